@@ -0,0 +1,122 @@
+import io
+import logging
+import pandas as pd
+
+from pandas import DataFrame
+
+
+class RunCheckpoint:
+
+    """
+    Progress checkpoint of an ETL run. Rows are saved in small parquet
+    parts under <prefix><run_id>/ as they are extracted, so that a run
+    that dies can be resumed fetching only the missing rows
+    """
+
+    def __init__(self,
+                 storage,
+                 prefix: str,
+                 run_id: str,
+                 columns: list):
+        """
+        Constructor for RunCheckpoint
+
+        :param storage: S3Bucket or LocalStorage where the parts are saved
+        :param prefix: the folder inside the storage for every run checkpoint
+        :param run_id: identifier of the run
+        :param columns: columns of the checkpointed rows
+        """
+        self._logger = logging.getLogger(__name__)
+        self.storage = storage
+        self.run_id = run_id
+        self.columns = columns
+        self.run_prefix = f"{prefix}{run_id}/"
+        self._next_part = len(self.part_keys())
+
+    def part_keys(self) -> list:
+        """
+        Returns the keys of the parts saved so far, in the order they were saved
+        """
+        return sorted(key for key in self.storage.list_keys(self.run_prefix) if key.endswith(".parquet"))
+
+    def iter_parts(self, columns: list = None):
+        """
+        Reads the saved parts one at a time
+
+        :param columns: columns to read. None reads every column
+
+        :returns:
+            Iterator: a DataFrame per part
+        """
+        for key in self.part_keys():
+            yield pd.read_parquet(io.BytesIO(self.storage.get_bytes(key)), columns=columns)
+
+    def iter_rows(self):
+        """
+        Reads the saved rows one part at a time
+
+        :returns:
+            Iterator: rows as tuples with the checkpoint columns
+        """
+        for part in self.iter_parts(columns=self.columns):
+            yield from part.itertuples(index=False, name=None)
+
+    def completed(self, key_cols: list) -> set:
+        """
+        Returns the keys of the rows saved so far
+
+        :param key_cols: columns that identify a row
+
+        :returns:
+            set: tuples with the key_cols values of every saved row
+        """
+        completed = set()
+        for part in self.iter_parts(columns=key_cols):
+            completed.update(part.itertuples(index=False, name=None))
+        return completed
+
+    def save_part(self, rows: list) -> str:
+        """
+        Saves rows as a new part
+
+        :param rows: tuples with the checkpoint columns
+
+        :returns:
+            str: key of the part
+        """
+        key = f"{self.run_prefix}part-{self._next_part:05d}.parquet"
+        buffer = io.BytesIO()
+        DataFrame(data=rows, columns=self.columns).to_parquet(buffer, compression='snappy')
+        self.storage.save_bytes(buffer.getvalue(), key)
+        self._next_part += 1
+        self._logger.debug(f"checkpointed {len(rows)} rows to {key}")
+        return key
+
+    def checkpointed(self, rows, part_size: int):
+        """
+        Passes rows through while saving them in parts of part_size rows
+
+        :param rows: iterable of tuples with the checkpoint columns
+        :param part_size: amount of rows per part
+
+        :returns:
+            Iterator: the same rows
+        """
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            yield row
+            if len(buffer) >= part_size:
+                self.save_part(buffer)
+                buffer = []
+        if buffer:
+            self.save_part(buffer)
+
+    def clear(self) -> bool:
+        """
+        Deletes every part of the run
+
+        :returns:
+            bool: True if the parts were deleted
+        """
+        return self.storage.delete_keys(self.part_keys())
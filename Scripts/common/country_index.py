@@ -0,0 +1,87 @@
+import hashlib
+import numpy as np
+import pandas as pd
+
+from pandas import DataFrame
+
+# bump it whenever the way the index is built changes, so that persisted indexes are rebuilt
+COUNTRY_INDEX_VERSION = 1
+
+EURO_REGION = "EU"
+
+
+class CountryIndex:
+
+    """
+    Precomputed country lookups shared by both ETLs: ALPHA-2 and ALPHA-3 codes,
+    local currency, euro membership and steam pricing region. Lookups are
+    exposed as Series indexed by country code, so that they're applied to whole
+    columns with Series.map instead of one lookup per row
+    """
+
+    COLUMNS = ["alpha_2", "alpha_3", "currency", "is_euro", "steam_region"]
+
+    def __init__(self, table: DataFrame):
+        """
+        Constructor for CountryIndex
+
+        :param table: df with COLUMNS, one row per country
+        """
+        self.table = table
+        content_hash = hashlib.sha1(pd.util.hash_pandas_object(table, index=False).values.tobytes()).hexdigest()
+        self.version = f"{COUNTRY_INDEX_VERSION}-{content_hash[:12]}"
+        by_alpha_2 = table.set_index("alpha_2")
+        self.alpha_3_by_alpha_2 = by_alpha_2["alpha_3"]
+        self.currency_by_alpha_2 = by_alpha_2["currency"]
+        self.is_euro_by_alpha_2 = by_alpha_2["is_euro"]
+        self.steam_region_by_alpha_2 = by_alpha_2["steam_region"]
+        self.alpha_2_by_alpha_3 = table.set_index("alpha_3")["alpha_2"]
+
+    @classmethod
+    def build(cls,
+              iso_codes: DataFrame,
+              alpha_2_col: str,
+              alpha_3_col: str) -> "CountryIndex":
+        """
+        Builds the index from the ISO-3166 lookup table. Currencies are looked up
+        in babel once here, not on every run
+
+        :param iso_codes: df with the ALPHA-2 and ALPHA-3 country codes
+        :param alpha_2_col: col with ALPHA-2 country codes
+        :param alpha_3_col: col with ALPHA-3 country codes
+
+        :returns:
+            CountryIndex: index with a row per country in iso_codes
+        """
+        iso_codes = iso_codes.dropna(subset=[alpha_2_col, alpha_3_col]) \
+                             .drop_duplicates(subset=[alpha_2_col])
+        # babel's locale data is only loaded when the index is rebuilt
+        from babel.numbers import get_territory_currencies
+        alpha_2 = iso_codes[alpha_2_col].str.upper().to_numpy()
+        currencies = []
+        for code in alpha_2:
+            territory_currencies = get_territory_currencies(code)
+            currencies.append(territory_currencies[0] if territory_currencies else None)
+        currencies = np.array(currencies, dtype=object)
+        is_euro = currencies == "EUR"
+        table = DataFrame({"alpha_2": alpha_2,
+                           "alpha_3": iso_codes[alpha_3_col].str.upper().to_numpy(),
+                           "currency": currencies,
+                           "is_euro": is_euro,
+                           # steam has a single price region for the whole euro zone
+                           "steam_region": np.where(is_euro, EURO_REGION, alpha_2)})
+        return cls(table)
+
+    def steam_regions(self, country_codes: list) -> dict:
+        """
+        Maps country codes to their steam pricing region
+
+        :param country_codes: country codes (ALPHA-2), in any case
+
+        :returns:
+            dict: country codes (as given) as keys and steam regions (lowercase) as values.
+                  Countries not in the index are their own region
+        """
+        codes = pd.Series(country_codes, dtype=object)
+        regions = codes.str.upper().map(self.steam_region_by_alpha_2).fillna(codes.str.upper())
+        return dict(zip(country_codes, regions.str.lower()))
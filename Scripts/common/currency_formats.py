@@ -0,0 +1,65 @@
+from typing import NamedTuple
+
+
+class CurrencyFormat(NamedTuple):
+    """
+    Represents how steam formats prices for a currency
+
+    :param decimal_sep: character separating the decimal part
+    :param thousands_sep: character grouping thousands. Whitespace separators
+                          are stored as " " (steam also sends no-break spaces)
+    """
+    decimal_sep: str
+    thousands_sep: str
+
+
+# steam store price formats per currency (ALPHA-3)
+STEAM_CURRENCY_FORMATS = {
+    "AED": CurrencyFormat(".", ","),
+    "ARS": CurrencyFormat(",", "."),
+    "AUD": CurrencyFormat(".", ","),
+    "BRL": CurrencyFormat(",", "."),
+    "CAD": CurrencyFormat(".", ","),
+    "CHF": CurrencyFormat(".", "'"),
+    "CLP": CurrencyFormat(",", "."),
+    "CNY": CurrencyFormat(".", ","),
+    "COP": CurrencyFormat(",", "."),
+    "CRC": CurrencyFormat(",", "."),
+    "EUR": CurrencyFormat(",", "."),
+    "GBP": CurrencyFormat(".", ","),
+    "HKD": CurrencyFormat(".", ","),
+    "IDR": CurrencyFormat(".", " "),
+    "ILS": CurrencyFormat(".", ","),
+    "INR": CurrencyFormat(".", ","),
+    "JPY": CurrencyFormat(".", ","),
+    "KRW": CurrencyFormat(".", ","),
+    "KWD": CurrencyFormat(".", ","),
+    "KZT": CurrencyFormat(",", " "),
+    "MXN": CurrencyFormat(".", ","),
+    "MYR": CurrencyFormat(".", ","),
+    "NOK": CurrencyFormat(",", " "),
+    "NZD": CurrencyFormat(".", ","),
+    "PEN": CurrencyFormat(".", ","),
+    "PHP": CurrencyFormat(".", ","),
+    "PLN": CurrencyFormat(",", " "),
+    "QAR": CurrencyFormat(".", ","),
+    "RUB": CurrencyFormat(",", " "),
+    "SAR": CurrencyFormat(".", ","),
+    "SGD": CurrencyFormat(".", ","),
+    "THB": CurrencyFormat(".", ","),
+    "TRY": CurrencyFormat(",", "."),
+    "TWD": CurrencyFormat(".", ","),
+    "UAH": CurrencyFormat(",", " "),
+    "USD": CurrencyFormat(".", ","),
+    "UYU": CurrencyFormat(",", "."),
+    "VND": CurrencyFormat(",", "."),
+    "ZAR": CurrencyFormat(".", " "),
+}
+
+# whitespace steam groups thousands with. The no-break spaces are listed on their own
+# because \s only matches ASCII whitespace in the pyarrow (RE2) backed string methods
+PRICE_WHITESPACE_PATTERN = "[\\s\u00a0\u202f]"
+
+# first run of digits and separators that starts and ends with a digit,
+# so that symbols like "pуб." or "kr." are left out
+PRICE_NUMBER_PATTERN = "(\\d[\\d.,'\\s\u00a0\u202f]*\\d|\\d)"
@@ -0,0 +1,171 @@
+import io
+import json
+import logging
+import threading
+import pandas as pd
+
+from Scripts.common.external_resources import OpenExRatesApi
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pandas import DataFrame
+
+SNAPSHOT_KEY_FORMAT = "%Y%m%d%H%M%S"
+
+
+class ExRatesCache:
+
+    """
+    Memoizes OpenExRatesApi responses. Rates are kept in memory and every
+    snapshot is persisted as parquet (in the bucket or locally) keyed by its
+    timestamp, so that reruns within the freshness window and reprocessing of
+    past snapshots don't call the API. It has the same get_ex_rates interface
+    as OpenExRatesApi, so it can be used in its place
+    """
+
+    def __init__(self,
+                 ex_rates_api: OpenExRatesApi,
+                 storage=None,
+                 prefix: str = "ex_rates/",
+                 freshness_minutes: float = 60,
+                 max_workers: int = 4):
+        """
+        Constructor for ExRatesCache
+
+        :param ex_rates_api: connection to exchange rates api
+        :param storage: S3Bucket or LocalStorage where snapshots are persisted. None keeps
+                        them in memory only
+        :param prefix: the folder inside storage for the snapshots
+        :param freshness_minutes: minutes a snapshot is served for before the api is called again
+        :param max_workers: number of threads requesting historical rates concurrently
+        """
+        self._logger = logging.getLogger(__name__)
+        self.ex_rates_api = ex_rates_api
+        self.storage = storage
+        self.prefix = prefix
+        self.freshness = timedelta(minutes=freshness_minutes)
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._historical = {}
+
+    def _snapshots_prefix(self, base_currency: str) -> str:
+        return f"{self.prefix}base={base_currency}/snapshots/"
+
+    def _historical_key(self, base_currency: str, date: str) -> str:
+        return f"{self.prefix}base={base_currency}/historical/{date}.parquet"
+
+    def _save(self, rates: dict, key: str, timestamp: datetime):
+        if self.storage is None:
+            return
+        buffer = io.BytesIO()
+        DataFrame({"currency": list(rates.keys()),
+                   "rate": list(rates.values()),
+                   "timestamp": timestamp}).to_parquet(buffer, compression='snappy')
+        self.storage.save_bytes(buffer.getvalue(), key)
+
+    def _load(self, key: str) -> dict:
+        if self.storage is None:
+            return None
+        data = self.storage.get_bytes(key)
+        if data is None:
+            return None
+        df = pd.read_parquet(io.BytesIO(data))
+        return dict(zip(df["currency"], df["rate"].astype(float)))
+
+    def _latest_pointer(self, base_currency: str) -> dict:
+        if self.storage is None:
+            return None
+        data = self.storage.get_bytes(f"{self.prefix}base={base_currency}/latest.json")
+        return json.loads(data) if data is not None else None
+
+    def get_ex_rates(self,
+                     base_currency: str,
+                     other_currencies: list) -> dict:
+        """
+        Gets exchange rates from memory, the persisted snapshots or the API, in that
+        order. Snapshots older than the freshness window are not served
+
+        :param base_currency: currency (ALPHA-3) exchange rates will be relative to
+        :param other_currencies: currencies (ALPHA-3) to get the exchange rates of
+
+        :returns:
+            dict: currencies (ALPHA-3) as keys and exchange rates float as values
+        """
+        now = datetime.now()
+        with self._lock:
+            snapshot = self._latest.get(base_currency)
+            if snapshot is None:
+                pointer = self._latest_pointer(base_currency)
+                if pointer is not None:
+                    rates = self._load(pointer["key"])
+                    if rates is not None:
+                        snapshot = (datetime.strptime(pointer["timestamp"], SNAPSHOT_KEY_FORMAT), rates)
+            if snapshot is not None and now - snapshot[0] <= self.freshness \
+                    and set(other_currencies) <= set(snapshot[1]):
+                self._logger.debug(f"ex rates for {base_currency} served from the {snapshot[0]} snapshot")
+                self._latest[base_currency] = snapshot
+                return {currency: snapshot[1][currency] for currency in other_currencies}
+
+            rates = self.ex_rates_api.get_ex_rates(base_currency, other_currencies)
+            timestamp = now.strftime(SNAPSHOT_KEY_FORMAT)
+            key = f"{self._snapshots_prefix(base_currency)}{timestamp}.parquet"
+            self._save(rates, key, now)
+            if self.storage is not None:
+                self.storage.save_bytes(json.dumps({"timestamp": timestamp, "key": key}).encode(),
+                                        f"{self.prefix}base={base_currency}/latest.json")
+            self._latest[base_currency] = (now, rates)
+            return dict(rates)
+
+    def get_ex_rates_at(self,
+                        base_currency: str,
+                        when: datetime) -> dict:
+        """
+        Gets the last persisted snapshot taken at or before when, without calling the API.
+        Used to re-normalize past price snapshots
+
+        :param base_currency: currency (ALPHA-3) exchange rates are relative to
+        :param when: date of the price snapshot
+
+        :returns:
+            dict: currencies (ALPHA-3) as keys and exchange rates float as values. None
+                  if there is no snapshot before when
+        """
+        if self.storage is None:
+            return None
+        prefix = self._snapshots_prefix(base_currency)
+        limit = f"{prefix}{when.strftime(SNAPSHOT_KEY_FORMAT)}.parquet"
+        keys = [key for key in self.storage.list_keys(prefix) if key <= limit]
+        return self._load(max(keys)) if keys else None
+
+    def get_historical_ex_rates(self,
+                                base_currency: str,
+                                other_currencies: list,
+                                dates: list) -> dict:
+        """
+        Gets the daily exchange rates of many days at once, for backfills. Days that
+        are already persisted are read from storage and the missing ones are requested
+        to the API concurrently and persisted
+
+        :param base_currency: currency (ALPHA-3) exchange rates will be relative to
+        :param other_currencies: currencies (ALPHA-3) to get the exchange rates of
+        :param dates: days (YYYY-MM-DD) to get the exchange rates of
+
+        :returns:
+            dict: days as keys and dicts with currencies as keys and exchange rates as values
+        """
+        def get_day(date):
+            cache_key = (base_currency, date)
+            if cache_key in self._historical:
+                return self._historical[cache_key]
+            rates = self._load(self._historical_key(base_currency, date))
+            if rates is None or not set(other_currencies) <= set(rates):
+                rates = self.ex_rates_api.get_historical_ex_rates(date, base_currency, other_currencies)
+                self._save(rates, self._historical_key(base_currency, date), datetime.strptime(date, "%Y-%m-%d"))
+            self._historical[cache_key] = rates
+            return rates
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            historical = dict(zip(dates, executor.map(get_day, dates)))
+        self._logger.info(f"historical ex rates for {len(dates)} days retrieved")
+        return {date: {currency: rates.get(currency) for currency in other_currencies}
+                for date, rates in historical.items()}
@@ -1,11 +1,239 @@
+import os
 import json
+import time
 import requests
 import logging
-import boto3
 import io
-import pandas as pd
+import bisect
+import tempfile
+import uuid
+
+from Scripts.common.metrics import METRICS
+from Scripts.common.rate_limiter import AdaptiveRateLimiter, parse_retry_after, backoff_delay
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from typing import NamedTuple, TYPE_CHECKING
+from urllib3.util.retry import Retry
+
+# boto3 and pyarrow are imported by the methods using them, so that jobs only load what they use
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+    from matplotlib.figure import Figure
+
+PARQUET_MAGIC = b"PAR1"
+
+
+class S3TransferConfig(NamedTuple):
+    """
+    Transfer settings of S3Bucket
+
+    :param multipart_threshold: objects from this size on are uploaded and downloaded in parts
+    :param multipart_chunksize: size of each part
+    :param max_concurrency: parts, ranges or files (upload_many) transferred at the same time
+    :param use_threads: False transfers the parts of an object one after the other
+    :param spool_max_size: objects built by S3Bucket (parquet, png) are kept in memory up to
+                           this size, bigger ones are spilled to a temporary file
+    :param footer_read_size: bytes read from the end of a parquet file to get its footer, a
+                             bigger footer takes a second request
+    :param range_coalesce_gap: column chunks closer than this are fetched in a single ranged GET
+    """
+    multipart_threshold: int = 8 * 2 ** 20
+    multipart_chunksize: int = 8 * 2 ** 20
+    max_concurrency: int = 10
+    use_threads: bool = True
+    spool_max_size: int = 16 * 2 ** 20
+    footer_read_size: int = 64 * 2 ** 10
+    range_coalesce_gap: int = 2 ** 20
+
+
+def merge_ranges(ranges: list, gap: int = 0) -> list:
+    """
+    Merges byte ranges that overlap or are less than gap bytes apart
+
+    :param ranges: (start, end) tuples, end excluded
+    :param gap: bytes between two ranges that are worth downloading to save a request
+
+    :returns:
+        list: sorted (start, end) tuples
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def parquet_column_ranges(metadata, columns: list, row_groups: list = None) -> list:
+    """
+    Returns the byte ranges of the column chunks of columns in a parquet file
+
+    :param metadata: pyarrow FileMetaData of the file
+    :param columns: top level column names
+    :param row_groups: indices of the row groups to get the ranges of. None means every row group
+
+    :returns:
+        list: (start, end) tuples, end excluded, one per row group and column
+    """
+    columns = set(columns)
+    ranges = []
+    for i in (row_groups if row_groups is not None else range(metadata.num_row_groups)):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            chunk = row_group.column(j)
+            if chunk.path_in_schema.split(".")[0] not in columns:
+                continue
+            # the dictionary page, when there's one, comes before the data pages
+            start = chunk.dictionary_page_offset if chunk.has_dictionary_page else chunk.data_page_offset
+            ranges.append((start, start + chunk.total_compressed_size))
+    return ranges
+
+
+class _RangedObjectFile(io.RawIOBase):
+
+    """
+    Read only file over an object of the bucket that only downloads the byte ranges
+    it's asked for. Ranges fetched in advance with prefetch are served from memory,
+    any other read is a ranged GET of its own
+    """
+
+    def __init__(self, s3_bucket: "S3Bucket", key: str, size: int):
+        super().__init__()
+        self.s3_bucket = s3_bucket
+        self.key = key
+        self.size = size
+        self.bytes_fetched = 0
+        self.footer_start = size
+        self._position = 0
+        # downloaded blocks, sorted by the offset they start at
+        self._starts = []
+        self._blocks = []
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        data = self.s3_bucket.get_range(self.key, start, end)
+        self.bytes_fetched += len(data)
+        return data
+
+    def _add_block(self, start: int, data: bytes):
+        i = bisect.bisect(self._starts, start)
+        self._starts.insert(i, start)
+        self._blocks.insert(i, data)
+
+    def fetch_parquet_footer(self, read_size: int) -> bytes:
+        """
+        Downloads the footer of the parquet file, with one ranged GET if it fits in
+        read_size bytes and two otherwise. Whatever else came with it is kept too
+
+        :param read_size: bytes read from the end of the file first
+
+        :returns:
+            bytes: the footer, i.e. the file metadata, its length and the magic bytes
+
+        :raises ValueError: if the object isn't a parquet file
+        """
+        tail_start = max(0, self.size - read_size)
+        tail = self._fetch(tail_start, self.size)
+        if len(tail) < 8 or tail[-4:] != PARQUET_MAGIC:
+            raise ValueError(f"{self.key} isn't a parquet file")
+        # the file ends with the metadata, its length and the magic bytes
+        metadata_start = self.size - 8 - int.from_bytes(tail[-8:-4], "little")
+        if metadata_start < tail_start:
+            tail = self._fetch(metadata_start, tail_start) + tail
+            tail_start = metadata_start
+        self._add_block(tail_start, tail)
+        self.footer_start = tail_start
+        return tail[metadata_start - tail_start:]
+
+    def prefetch_columns(self,
+                         metadata,
+                         columns: list,
+                         row_groups: list = None,
+                         gap: int = 0,
+                         max_workers: int = 1):
+        """
+        Downloads the column chunks of columns, merging the ones less than gap bytes
+        apart. What came with the footer isn't downloaded again
+
+        :param metadata: pyarrow FileMetaData of the file
+        :param columns: top level column names
+        :param row_groups: indices of the row groups to download. None means every row group
+        :param gap: bytes between two chunks that are worth downloading to save a request
+        :param max_workers: ranged GETs running at the same time
+        """
+        ranges = merge_ranges(parquet_column_ranges(metadata, columns, row_groups), gap=gap)
+        # small files come whole with the footer
+        self.prefetch([(start, min(end, self.footer_start)) for start, end in ranges if start < self.footer_start],
+                      max_workers=max_workers)
+
+    def discard_prefetched(self):
+        """
+        Frees every downloaded range but the footer
+        """
+        footer = [i for i, start in enumerate(self._starts) if start >= self.footer_start]
+        self._starts = [self._starts[i] for i in footer]
+        self._blocks = [self._blocks[i] for i in footer]
+
+    def prefetch(self, ranges: list, max_workers: int = 1):
+        """
+        Downloads byte ranges, max_workers at a time, and keeps them in memory
+
+        :param ranges: (start, end) tuples, end excluded, that don't overlap each other nor the footer
+        :param max_workers: ranged GETs running at the same time
+        """
+        if not ranges:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ranges)))) as executor:
+            blocks = list(executor.map(lambda r: self.s3_bucket.get_range(self.key, *r), ranges))
+        for (start, _), data in zip(ranges, blocks):
+            self.bytes_fetched += len(data)
+            self._add_block(start, data)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        end = min(self._position + len(buffer), self.size)
+        position = self._position
+        chunks = []
+        while position < end:
+            i = bisect.bisect(self._starts, position) - 1
+            if i >= 0 and position < self._starts[i] + len(self._blocks[i]):
+                chunk = self._blocks[i][position - self._starts[i]:end - self._starts[i]]
+            else:
+                # the bytes up to the next block aren't in memory
+                next_start = self._starts[i + 1] if i + 1 < len(self._starts) else end
+                chunk = self._fetch(position, min(next_start, end))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            position += len(chunk)
+        data = b"".join(chunks)
+        buffer[:len(data)] = data
+        self._position = position
+        return len(data)
+
+
+class ConditionalWriteUnsupported(RuntimeError):
+
+    """
+    Raised when an object can't be written only if absent, because botocore or
+    the S3 endpoint don't support conditional writes (If-None-Match)
+    """
 
-from matplotlib.figure import Figure
 
 class S3Bucket:
 
@@ -18,7 +246,8 @@ class S3Bucket:
                  region_name: str,
                  aws_access_key_id: str,
                  aws_secret_access_key: str,
-                 bucket_name: str):
+                 bucket_name: str,
+                 transfer_config: dict = None):
         """
         Constructor for S3Bucket
 
@@ -27,15 +256,46 @@ class S3Bucket:
         :param aws_access_key_id: secret key for session initialization
         :param aws_secret_access_key: secret access key for session initialization
         :param bucket_name: S3 bucket name
+        :param transfer_config: S3TransferConfig fields. None keeps the defaults
         """
+        self._logger = logging.getLogger(__name__)
         self.endpoint_url = endpoint_url
         self.region_name = region_name
         self.bucket_name = bucket_name
+        self.transfer_config = S3TransferConfig(**(transfer_config or {}))
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
         self.session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
                                              aws_secret_access_key=aws_secret_access_key)
-        self.s3_session = self.session.client('s3', endpoint_url=endpoint_url, region_name=region_name)
+        # every concurrent part or range needs its own connection
+        self.s3_session = self.session.client('s3', endpoint_url=endpoint_url, region_name=region_name,
+                                              config=Config(max_pool_connections=max(
+                                                  10, self.transfer_config.max_concurrency)))
+        self._transfer_args = {"Config": TransferConfig(
+            multipart_threshold=self.transfer_config.multipart_threshold,
+            multipart_chunksize=self.transfer_config.multipart_chunksize,
+            max_concurrency=self.transfer_config.max_concurrency,
+            use_threads=self.transfer_config.use_threads)}
 
-    def save_df_to_parquet(self, df: pd.DataFrame, key: str) -> bool:
+    def _put_fileobj(self, fileobj, key: str):
+        """
+        Streams a file object from its current position to the bucket, recording
+        the request and the bytes uploaded
+        """
+        start = fileobj.tell()
+        with METRICS.timer("s3_request_seconds", operation="put"):
+            self.s3_session.upload_fileobj(fileobj, self.bucket_name, key, **self._transfer_args)
+        METRICS.inc("s3_requests_total", operation="put")
+        METRICS.inc("s3_bytes_uploaded_total", fileobj.seek(0, io.SEEK_END) - start)
+
+    def _spooled_file(self):
+        """
+        Returns a file kept in memory until it outgrows spool_max_size
+        """
+        return tempfile.SpooledTemporaryFile(max_size=self.transfer_config.spool_max_size)
+
+    def save_df_to_parquet(self, df: "pd.DataFrame", key: str) -> bool:
         """
         Handles S3 bucket connection to save dataframes
 
@@ -45,26 +305,358 @@ class S3Bucket:
         :returns:
             bool: True if data was loaded successfully
         """
-        df_buffer = io.BytesIO()
-        df.to_parquet(df_buffer, engine='auto', compression='snappy')
-        df_buffer.seek(0)
-        self.s3_session.upload_fileobj(df_buffer, self.bucket_name, key)
+        with self._spooled_file() as df_buffer:
+            df.to_parquet(df_buffer, engine='auto', compression='snappy')
+            df_buffer.seek(0)
+            self._put_fileobj(df_buffer, key)
         return True
 
-    def save_fig_to_png(self, fig: Figure, key: str) -> bool:
+    def write_df_chunks_to_parquet_file(self, df_chunks, schema: "pa.Schema" = None):
         """
-        Handles S3 bucket connection to save dataframes
+        Writes dataframes that are built in chunks to a local temporary parquet file.
+        Each chunk is written as a row group as soon as it arrives, so memory usage
+        doesn't depend on the amount of rows
 
-        :param df: DataFrame with the data to be saved
+        :param df_chunks: iterable of DataFrames with the same columns
+        :param schema: parquet schema of the file. None infers it from the first chunk
+
+        :returns:
+            file: temporary file positioned at the start. None if there was no data
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        parquet_file = tempfile.TemporaryFile()
+        writer = None
+        for df in df_chunks:
+            if df.empty:
+                continue
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_file, table.schema, compression='snappy')
+            writer.write_table(table.cast(writer.schema), row_group_size=len(df))
+        if writer is None:
+            parquet_file.close()
+            return None
+        writer.close()
+        parquet_file.seek(0)
+        return parquet_file
+
+    def upload_file(self, fileobj, key: str) -> bool:
+        """
+        Streams a file to the bucket and closes it
+
+        :param fileobj: file opened in binary mode
+        :param key: string path in bucket where data is going to be located in (containing filename too)
+
+        :returns:
+            bool: True if data was loaded successfully
+        """
+        with fileobj:
+            self._put_fileobj(fileobj, key)
+        return True
+
+    def save_df_chunks_to_parquet(self, df_chunks, key: str, schema: "pa.Schema" = None) -> bool:
+        """
+        Handles S3 bucket connection to save dataframes that are built in chunks.
+        Chunks are written to a local temporary file as row groups and the file
+        is streamed to the bucket at the end
+
+        :param df_chunks: iterable of DataFrames with the same columns
+        :param key: string path in bucket where data is going to be located in (containing filename too)
+        :param schema: parquet schema of the file. None infers it from the first chunk
+
+        :returns:
+            bool: True if data was loaded successfully, False if there was no data
+        """
+        parquet_file = self.write_df_chunks_to_parquet_file(df_chunks, schema=schema)
+        if parquet_file is None:
+            return False
+        return self.upload_file(parquet_file, key)
+
+    def upload_many(self, objects: dict, max_workers: int = None) -> bool:
+        """
+        Uploads several objects at the same time, e.g. every artifact of a run.
+        File objects are closed once uploaded
+
+        :param objects: keys in the bucket as keys and bytes or files opened in binary mode as values
+        :param max_workers: objects uploaded at the same time. None uses max_concurrency
+
+        :returns:
+            bool: True if every object was loaded successfully
+        """
+        def upload(key, data):
+            if isinstance(data, (bytes, bytearray)):
+                return self.save_bytes(data, key)
+            return self.upload_file(data, key)
+
+        if not objects:
+            return True
+        max_workers = min(max_workers or self.transfer_config.max_concurrency, len(objects))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(upload, key, data) for key, data in objects.items()]
+            for future in futures:
+                future.result()
+        return True
+
+    def save_fig_to_png(self, fig: "Figure", key: str) -> bool:
+        """
+        Handles S3 bucket connection to save figures
+
+        :param fig: matplotlib figure to be saved
+        :param key: string path in bucket where data is going to be located in (containing filename too)
+
+        :returns:
+            bool: True if data was loaded successfully
+        """
+        with self._spooled_file() as buffer:
+            fig.savefig(buffer, format="png")
+            buffer.seek(0)
+            self._put_fileobj(buffer, key)
+        return True
+
+    def save_bytes(self, data: bytes, key: str) -> bool:
+        """
+        Saves raw bytes to the bucket
+
+        :param data: object content
         :param key: string path in bucket where data is going to be located in (containing filename too)
 
         :returns:
             bool: True if data was loaded successfully
         """
-        buffer = io.BytesIO()
-        fig.savefig(buffer, format="png")
-        buffer.seek(0)
-        self.s3_session.upload_fileobj(buffer, self.bucket_name, key)
+        with METRICS.timer("s3_request_seconds", operation="put"):
+            self.s3_session.put_object(Bucket=self.bucket_name, Key=key, Body=data)
+        METRICS.inc("s3_requests_total", operation="put")
+        METRICS.inc("s3_bytes_uploaded_total", len(data))
+        return True
+
+    def save_bytes_if_absent(self, data: bytes, key: str) -> bool:
+        """
+        Saves raw bytes to the bucket only if there's no object in key yet. The check
+        and the write are a single conditional request (If-None-Match), so when
+        several processes race for the same key exactly one of them wins
+
+        :param data: object content
+        :param key: string path in bucket where data is going to be located in (containing filename too)
+
+        :returns:
+            bool: True if data was saved, False if the object already existed
+
+        :raises ConditionalWriteUnsupported: if botocore or the endpoint don't support conditional writes
+        """
+        from botocore.exceptions import ParamValidationError
+        try:
+            with METRICS.timer("s3_request_seconds", operation="put"):
+                self.s3_session.put_object(Bucket=self.bucket_name, Key=key, Body=data, IfNoneMatch="*")
+        except ParamValidationError as e:
+            # botocore < 1.35.2 doesn't know the parameter and refuses to send the request
+            if "IfNoneMatch" not in str(e):
+                raise
+            raise ConditionalWriteUnsupported(f"conditional writes (If-None-Match) aren't supported by the "
+                                              f"installed botocore, saving {key} needs botocore >= 1.35.2") from e
+        except self.s3_session.exceptions.ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("NotImplemented", "501"):
+                # S3 compatible stores that don't implement the header, a write there can't be made exclusive
+                raise ConditionalWriteUnsupported(f"conditional writes (If-None-Match) aren't supported by "
+                                                  f"{self.endpoint_url or 'the S3 endpoint'}, {key} can't be "
+                                                  f"saved only if absent") from e
+            # 409 means a concurrent conditional write to the same key is in progress
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            METRICS.inc("s3_requests_total", operation="put", status="exists")
+            return False
+        METRICS.inc("s3_requests_total", operation="put")
+        METRICS.inc("s3_bytes_uploaded_total", len(data))
+        return True
+
+    def get_bytes(self, key: str) -> bytes:
+        """
+        Reads an object from the bucket
+
+        :param key: string path in bucket of the object
+
+        :returns:
+            bytes: object content. None if the object doesn't exist
+        """
+        try:
+            with METRICS.timer("s3_request_seconds", operation="get"):
+                data = self.s3_session.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
+        except self.s3_session.exceptions.NoSuchKey:
+            METRICS.inc("s3_requests_total", operation="get", status="missing")
+            return None
+        METRICS.inc("s3_requests_total", operation="get")
+        METRICS.inc("s3_bytes_downloaded_total", len(data))
+        return data
+
+    def download_fileobj(self, key: str, fileobj):
+        """
+        Streams an object of the bucket to a file object
+
+        :param key: string path in bucket of the object
+        :param fileobj: file opened in binary mode to write the object to
+        """
+        start = fileobj.tell()
+        with METRICS.timer("s3_request_seconds", operation="get"):
+            self.s3_session.download_fileobj(self.bucket_name, key, fileobj, **self._transfer_args)
+        METRICS.inc("s3_requests_total", operation="get")
+        METRICS.inc("s3_bytes_downloaded_total", fileobj.seek(0, io.SEEK_END) - start)
+
+    def get_size(self, key: str) -> int:
+        """
+        Returns the size of an object of the bucket
+
+        :param key: string path in bucket of the object
+
+        :returns:
+            int: size in bytes. None if the object doesn't exist
+        """
+        try:
+            with METRICS.timer("s3_request_seconds", operation="head"):
+                size = self.s3_session.head_object(Bucket=self.bucket_name, Key=key)["ContentLength"]
+        except self.s3_session.exceptions.ClientError as e:
+            # HEAD responses have no body, so a missing key comes as a bare 404
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            METRICS.inc("s3_requests_total", operation="head", status="missing")
+            return None
+        METRICS.inc("s3_requests_total", operation="head")
+        return size
+
+    def get_range(self, key: str, start: int, end: int) -> bytes:
+        """
+        Reads a byte range of an object with a ranged GET
+
+        :param key: string path in bucket of the object
+        :param start: first byte of the range
+        :param end: byte the range ends at, excluded
+
+        :returns:
+            bytes: content of the range
+        """
+        with METRICS.timer("s3_request_seconds", operation="get_range"):
+            data = self.s3_session.get_object(Bucket=self.bucket_name, Key=key,
+                                              Range=f"bytes={start}-{end - 1}")["Body"].read()
+        METRICS.inc("s3_requests_total", operation="get_range")
+        METRICS.inc("s3_bytes_downloaded_total", len(data))
+        return data
+
+    @contextmanager
+    def _open_parquet(self, key: str, size: int):
+        """
+        Opens a parquet file of the bucket downloading only its footer. The column
+        chunks are downloaded as they're prefetched or read
+
+        :returns:
+            tuple: the _RangedObjectFile and the pyarrow ParquetFile reading from it
+        """
+        import pyarrow.parquet as pq
+        with _RangedObjectFile(self, key, size) as f:
+            footer = f.fetch_parquet_footer(self.transfer_config.footer_read_size)
+            # the metadata is parsed from the footer already downloaded, pyarrow
+            # would otherwise read the end of the file again with its own read size
+            metadata = pq.read_metadata(io.BytesIO(PARQUET_MAGIC + footer))
+            try:
+                yield f, pq.ParquetFile(f, metadata=metadata)
+            finally:
+                METRICS.inc("s3_bytes_skipped_total", size - f.bytes_fetched)
+                self._logger.debug(f"{key}: read {f.bytes_fetched} of {size} bytes")
+
+    def read_parquet(self, key: str, columns: list = None) -> "pd.DataFrame":
+        """
+        Reads a parquet file of the bucket downloading only what's needed: the footer
+        first, then the chunks of columns in every row group, with ranges that are
+        close together merged and up to max_concurrency ranged GETs at a time
+
+        :param key: string path in bucket of the parquet file
+        :param columns: columns to read. None reads every column
+
+        :returns:
+            DataFrame: the columns of the file
+
+        :raises FileNotFoundError: if there's no object in key
+        """
+        size = self.get_size(key)
+        if size is None:
+            raise FileNotFoundError(f"{key} isn't in bucket {self.bucket_name}")
+        with self._open_parquet(key, size) as (f, parquet_file):
+            f.prefetch_columns(parquet_file.metadata,
+                               columns if columns is not None else parquet_file.schema_arrow.names,
+                               gap=self.transfer_config.range_coalesce_gap,
+                               max_workers=self.transfer_config.max_concurrency)
+            return parquet_file.read(columns=columns, use_pandas_metadata=True).to_pandas()
+
+    def iter_parquet_row_groups(self, key: str, columns: list = None, ranges: dict = None):
+        """
+        Reads a parquet file of the bucket one row group at a time. The footer is
+        downloaded first and row groups whose statistics fall outside ranges are
+        skipped without downloading them. Of the rest, only the chunks of columns
+        are downloaded, one row group at a time
+
+        :param key: string path in bucket of the parquet file
+        :param columns: columns to read. None reads every column
+        :param ranges: dict with column names as keys and (min, max) tuples as values, both
+                       inclusive. None bounds are open
+
+        :returns:
+            Iterator: pyarrow Tables, one per row group read. Nothing if there's no object in key
+        """
+        from Scripts.common.parquet_dataset import row_groups_in_ranges
+        size = self.get_size(key)
+        if size is None:
+            return
+        with self._open_parquet(key, size) as (f, parquet_file):
+            metadata = parquet_file.metadata
+            for row_group in row_groups_in_ranges(metadata, ranges):
+                f.prefetch_columns(metadata,
+                                   columns if columns is not None else parquet_file.schema_arrow.names,
+                                   row_groups=[row_group],
+                                   gap=self.transfer_config.range_coalesce_gap,
+                                   max_workers=self.transfer_config.max_concurrency)
+                yield parquet_file.read_row_group(row_group, columns=columns)
+                # only a row group is kept in memory at a time
+                f.discard_prefetched()
+
+    def _list_objects(self, **pagination_args) -> list:
+        """
+        Lists objects with list_objects_v2, following its pages. Every page is a
+        request of its own and is recorded as such
+
+        :returns:
+            list: Contents entries of every page
+        """
+        paginator = self.s3_session.get_paginator("list_objects_v2")
+        contents = []
+        for page in paginator.paginate(**pagination_args):
+            METRICS.inc("s3_requests_total", operation="list")
+            contents.extend(page.get("Contents", []))
+        return contents
+
+    def list_keys(self, prefix: str) -> list:
+        """
+        Lists every key under prefix, subfolders included
+
+        :param prefix: "Folder" to list the keys of
+
+        :returns:
+            list: keys under prefix
+        """
+        return [content["Key"] for content in self._list_objects(Bucket=self.bucket_name, Prefix=prefix)]
+
+    def delete_keys(self, keys: list) -> bool:
+        """
+        Deletes objects from the bucket
+
+        :param keys: keys of the objects to delete
+
+        :returns:
+            bool: True if the objects were deleted
+        """
+        # delete_objects accepts up to 1000 keys per request
+        for i in range(0, len(keys), 1000):
+            METRICS.inc("s3_requests_total", operation="delete")
+            self.s3_session.delete_objects(Bucket=self.bucket_name,
+                                           Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]]})
         return True
 
     def get_bucket_filenames(self,
@@ -85,33 +677,306 @@ class S3Bucket:
         :returns:
             list: strings containing filenames in prefix under aforementioned conditions
         """
-        filenames = []
-        api_res = self.s3_session.list_objects_v2(Bucket=bucket_name, Prefix=prefix, Delimiter=delimiter)
-        result = api_res['Contents']
-        result = sorted(result, key=lambda d: d['LastModified'], reverse=True)
-        filenames = [file_content["Key"] for file_content in result]
+        # with a delimiter, S3 leaves the files in "subfolders" out of Contents by itself
+        pagination_args = {"Bucket": bucket_name, "Prefix": prefix}
         if same_level:
-            sub_prefixes = api_res["CommonPrefixes"]
-            sub_prefixes = [sub_prefix.get("Prefix") for sub_prefix in sub_prefixes]
-            is_file_in_sub_prefix = lambda file: any(sub_prefix in file for sub_prefix in sub_prefixes)
-            filenames = list(filter(lambda file: not is_file_in_sub_prefix(file), filenames))
-        return filenames
+            pagination_args["Delimiter"] = delimiter
+        result = self._list_objects(**pagination_args)
+        result = sorted(result, key=lambda d: d['LastModified'], reverse=True)
+        return [file_content["Key"] for file_content in result]
 
-class SteamWebApi:
+
+class LocalStorage:
+
+    """
+    Local directory with the same object interface as S3Bucket
+    (save_bytes, save_bytes_if_absent, get_bytes, list_keys and delete_keys)
+    """
+
+    def __init__(self, root_dir: str):
+        """
+        Constructor for LocalStorage
+
+        :param root_dir: directory keys are relative to
+        """
+        self.root_dir = root_dir
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root_dir, *key.split("/"))
+
+    def save_bytes(self, data: bytes, key: str) -> bool:
+        """
+        Saves raw bytes to a file. The file is written under a temporary
+        name first so that readers never see a partial file
+
+        :param data: file content
+        :param key: path relative to root_dir
+
+        :returns:
+            bool: True if data was saved successfully
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return True
+
+    def save_bytes_if_absent(self, data: bytes, key: str) -> bool:
+        """
+        Saves raw bytes to a file only if it doesn't exist. The file is written under
+        a unique temporary name and hard linked to its final name, which fails if the
+        file exists, so processes racing for the same file never overwrite each other
+
+        :param data: file content
+        :param key: path relative to root_dir
+
+        :returns:
+            bool: True if data was saved, False if the file already existed
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    def get_bytes(self, key: str) -> bytes:
+        """
+        Reads a file
+
+        :param key: path relative to root_dir
+
+        :returns:
+            bytes: file content. None if the file doesn't exist
+        """
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def list_keys(self, prefix: str) -> list:
+        """
+        Lists every key starting with prefix
+
+        :param prefix: key prefix
+
+        :returns:
+            list: keys under prefix
+        """
+        keys = []
+        for dir_path, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                key = os.path.relpath(os.path.join(dir_path, filename), self.root_dir).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return keys
+
+    def delete_keys(self, keys: list) -> bool:
+        """
+        Deletes files
+
+        :param keys: paths relative to root_dir
+
+        :returns:
+            bool: True if the files were deleted
+        """
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        return True
+
+
+class HttpClient:
+
+    """
+    Base class for API connections. Owns a persistent requests Session whose
+    connection pool is reused (keep-alive) across every request of the run.
+    Every response is recorded in the run metrics under the API_NAME label
+    """
+
+    API_NAME = "http"
+
+    def __init__(self,
+                 pool_size: int = 10,
+                 timeout: float = 10,
+                 retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 keep_alive: bool = True):
+        """
+        Constructor for HttpClient
+
+        :param pool_size: max amount of connections kept open per host
+        :param timeout: seconds to wait for the server to connect/send data
+        :param retries: transport-level retries (connection and read errors)
+        :param backoff_factor: backoff factor between transport-level retries
+        :param keep_alive: if False, connections are closed after every request
+        """
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries,
+                                                connect=retries,
+                                                read=retries,
+                                                status=0,
+                                                backoff_factor=backoff_factor,
+                                                raise_on_status=False))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+        self.session.hooks["response"].append(self._record_response)
+
+    def _record_response(self, response: requests.Response, *args, **kwargs):
+        METRICS.inc("http_requests_total", api=self.API_NAME, status=response.status_code)
+        METRICS.observe("http_request_seconds", response.elapsed.total_seconds(), api=self.API_NAME)
+        METRICS.inc("http_bytes_downloaded_total", len(response.content), api=self.API_NAME)
+
+    def close(self):
+        """
+        Closes every connection in the pool
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SteamWebApi(HttpClient):
 
     """
     Represents connection to Steam Market API
     """
 
+    API_NAME = "steam_appdetails"
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
     def __init__(self,
-                 endpoint: str):
+                 endpoint: str,
+                 rate_limit: dict = None,
+                 max_retries: int = 5,
+                 backoff_base: float = 1.0,
+                 backoff_max: float = 60.0,
+                 http_config: dict = None):
         """
         Constructor for SteamWebAPI
 
         :param endpoint: API's endpoint
+        :param rate_limit: args for the AdaptiveRateLimiter shared by every request
+        :param max_retries: times a throttled or failed request is retried before giving up
+        :param backoff_base: delay (in seconds) before the first retry
+        :param backoff_max: maximum delay (in seconds) between retries
+        :param http_config: args for the HttpClient connection pool. Its transport-level
+                            retries are always disabled, every retry goes through _get
         """
+        # retries inside urllib3 would skip the rate limiter and multiply _get's own retries
+        super().__init__(**dict(http_config or {}, retries=0))
         self._logger = logging.getLogger(__name__)
         self.endpoint = endpoint
+        self.rate_limiter = AdaptiveRateLimiter(**(rate_limit or {}))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _get(self, params: dict) -> requests.Response:
+        """
+        Requests the endpoint through the rate limiter, retrying throttled
+        (429), failed (5xx), dropped and timed out requests with jittered
+        exponential backoff. A Retry-After header is waited out before retrying
+
+        :param params: query params for the request
+
+        :returns:
+            Response: the first successful response
+
+        :raises requests.HTTPError: if the request keeps failing after max_retries
+        :raises requests.RequestException: if the connection keeps failing or timing out after max_retries
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                req = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # ConnectTimeout is both, ReadTimeout only a Timeout
+                reason = "timeout" if isinstance(e, requests.Timeout) else "connection"
+                METRICS.inc("http_errors_total", api=self.API_NAME, reason=reason)
+                if attempt == self.max_retries:
+                    raise
+                self._logger.debug(f"{reason} error {e}, retrying...")
+                METRICS.inc("http_retries_total", api=self.API_NAME)
+                time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+                continue
+            if req.status_code not in self.RETRY_STATUS_CODES:
+                self.rate_limiter.on_success()
+                return req
+            retry_after = parse_retry_after(req.headers.get("Retry-After"))
+            self.rate_limiter.on_throttle(retry_after)
+            if req.status_code == 429:
+                METRICS.inc("http_throttled_total", api=self.API_NAME)
+            else:
+                METRICS.inc("http_errors_total", api=self.API_NAME, reason=req.status_code)
+            if attempt == self.max_retries:
+                break
+            delay = max(retry_after or 0, backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            self._logger.debug(f"status {req.status_code} for {params}, retrying in {delay:.2f}s...")
+            METRICS.inc("http_retries_total", api=self.API_NAME)
+            time.sleep(delay)
+        req.raise_for_status()
+        return req
+
+    def get_app_prices(self, app_ids: list, country_code: str = "us") -> tuple:
+        """
+        Gets the price of several apps from API in a single request. Only the
+        price_overview section of each app is requested
+
+        :param app_ids: list of ints representing the app ids
+        :param country_code: string representing the country code (ALPHA-2) for app price info
+
+        :returns:
+            tuple: dict with app ids as keys and (price as string, currency name (ALPHA-3))
+                   as values, and dict with the app ids that failed as keys and the reason as values
+        """
+        params = {"cc": country_code,
+                  "appids": ",".join(str(app_id) for app_id in app_ids),
+                  "filters": "price_overview"}
+        self._logger.debug(f"Processing {self.endpoint} with params cc={params['cc']}&appids={params['appids']}")
+        req = self._get(params)
+        assert req.ok
+        json_data = json.loads(req.text) or {}
+        prices, failures = {}, {}
+        for app_id in app_ids:
+            app_data = json_data.get(f"{app_id}")
+            if not app_data or not app_data.get("success", False):
+                failures[app_id] = "app not found"
+                continue
+            # steam sends an empty list instead of a dict when the filtered data is missing (e.g. free apps)
+            data = app_data.get("data")
+            price_overview = data.get("price_overview", None) if isinstance(data, dict) else None
+            # check if there's price data
+            if price_overview is None:
+                failures[app_id] = "no price data"
+                continue
+            # check if there's price formatting data
+            if price_overview.get("final_formatted", None) is None:
+                failures[app_id] = "no price formatting data"
+                continue
+            prices[app_id] = (price_overview["final_formatted"], price_overview["currency"])
+        return prices, failures
 
     def get_app_price(self, app_id: int, country_code: str = "us") -> tuple:
         """
@@ -123,36 +988,38 @@ class SteamWebApi:
         :returns:
             tuple: price as string and currency name (ALPHA-3)
         """
-        params = {"cc": country_code, "appids": app_id}
-        self._logger.debug(f"Processing {self.endpoint} with params cc={params['cc']}&appids={params['appids']}")
-        req = requests.get(self.endpoint, params=params)
-        assert req.ok
-        json_data = json.loads(req.text)
-        # check if there's price data
-        assert json_data[f"{app_id}"]["data"].get("price_overview", None) is not None
-        # check if there's price formatting data
-        assert json_data[f"{app_id}"]["data"]["price_overview"].get("final_formatted", None) is not None
-        price_str = json_data[f"{app_id}"]["data"]["price_overview"]["final_formatted"]
-        currency_name = json_data[f"{app_id}"]["data"]["price_overview"]["currency"]
-        return price_str, currency_name
+        prices, failures = self.get_app_prices([app_id], country_code=country_code)
+        assert app_id in prices, failures.get(app_id)
+        return prices[app_id]
 
-class OpenExRatesApi:
+class OpenExRatesApi(HttpClient):
     """
     Represents a connection to OpenExchangeRates API
     """
 
+    API_NAME = "openexchangerates"
+
     def __init__(self,
                  endpoint: str,
-                 app_token: str):
+                 app_token: str,
+                 historical_endpoint: str = None,
+                 http_config: dict = None):
         """
         Constructor for OpenExRatesAPI
 
         :param endpoint: exchange rate endpoint
         :param app_token: api token for auth
+        :param historical_endpoint: historical exchange rate endpoint, with a {date} placeholder
+                                    for the date (YYYY-MM-DD)
+        :param http_config: args for the HttpClient connection pool. Its transport-level
+                            retries are always disabled, every retry goes through _get
         """
+        # retries inside urllib3 would skip the rate limiter and multiply _get's own retries
+        super().__init__(**dict(http_config or {}, retries=0))
         self._logger = logging.getLogger(__name__)
         self.endpoint = endpoint
         self.app_token = app_token
+        self.historical_endpoint = historical_endpoint
 
     def get_ex_rates(self,
                      base_currency: str,
@@ -170,6 +1037,30 @@ class OpenExRatesApi:
                   "app_id": self.app_token,
                   "symbols": ",".join(other_currencies)}
         self._logger.debug(f"Processing {self.endpoint} with params base={params['base']}&symbols={params['symbols']}")
-        req = requests.get(self.endpoint, params=params)
+        req = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+        assert req.ok
+        return json.loads(req.text).get("rates", None)
+
+    def get_historical_ex_rates(self,
+                                date: str,
+                                base_currency: str,
+                                other_currencies: list) -> dict:
+        """
+        Gets the exchange rates of a past day from API
+
+        :param date: day (YYYY-MM-DD) to get the exchange rates of
+        :param base_currency: currency (ALPHA-3) exchange rates will be relative to
+        :param other_currencies: currencies (ALPHA-3) to get the exchange rates of
+
+        :returns:
+            dict: currencies (ALPHA-3) as keys and exchange rates float as values
+        """
+        assert self.historical_endpoint is not None, "historical_endpoint is not configured"
+        endpoint = self.historical_endpoint.format(date=date)
+        params = {"base": base_currency,
+                  "app_id": self.app_token,
+                  "symbols": ",".join(other_currencies)}
+        self._logger.debug(f"Processing {endpoint} with params base={params['base']}&symbols={params['symbols']}")
+        req = self.session.get(endpoint, params=params, timeout=self.timeout)
         assert req.ok
         return json.loads(req.text).get("rates", None)
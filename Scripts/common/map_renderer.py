@@ -0,0 +1,187 @@
+import io
+import hashlib
+import logging
+import matplotlib
+import multiprocessing
+import numpy as np
+
+# headless backend, maps are only ever saved to files
+matplotlib.use("Agg")
+
+import matplotlib.colors as colors
+
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+from typing import NamedTuple
+
+MISSING_VALUE_COL = "steam_value"
+
+
+class MapStyle(NamedTuple):
+    """
+    Plot arguments shared by every map
+
+    :param value_col: col of the value the countries are colored by
+    :param plot_args: args to create the empty canvas (e.g. figsize)
+    :param color_bar_args: args of the color bar colormap
+    :param missing_countries_plot_args: args to plot the base layer, the countries with no information
+    :param world_map_prices_plot_args: args to plot the countries with price information
+    :param divider_plot_args: args to create the color bar axes
+    :param dpi: resolution of the base layer and the saved images
+    """
+    value_col: str
+    plot_args: dict
+    color_bar_args: dict
+    missing_countries_plot_args: dict
+    world_map_prices_plot_args: dict
+    divider_plot_args: dict
+    dpi: int = 100
+
+
+class MapJob(NamedTuple):
+    """
+    A map to render
+
+    :param name: map name, identifies the map between runs
+    :param title: plot title
+    :param values: value of each country, aligned with the rows of the renderer geometries.
+                   NaN for countries without data
+    """
+    name: str
+    title: str
+    values: np.ndarray
+
+    def data_hash(self) -> str:
+        """
+        Hash of everything the rendered image depends on, except the style
+        """
+        sha = hashlib.sha256(self.title.encode())
+        sha.update(np.ascontiguousarray(self.values, dtype="float64").tobytes())
+        return sha.hexdigest()
+
+
+class MapRenderer:
+
+    """
+    Renders world maps colored by a value per country. The base layer (every
+    country geometry and its borders) is rendered once and reused as an image
+    by every map, only the countries with data are drawn per map. Figures are
+    created without pyplot, so there's no global figure registry to leak from,
+    and are cleared as soon as they're saved
+    """
+
+    def __init__(self,
+                 geometries,
+                 style: MapStyle,
+                 base_layer: np.ndarray = None):
+        """
+        Constructor for MapRenderer
+
+        :param geometries: GeoDataFrame with the country geometries
+        :param style: plot arguments shared by every map
+        :param base_layer: base layer already rendered (e.g. by the parent process). None renders
+                           it on first use
+        """
+        self._logger = logging.getLogger(__name__)
+        self.geometries = geometries[["geometry"]].copy()
+        self.style = style
+        self.bounds = tuple(self.geometries.total_bounds)
+        self._base_layer = base_layer
+
+    @property
+    def base_layer(self) -> np.ndarray:
+        """
+        RGBA image of the base layer, covering the geometries bounds
+        """
+        if self._base_layer is None:
+            fig = Figure(figsize=self.style.plot_args.get("figsize"), dpi=self.style.dpi)
+            FigureCanvasAgg(fig)
+            try:
+                ax = fig.add_axes([0, 0, 1, 1])
+                self.geometries.assign(**{MISSING_VALUE_COL: 0}) \
+                               .plot(ax=ax, **self.style.missing_countries_plot_args)
+                self._set_bounds(ax)
+                ax.set_aspect("auto")
+                ax.set_axis_off()
+                fig.canvas.draw()
+                self._base_layer = np.asarray(fig.canvas.buffer_rgba()).copy()
+            finally:
+                fig.clear()
+            self._logger.debug(f"base layer rendered ({self._base_layer.shape[1]}x{self._base_layer.shape[0]})")
+        return self._base_layer
+
+    def _set_bounds(self, ax):
+        minx, miny, maxx, maxy = self.bounds
+        ax.set_xlim(minx, maxx)
+        ax.set_ylim(miny, maxy)
+
+    def render(self, job: MapJob) -> bytes:
+        """
+        Renders a map
+
+        :param job: map to render
+
+        :returns:
+            bytes: PNG image
+        """
+        value_col = self.style.value_col
+        data = self.geometries.assign(**{value_col: job.values})
+        data = data[data[value_col].notna()]
+        fig = Figure(dpi=self.style.dpi, **self.style.plot_args)
+        FigureCanvasAgg(fig)
+        try:
+            ax = fig.add_subplot()
+            minx, miny, maxx, maxy = self.bounds
+            ax.imshow(self.base_layer, extent=(minx, maxx, miny, maxy), zorder=0)
+            cax = make_axes_locatable(ax).append_axes(**self.style.divider_plot_args)
+            if not data.empty:
+                data.plot(ax=ax,
+                          cmap=colors.LinearSegmentedColormap.from_list(**self.style.color_bar_args),
+                          norm=colors.Normalize(vmin=data[value_col].min(), vmax=data[value_col].max()),
+                          cax=cax,
+                          zorder=1,
+                          **self.style.world_map_prices_plot_args)
+            self._set_bounds(ax)
+            ax.set_axis_off()
+            ax.set_title(job.title)
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format="png")
+            return buffer.getvalue()
+        finally:
+            fig.clear()
+
+    def render_many(self, jobs: list, max_workers: int = 1) -> dict:
+        """
+        Renders many maps. With more than one worker, they're rendered in a
+        process pool, each worker receives the geometries and base layer once.
+        Workers are spawned rather than forked, since the pipeline runs stages
+        in threads
+
+        :param jobs: list of MapJob
+        :param max_workers: number of processes rendering maps
+
+        :returns:
+            dict: map names as keys and PNG images as values
+        """
+        if max_workers <= 1 or len(jobs) <= 1:
+            return {job.name: self.render(job) for job in jobs}
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs)),
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(self.geometries, self.style, self.base_layer)) as executor:
+            return dict(zip((job.name for job in jobs), executor.map(_render_job, jobs)))
+
+
+# renderer of each worker process, built once by the pool initializer
+_WORKER_RENDERER = None
+
+
+def _init_worker(geometries, style: MapStyle, base_layer: np.ndarray):
+    global _WORKER_RENDERER
+    _WORKER_RENDERER = MapRenderer(geometries, style, base_layer=base_layer)
+
+
+def _render_job(job: MapJob) -> bytes:
+    return _WORKER_RENDERER.render(job)
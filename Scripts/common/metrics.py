@@ -0,0 +1,278 @@
+import json
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+
+# seconds, from a fast api response to a slow pipeline stage
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+class Histogram:
+
+    """
+    Cumulative histogram with fixed buckets, as Prometheus defines them
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Constructor for Histogram
+
+        :param buckets: upper bounds of the buckets, sorted
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in
+
+        :param q: quantile, between 0 and 1
+
+        :returns:
+            float: the estimate. None if nothing was observed, inf if it's over the last bucket
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return float("inf")
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _prometheus_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class MetricsRegistry:
+
+    """
+    Thread-safe store of the counters, gauges and histograms recorded during
+    a run. Metrics are identified by their name and labels
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Increases a counter
+
+        :param name: counter name
+        :param value: amount to add
+        :param labels: labels of the counter
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """
+        Sets a gauge
+
+        :param name: gauge name
+        :param value: current value
+        :param labels: labels of the gauge
+        """
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = DEFAULT_BUCKETS, **labels):
+        """
+        Records a value in a histogram
+
+        :param name: histogram name
+        :param value: observed value
+        :param buckets: buckets of the histogram, used when it's created
+        :param labels: labels of the histogram
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Records the seconds the block takes in a histogram, even if it raises
+
+        :param name: histogram name
+        :param labels: labels of the histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        """
+        Removes every metric
+        """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Returns every metric in a JSON serializable dict
+
+        :returns:
+            dict: lists of counters, gauges and histograms, each with its name, labels and values
+        """
+        with self._lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self._counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self._gauges.items())],
+                "histograms": [{"name": name,
+                                "labels": dict(labels),
+                                "count": histogram.count,
+                                "sum": histogram.sum,
+                                "p50": histogram.quantile(0.5),
+                                "p99": histogram.quantile(0.99),
+                                "buckets": dict(zip((str(bound) for bound in histogram.buckets), histogram.counts))}
+                               for (name, labels), histogram in sorted(self._histograms.items())]}
+
+    def to_prometheus(self, prefix: str = "") -> str:
+        """
+        Formats every metric in the Prometheus text exposition format
+
+        :param prefix: prepended to every metric name
+
+        :returns:
+            str: metrics text
+        """
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {prefix}{name} {kind}")
+                    for (metric_name, labels), value in sorted(metrics.items()):
+                        if metric_name == name:
+                            lines.append(f"{prefix}{name}{_prometheus_labels(labels)} {value:g}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for (metric_name, labels), histogram in sorted(self._histograms.items()):
+                    if metric_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{prefix}{name}_bucket{_prometheus_labels(labels, (('le', f'{bound:g}'),))} "
+                                     f"{count}")
+                    lines.append(f"{prefix}{name}_bucket{_prometheus_labels(labels, (('le', '+Inf'),))} "
+                                 f"{histogram.count}")
+                    lines.append(f"{prefix}{name}_sum{_prometheus_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{prefix}{name}_count{_prometheus_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+# registry every component of the pipeline records to
+METRICS = MetricsRegistry()
+
+
+class RunReport:
+
+    """
+    Machine-readable report of a run: when it ran, how it ended and every
+    metric recorded meanwhile
+    """
+
+    def __init__(self, metrics: MetricsRegistry = METRICS):
+        """
+        Constructor for RunReport. The run starts when the report is created
+
+        :param metrics: registry the run records to
+        """
+        self._logger = logging.getLogger(__name__)
+        self.metrics = metrics
+        self.started_at = time.time()
+        self.finished_at = None
+        self.status = "running"
+
+    def finish(self, status: str = "succeeded"):
+        """
+        Marks the run as finished
+
+        :param status: how the run ended
+        """
+        self.finished_at = time.time()
+        self.status = status
+
+    @contextmanager
+    def recording(self, save):
+        """
+        Runs the block as the run: the report finishes as succeeded when the block
+        ends, returns included, or as failed if it raises, and is saved either way.
+        A report that can't be saved (e.g. S3 is what failed) is only logged, so it
+        never hides the run's own error
+
+        :param save: function saving the report, called with it
+        """
+        try:
+            yield self
+        except BaseException:
+            self.finish(status="failed")
+            raise
+        else:
+            self.finish()
+        finally:
+            try:
+                save(self)
+                self._logger.info(f"run report saved, status {self.status}")
+            except Exception:
+                self._logger.exception(f"run report couldn't be saved, status {self.status}")
+
+    def to_dict(self) -> dict:
+        finished_at = self.finished_at or time.time()
+        return {"status": self.status,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "seconds": finished_at - self.started_at,
+                **self.metrics.snapshot()}
+
+    def save(self, storage, key: str, prometheus: bool = False, prometheus_prefix: str = "") -> list:
+        """
+        Saves the report as JSON and, optionally, in Prometheus text format next to it
+
+        :param storage: S3Bucket or LocalStorage the report is saved to
+        :param key: key of the JSON report, the Prometheus one replaces its .json suffix with .prom
+        :param prometheus: whether to save the Prometheus text format too
+        :param prometheus_prefix: prepended to every metric name in the Prometheus text format
+
+        :returns:
+            list: keys saved
+        """
+        # the report itself is saved after the snapshot, so its own upload isn't in it
+        keys = [key]
+        data = json.dumps(self.to_dict(), indent=2).encode()
+        text = self.metrics.to_prometheus(prefix=prometheus_prefix).encode() if prometheus else None
+        storage.save_bytes(data, key)
+        if prometheus:
+            keys.append(key.rsplit(".json", 1)[0] + ".prom")
+            storage.save_bytes(text, keys[-1])
+        return keys
@@ -0,0 +1,160 @@
+import io
+import tempfile
+
+from typing import TYPE_CHECKING
+
+# pyarrow is imported by the functions using it, so that jobs that don't write parquet don't load it
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+
+def partition_path(partition_cols: list, values: tuple) -> str:
+    """
+    Builds the Hive-style path of a partition
+
+    :param partition_cols: partition column names
+    :param values: partition values, in the same order
+
+    :returns:
+        str: path like "month=2024-01/country_iso=ar/"
+    """
+    return "".join(f"{col}={value}/" for col, value in zip(partition_cols, values))
+
+
+class PartitionedParquetWriter:
+
+    """
+    Writes dataframes that are built in chunks to a Hive-style partitioned
+    parquet dataset. Every partition gets its own local temporary file and
+    each chunk is written to them as row groups as soon as it arrives.
+    Partition columns are left out of the files, their values live in the path
+    """
+
+    def __init__(self,
+                 partition_cols: list,
+                 dictionary_cols: list = None):
+        """
+        Constructor for PartitionedParquetWriter
+
+        :param partition_cols: columns the dataset is partitioned by
+        :param dictionary_cols: columns stored dictionary encoded (low cardinality strings)
+        """
+        self.partition_cols = partition_cols
+        self.dictionary_cols = dictionary_cols or []
+        self._writers = {}
+        self._files = {}
+
+    def write(self, df: "DataFrame"):
+        """
+        Writes a chunk, split by partition
+
+        :param df: DataFrame containing the partition columns
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if df.empty:
+            return
+        for values, partition_df in df.groupby(self.partition_cols, sort=False, observed=True):
+            values = values if isinstance(values, tuple) else (values,)
+            path = partition_path(self.partition_cols, values)
+            table = pa.Table.from_pandas(partition_df.drop(columns=self.partition_cols), preserve_index=False)
+            if path not in self._writers:
+                self._files[path] = tempfile.TemporaryFile()
+                self._writers[path] = pq.ParquetWriter(self._files[path],
+                                                       table.schema,
+                                                       compression='snappy',
+                                                       use_dictionary=[col for col in self.dictionary_cols
+                                                                       if col in table.column_names])
+            writer = self._writers[path]
+            writer.write_table(table.cast(writer.schema), row_group_size=len(partition_df))
+
+    def close(self) -> dict:
+        """
+        Finishes every partition file
+
+        :returns:
+            dict: partition paths as keys and temporary files, positioned at the start, as values
+        """
+        for path, writer in self._writers.items():
+            writer.close()
+            self._files[path].seek(0)
+        self._writers = {}
+        return self._files
+
+
+def compact_parquet_files(files: list,
+                          sort_cols: list,
+                          row_group_size: int,
+                          dictionary_cols: list = None) -> bytes:
+    """
+    Merges small parquet files into one, sorted so that row group statistics
+    let readers skip row groups when filtering by the sort columns
+
+    :param files: contents of the parquet files to merge
+    :param sort_cols: columns the merged rows are sorted by
+    :param row_group_size: rows per row group in the merged file
+    :param dictionary_cols: columns stored dictionary encoded
+
+    :returns:
+        bytes: content of the merged parquet file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.concat_tables([pq.read_table(io.BytesIO(data)) for data in files])
+    table = table.sort_by([(col, "ascending") for col in sort_cols if col in table.column_names])
+    buffer = io.BytesIO()
+    pq.write_table(table,
+                   buffer,
+                   compression='snappy',
+                   row_group_size=row_group_size,
+                   use_dictionary=[col for col in (dictionary_cols or []) if col in table.column_names])
+    return buffer.getvalue()
+
+
+def iter_row_groups(source,
+                    columns: list = None,
+                    ranges: dict = None):
+    """
+    Reads a parquet file one row group at a time. Row groups whose min/max
+    statistics fall outside ranges are skipped without being read
+
+    :param source: file-like object or path of the parquet file
+    :param columns: columns to read. None reads every column
+    :param ranges: dict with column names as keys and (min, max) tuples as values, both
+                   inclusive. None bounds are open
+
+    :returns:
+        Iterator: pyarrow Tables, one per row group read
+    """
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(source)
+    for row_group in row_groups_in_ranges(parquet_file.metadata, ranges):
+        yield parquet_file.read_row_group(row_group, columns=columns)
+
+
+def row_groups_in_ranges(metadata, ranges: dict = None) -> list:
+    """
+    Returns the row groups of a parquet file whose min/max statistics aren't outside ranges
+
+    :param metadata: pyarrow FileMetaData of the file
+    :param ranges: dict with column names as keys and (min, max) tuples as values, both
+                   inclusive. None bounds are open
+
+    :returns:
+        list: indices of the row groups
+    """
+    column_positions = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+    return [row_group for row_group in range(metadata.num_row_groups)
+            if _row_group_in_ranges(metadata.row_group(row_group), column_positions, ranges or {})]
+
+
+def _row_group_in_ranges(row_group, column_positions: dict, ranges: dict) -> bool:
+    for col, (low, high) in ranges.items():
+        if col not in column_positions:
+            continue
+        statistics = row_group.column(column_positions[col]).statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+        if (low is not None and statistics.max < low) or (high is not None and statistics.min > high):
+            return False
+    return True
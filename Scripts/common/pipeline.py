@@ -0,0 +1,133 @@
+import time
+import logging
+
+from Scripts.common.metrics import METRICS
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, NamedTuple
+
+
+class PipelineStage(NamedTuple):
+    """
+    Represents a stage of the pipeline
+
+    :param name: stage name, the results of the stage are passed to the stages
+                 depending on it as a keyword argument with this name
+    :param func: function running the stage. It receives the results of its
+                 dependencies as keyword arguments
+    :param depends_on: names of the stages that must finish before this one starts
+    """
+    name: str
+    func: Callable
+    depends_on: tuple = ()
+
+
+class Pipeline:
+
+    """
+    Runs a graph of stages, starting every stage as soon as its dependencies
+    finish, so that independent stages run concurrently
+    """
+
+    def __init__(self,
+                 stages: list,
+                 max_workers: int = 4):
+        """
+        Constructor for Pipeline
+
+        :param stages: list of PipelineStage
+        :param max_workers: max amount of stages running at the same time
+        """
+        self._logger = logging.getLogger(__name__)
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max_workers
+        self.timings = {}
+        self._validate()
+
+    @classmethod
+    def from_config(cls,
+                    config: dict,
+                    stage_funcs: dict,
+                    selected_stages: list = None) -> "Pipeline":
+        """
+        Builds the pipeline from its YAML configuration
+
+        :param config: dict with max_workers and stages, stage names as keys
+                       and a dict with their depends_on list as values. The lists become tuples
+        :param stage_funcs: dict with stage names as keys and the functions running them as values
+        :param selected_stages: names of the stages to run. Dependencies on stages that aren't
+                                selected are dropped, so their functions must work without
+                                those results. None runs every configured stage
+
+        :returns:
+            Pipeline: pipeline with the configured stages
+        """
+        stages = []
+        for name, stage_config in config["stages"].items():
+            if selected_stages is not None and name not in selected_stages:
+                continue
+            if name not in stage_funcs:
+                raise ValueError(f"pipeline stage {name} doesn't exist")
+            depends_on = tuple((stage_config or {}).get("depends_on", ()))
+            if selected_stages is not None:
+                depends_on = tuple(dependency for dependency in depends_on if dependency in selected_stages)
+            stages.append(PipelineStage(name=name,
+                                        func=stage_funcs[name],
+                                        depends_on=depends_on))
+        return cls(stages, max_workers=config.get("max_workers", 4))
+
+    def _validate(self):
+        """
+        Checks that every dependency exists and that the graph has no cycles
+        """
+        for stage in self.stages.values():
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(f"stage {stage.name} depends on {dependency}, which doesn't exist")
+        done = set()
+        remaining = dict(self.stages)
+        while remaining:
+            ready = [name for name, stage in remaining.items() if set(stage.depends_on) <= done]
+            if not ready:
+                raise ValueError(f"pipeline stages {sorted(remaining)} have circular dependencies")
+            for name in ready:
+                done.add(name)
+                del remaining[name]
+
+    def _run_stage(self, stage: PipelineStage, inputs: dict):
+        self._logger.info(f"{stage.name} has started...")
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            result = stage.func(**inputs)
+            status = "succeeded"
+            return result
+        finally:
+            self.timings[stage.name] = time.perf_counter() - start
+            METRICS.observe("pipeline_stage_seconds", self.timings[stage.name], stage=stage.name)
+            METRICS.inc("pipeline_stages_total", stage=stage.name, status=status)
+            self._logger.info(f"{stage.name} has finished in {self.timings[stage.name]:.2f}s")
+
+    def run(self) -> dict:
+        """
+        Runs every stage. If a stage fails, no new stages are started and
+        the error is raised once the running ones finish
+
+        :returns:
+            dict: stage names as keys and their results as values
+        """
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [stage for stage in pending.values() if all(dep in results for dep in stage.depends_on)]
+                for stage in ready:
+                    inputs = {dependency: results[dependency] for dependency in stage.depends_on}
+                    running[executor.submit(self._run_stage, stage, inputs)] = stage.name
+                    del pending[stage.name]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        timings = ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.timings.items())
+        self._logger.info(f"pipeline stage timings: {timings}")
+        return results
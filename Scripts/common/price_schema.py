@@ -0,0 +1,93 @@
+import numpy as np
+
+from typing import TYPE_CHECKING
+
+# pandas and pyarrow are imported by the functions using them, so that importing the schema loads neither
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from pandas import DataFrame
+
+# price rows are (app, country code, steam currency, price). Apps fit in int32 and
+# countries and currencies are a few dozen codes, so they're stored as categories
+APP_DTYPE = "int32"
+CODE_DTYPE = "category"
+PRICE_DTYPES = ("float32", "float64")
+
+
+def _check_price_dtype(price_dtype: str):
+    if price_dtype not in PRICE_DTYPES:
+        raise ValueError(f"price dtype must be one of {PRICE_DTYPES}, not {price_dtype}")
+
+
+def price_dtypes(cols: list, price_dtype: str = "float64") -> dict:
+    """
+    Returns the dtypes of the price columns
+
+    :param cols: app, country code, currency and price col names, in that order
+    :param price_dtype: float32 or float64
+
+    :returns:
+        dict: col names as keys and dtypes as values
+    """
+    _check_price_dtype(price_dtype)
+    app_col, cc_col, currency_col, price_col = cols
+    return {app_col: APP_DTYPE, cc_col: CODE_DTYPE, currency_col: CODE_DTYPE, price_col: price_dtype}
+
+
+def apply_price_schema(df: "DataFrame", cols: list, price_dtype: str = "float64") -> "DataFrame":
+    """
+    Casts the price columns in df to their dtypes. Columns that are missing or
+    already have the right dtype are left as they are, so nothing is copied
+    when df already follows the schema
+
+    :param df: df with some or all of the price columns
+    :param cols: app, country code, currency and price col names, in that order
+    :param price_dtype: float32 or float64
+
+    :returns:
+        DataFrame: df with the price columns cast
+    """
+    dtypes = {col: dtype for col, dtype in price_dtypes(cols, price_dtype).items()
+              if col in df.columns and str(df[col].dtype) != dtype}
+    return df.astype(dtypes) if dtypes else df
+
+
+def raw_price_frame(rows: list, cols: list) -> "DataFrame":
+    """
+    Builds a df from raw price rows column by column, with the compact dtypes.
+    The price column keeps the raw price strings until they're parsed
+
+    :param rows: tuples with the app id, country code, currency and raw price string
+    :param cols: app, country code, currency and price col names, in that order
+
+    :returns:
+        DataFrame: df with cols
+    """
+    import pandas as pd
+    app_col, cc_col, currency_col, price_col = cols
+    apps, countries, currencies, prices = zip(*rows) if rows else ((), (), (), ())
+    return pd.DataFrame({app_col: np.array(apps, dtype=APP_DTYPE),
+                         cc_col: pd.Categorical(countries),
+                         currency_col: pd.Categorical(currencies),
+                         price_col: np.array(prices, dtype=object)})
+
+
+def price_arrow_schema(cols: list, price_dtype: str = "float64") -> "pa.Schema":
+    """
+    Returns the parquet schema of the price columns. Codes are dictionary
+    encoded with a fixed index type, so that chunks with different categories
+    can be written to the same file
+
+    :param cols: app, country code, currency and price col names, in that order
+    :param price_dtype: float32 or float64
+
+    :returns:
+        pa.Schema: schema with cols
+    """
+    import pyarrow as pa
+    _check_price_dtype(price_dtype)
+    app_col, cc_col, currency_col, price_col = cols
+    return pa.schema([(app_col, pa.int32()),
+                      (cc_col, pa.dictionary(pa.int32(), pa.string())),
+                      (currency_col, pa.dictionary(pa.int32(), pa.string())),
+                      (price_col, pa.from_numpy_dtype(np.dtype(price_dtype)))])
@@ -0,0 +1,115 @@
+import io
+import os
+import pstats
+import logging
+import cProfile
+import tempfile
+import tracemalloc
+
+from functools import wraps
+
+PROFILE_MODES = ("cpu", "mem")
+
+
+class StageProfiler:
+
+    """
+    Profiles a function with cProfile (cpu) or tracemalloc (mem) and saves
+    the raw profile plus a top-N summary to a storage (S3Bucket or LocalStorage).
+
+    cProfile only sees the thread the function runs in, so work the stage hands
+    to thread or process pools shows up as time waiting on them. tracemalloc
+    traces the whole process, so stages running at the same time are included
+    """
+
+    def __init__(self,
+                 mode: str,
+                 storage,
+                 key_prefix: str,
+                 top_n: int = 30,
+                 tracemalloc_frames: int = 10):
+        """
+        Constructor for StageProfiler
+
+        :param mode: "cpu" or "mem"
+        :param storage: S3Bucket or LocalStorage the profiles are saved to
+        :param key_prefix: prefix of the keys of the saved profiles
+        :param top_n: amount of functions (cpu) or lines (mem) in the summary
+        :param tracemalloc_frames: frames stored per allocation traceback
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"profile mode must be one of {PROFILE_MODES}, not {mode}")
+        self._logger = logging.getLogger(__name__)
+        self.mode = mode
+        self.storage = storage
+        self.key_prefix = key_prefix
+        self.top_n = top_n
+        self.tracemalloc_frames = tracemalloc_frames
+
+    def wrap(self, name: str, func):
+        """
+        Returns func profiled every time it's called
+
+        :param name: stage name, used in the keys of the saved profiles
+        :param func: function running the stage
+        """
+        @wraps(func)
+        def profiled(*args, **kwargs):
+            run = self._profile_cpu if self.mode == "cpu" else self._profile_mem
+            return run(name, func, *args, **kwargs)
+        return profiled
+
+    def _profile_cpu(self, name: str, func, *args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            stats = pstats.Stats(profiler)
+            # pstats only dumps to a path, the file is read back to save it to the storage
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "stage.prof")
+                stats.dump_stats(path)
+                with open(path, "rb") as f:
+                    data = f.read()
+            summary = io.StringIO()
+            stats.stream = summary
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_n)
+            self._save(name, data, "prof", summary.getvalue())
+
+    def _profile_mem(self, name: str, func, *args, **kwargs):
+        was_tracing = tracemalloc.is_tracing()
+        if was_tracing and not hasattr(tracemalloc, "reset_peak"):
+            # reset_peak is Python 3.9+, before it the peak is only reset by restarting the tracing
+            tracemalloc.stop()
+            tracemalloc.start(self.tracemalloc_frames)
+        elif not was_tracing:
+            tracemalloc.start(self.tracemalloc_frames)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if not was_tracing:
+                tracemalloc.stop()
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "stage.tracemalloc")
+                snapshot.dump(path)
+                with open(path, "rb") as f:
+                    data = f.read()
+            lines = [f"current {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB",
+                     f"top {self.top_n} allocation sites:"]
+            lines += [str(stat) for stat in snapshot.statistics("lineno")[:self.top_n]]
+            self._save(name, data, "tracemalloc", "\n".join(lines) + "\n")
+
+    def _save(self, name: str, data: bytes, extension: str, summary: str):
+        key = f"{self.key_prefix}{name}_{self.mode}"
+        # profiles are saved while the stage's own error is raised, a failed save mustn't replace it
+        try:
+            self.storage.save_bytes(data, f"{key}.{extension}")
+            self.storage.save_bytes(summary.encode(), f"{key}_summary.txt")
+        except Exception:
+            self._logger.exception(f"{self.mode} profile of {name} couldn't be saved to {key}.{extension}")
+            return
+        self._logger.info(f"{self.mode} profile of {name} saved to {key}.{extension}")
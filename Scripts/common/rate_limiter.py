@@ -0,0 +1,153 @@
+import time
+import random
+import logging
+import threading
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class AdaptiveRateLimiter:
+
+    """
+    Thread-safe token bucket whose refill rate adapts to the API's
+    responses (AIMD). The rate grows additively after every successful
+    request and is cut multiplicatively every time the API throttles
+    """
+
+    def __init__(self,
+                 rate: float = 1.0,
+                 min_rate: float = 0.1,
+                 max_rate: float = 10.0,
+                 capacity: float = 1.0,
+                 increase_step: float = 0.05,
+                 decrease_factor: float = 0.5):
+        """
+        Constructor for AdaptiveRateLimiter
+
+        :param rate: initial amount of requests per second
+        :param min_rate: the rate is never decreased below this value
+        :param max_rate: the rate is never increased above this value
+        :param capacity: max amount of tokens the bucket can hold (burst size)
+        :param increase_step: requests per second added to the rate after a successful request
+        :param decrease_factor: factor the rate is multiplied by when the API throttles
+        """
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.capacity = capacity
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._throttle_count = 0
+        self._success_count = 0
+
+    @property
+    def rate(self) -> float:
+        """
+        Current amount of requests per second
+        """
+        return self._rate
+
+    @property
+    def throttle_count(self) -> int:
+        """
+        Amount of times the API has throttled the requests
+        """
+        return self._throttle_count
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of the limiter state
+
+        :returns:
+            dict: current rate, throttle count and successful requests count
+        """
+        with self._lock:
+            return {"rate": self._rate,
+                    "throttle_count": self._throttle_count,
+                    "success_count": self._success_count}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """
+        Blocks the calling thread until a token is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self._rate)
+            time.sleep(wait)
+
+    def on_success(self):
+        """
+        Additive increase of the rate after a successful request
+        """
+        with self._lock:
+            self._success_count += 1
+            self._rate = min(self.max_rate, self._rate + self.increase_step)
+
+    def on_throttle(self, retry_after: float = None):
+        """
+        Multiplicative decrease of the rate after the API throttled a request
+
+        :param retry_after: seconds the API asked to wait before the next request (if any)
+        """
+        with self._lock:
+            self._throttle_count += 1
+            self._rate = max(self.min_rate, self._rate * self.decrease_factor)
+            # empty the bucket so that the lowered rate applies right away
+            self._tokens = min(self._tokens, 0)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self._logger.debug(f"throttled ({self._throttle_count} times), rate lowered to {self._rate:.3f} req/s")
+
+
+def parse_retry_after(value: str) -> float:
+    """
+    Parses a Retry-After header
+
+    :param value: header value, either delay seconds or an HTTP date
+
+    :returns:
+        float: seconds to wait. None if the header is missing or can't be parsed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        # dates with a -0000 zone, or none, are parsed as naive but are in UTC
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Exponential backoff with full jitter
+
+    :param attempt: retry number (starting at 0)
+    :param base: delay for the first retry
+    :param cap: maximum delay
+
+    :returns:
+        float: seconds to wait before the next retry
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
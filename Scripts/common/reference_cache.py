@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import pandas as pd
+
+from Scripts.common.country_index import CountryIndex, COUNTRY_INDEX_VERSION
+from pandas import DataFrame
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+# reference data is loaded once per process and shared by every cache instance. Each
+# entry has its own lock, so independent entries (e.g. the country index and the world
+# geometries) load at the same time and only loads of the same entry wait for each other
+_MEMORY_CACHE = {}
+_MEMORY_CACHE_LOCKS = {}
+_MEMORY_CACHE_LOCK = threading.Lock()
+
+
+def _file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ReferenceDataCache:
+
+    """
+    Cache for the reference data the ETLs need on every run (ISO-3166 code
+    lookups, the country index and Natural Earth geometries). Entries are
+    kept in memory for the whole process and persisted locally in columnar
+    format (Feather and GeoParquet), so that they aren't downloaded or
+    parsed on every run. Every caller gets the cached object itself, so the
+    entries are read-only: callers that modify one must copy it first
+    """
+
+    def __init__(self,
+                 cache_dir: str = None,
+                 ttl_hours: float = 168):
+        """
+        Constructor for ReferenceDataCache
+
+        :param cache_dir: local directory where entries are persisted. None keeps them in memory only
+        :param ttl_hours: hours a persisted entry downloaded from the web is valid for
+        """
+        self._logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.ttl_hours = ttl_hours
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, name: str, extension: str) -> tuple:
+        return (os.path.join(self.cache_dir, f"{name}.{extension}"),
+                os.path.join(self.cache_dir, f"{name}.meta.json"))
+
+    def _is_valid(self, data_path: str, meta_path: str, source_signature: str) -> bool:
+        """
+        Checks a persisted entry: the file must match the hash it was saved with, come
+        from the same source and be younger than the ttl
+        """
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("source") != source_signature:
+            return False
+        if (time.time() - meta.get("created_at", 0)) > self.ttl_hours * 3600:
+            return False
+        return meta.get("sha256") == _file_sha256(data_path)
+
+    def _write_meta(self, data_path: str, meta_path: str, source_signature: str):
+        with open(meta_path, "w") as f:
+            json.dump({"source": source_signature,
+                       "created_at": time.time(),
+                       "sha256": _file_sha256(data_path)}, f)
+
+    def _get(self, key: tuple, load, read, write, extension: str, source_signature: str):
+        """
+        Returns an entry from memory, disk or its source, in that order. The entry is
+        shared, not copied
+        """
+        with _MEMORY_CACHE_LOCK:
+            key_lock = _MEMORY_CACHE_LOCKS.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in _MEMORY_CACHE:
+                return _MEMORY_CACHE[key]
+            data = None
+            if self.cache_dir:
+                name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+                data_path, meta_path = self._paths(f"{key[0]}_{name}", extension)
+                if self._is_valid(data_path, meta_path, source_signature):
+                    self._logger.debug(f"reading {key[0]} from {data_path}")
+                    data = read(data_path)
+            if data is None:
+                self._logger.info(f"loading {key[0]} from {key[1]}")
+                data = load()
+                if self.cache_dir:
+                    write(data, data_path)
+                    self._write_meta(data_path, meta_path, source_signature)
+            _MEMORY_CACHE[key] = data
+            return data
+
+    def get_iso_codes(self, url: str, usecols: list) -> DataFrame:
+        """
+        Returns the ISO-3166 lookup table
+
+        :param url: url of the csv with the ISO-3166 codes
+        :param usecols: columns to load
+
+        :returns:
+            DataFrame: df with usecols, shared with other callers, read-only
+        """
+        return self._get(key=("iso_codes", url, tuple(usecols)),
+                         load=lambda: pd.read_csv(url, usecols=usecols),
+                         read=pd.read_feather,
+                         write=lambda df, path: df.reset_index(drop=True).to_feather(path),
+                         extension="feather",
+                         source_signature=url)
+
+    def get_world_geometries(self, name: str) -> "gpd.GeoDataFrame":
+        """
+        Returns a geopandas built-in map
+
+        :param name: geopandas built-in map name
+
+        :returns:
+            GeoDataFrame: df with the countries geometries, shared with other callers, read-only
+        """
+        # geopandas is only imported by the jobs that draw maps
+        import geopandas as gpd
+        path = gpd.datasets.get_path(name)
+        # the shapefile is local, so the entry is valid for as long as the file doesn't change
+        stat = os.stat(path)
+        return self._get(key=("world_geometries", path),
+                         load=lambda: gpd.read_file(path),
+                         read=gpd.read_parquet,
+                         write=lambda gdf, parquet_path: gdf.to_parquet(parquet_path),
+                         extension="parquet",
+                         source_signature=f"{path}:{stat.st_size}:{stat.st_mtime}")
+
+    def get_country_index(self,
+                          url: str,
+                          alpha_2_col: str,
+                          alpha_3_col: str) -> CountryIndex:
+        """
+        Returns the country index built from the ISO-3166 lookup table
+
+        :param url: url of the csv with the ISO-3166 codes
+        :param alpha_2_col: col with ALPHA-2 country codes
+        :param alpha_3_col: col with ALPHA-3 country codes
+
+        :returns:
+            CountryIndex: index shared by both ETLs
+        """
+        table = self._get(key=("country_index", url, alpha_2_col, alpha_3_col, COUNTRY_INDEX_VERSION),
+                          load=lambda: CountryIndex.build(self.get_iso_codes(url, usecols=[alpha_2_col, alpha_3_col]),
+                                                          alpha_2_col=alpha_2_col,
+                                                          alpha_3_col=alpha_3_col).table,
+                          read=pd.read_feather,
+                          write=lambda df, path: df.to_feather(path),
+                          extension="feather",
+                          source_signature=f"{url}:{COUNTRY_INDEX_VERSION}")
+        return CountryIndex(table)
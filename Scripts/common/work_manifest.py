@@ -0,0 +1,212 @@
+import json
+import time
+import zlib
+import logging
+
+from Scripts.common.external_resources import ConditionalWriteUnsupported
+from typing import NamedTuple
+
+
+class ShardClaim(NamedTuple):
+    """
+    Lease on a shard of a distributed run
+
+    :param shard_id: shard identifier
+    :param generation: lease generation, it increases every time an expired lease is taken over
+    :param app_ids: apps of the shard
+    :param expires_at: unix time the lease expires at
+    """
+    shard_id: str
+    generation: int
+    app_ids: list
+    expires_at: float
+
+
+class WorkManifest:
+
+    """
+    Work of a distributed run, shared by its coordinator and workers through a
+    storage (S3Bucket or LocalStorage). Everything lives under <prefix><run_id>/:
+
+    - manifest.json: the shards (app ids) plus whatever the coordinator resolved for the
+      workers (e.g. exchange rates), written once by the coordinator
+    - leases/<shard_id>/<generation>.json: a worker's claim on a shard, created with a
+      conditional write, so only one worker gets each generation. A lease that expired
+      (its worker died or hung) is taken over by creating the next generation
+    - done/<shard_id>.json: written once the shard's part is saved
+
+    Lease expiry compares clocks of different machines, so lease_seconds must be well
+    over both the time a shard takes and the clock skew between workers
+    """
+
+    def __init__(self,
+                 storage,
+                 prefix: str,
+                 run_id: str,
+                 lease_seconds: float = 900):
+        """
+        Constructor for WorkManifest
+
+        :param storage: S3Bucket or LocalStorage shared by the coordinator and the workers
+        :param prefix: the folder inside the storage for every distributed run
+        :param run_id: identifier of the run
+        :param lease_seconds: seconds a claimed shard is reserved for its worker
+        """
+        self._logger = logging.getLogger(__name__)
+        self.storage = storage
+        self.run_id = run_id
+        self.lease_seconds = lease_seconds
+        self.run_prefix = f"{prefix}{run_id}/"
+        self._manifest = None
+
+    @property
+    def manifest_key(self) -> str:
+        return f"{self.run_prefix}manifest.json"
+
+    def part_key(self, shard_id: str, name: str = "part") -> str:
+        """
+        Key of a file a worker saves for a shard
+
+        :param shard_id: shard identifier
+        :param name: file name, without the .parquet suffix
+        """
+        return f"{self.run_prefix}parts/{shard_id}/{name}.parquet"
+
+    def _save_if_absent(self, data: bytes, key: str) -> bool:
+        """
+        Creates an object only if it doesn't exist yet. Every claim and marker of the
+        run depends on it, so a storage without conditional writes stops the run
+
+        :raises ConditionalWriteUnsupported: if the storage can't write only if absent
+        """
+        try:
+            return self.storage.save_bytes_if_absent(data, key)
+        except ConditionalWriteUnsupported as e:
+            self._logger.error(f"run {self.run_id}: distributed runs need a storage with conditional "
+                               f"writes, shards can't be claimed safely ({e})")
+            raise
+
+    def create(self, app_ids: list, shard_size: int, **extra) -> bool:
+        """
+        Splits the apps into shards and writes the manifest. If the run already has a
+        manifest (e.g. the coordinator was restarted) it's kept as it is
+
+        :param app_ids: every app of the run
+        :param shard_size: apps per shard
+        :param extra: JSON serializable values shared with every worker
+
+        :returns:
+            bool: True if the manifest was written, False if it already existed
+        """
+        shards = {f"{i // shard_size:05d}": list(app_ids[i:i + shard_size])
+                  for i in range(0, len(app_ids), shard_size)}
+        manifest = {"run_id": self.run_id, "shards": shards, **extra}
+        created = self._save_if_absent(json.dumps(manifest, indent=2).encode(), self.manifest_key)
+        if created:
+            self._logger.info(f"run {self.run_id}: {len(app_ids)} apps split into {len(shards)} shards")
+        return created
+
+    def load(self) -> dict:
+        """
+        Reads the manifest, once
+
+        :returns:
+            dict: manifest with the shards and the coordinator values
+
+        :raises ValueError: if the run has no manifest
+        """
+        if self._manifest is None:
+            data = self.storage.get_bytes(self.manifest_key)
+            if data is None:
+                raise ValueError(f"run {self.run_id} has no work manifest in {self.manifest_key}")
+            self._manifest = json.loads(data)
+        return self._manifest
+
+    def completed_shards(self) -> dict:
+        """
+        Returns the shards whose part is saved
+
+        :returns:
+            dict: shard ids as keys and their done marker as values
+        """
+        return {key.rsplit("/", 1)[1][:-len(".json")]: json.loads(self.storage.get_bytes(key))
+                for key in self.storage.list_keys(f"{self.run_prefix}done/")}
+
+    def _done_shard_ids(self) -> set:
+        return {key.rsplit("/", 1)[1][:-len(".json")] for key in self.storage.list_keys(f"{self.run_prefix}done/")}
+
+    def _latest_leases(self) -> dict:
+        latest = {}
+        for key in self.storage.list_keys(f"{self.run_prefix}leases/"):
+            shard_id, generation = key[len(f"{self.run_prefix}leases/"):-len(".json")].split("/")
+            latest[shard_id] = max(latest.get(shard_id, -1), int(generation))
+        return latest
+
+    def claim(self, worker_id: str) -> ShardClaim:
+        """
+        Claims the next shard that isn't done nor leased to another worker. Workers
+        start looking at different shards, so they rarely compete for the same one
+
+        :param worker_id: identifier of the worker, recorded in the lease
+
+        :returns:
+            ShardClaim: the claimed shard. None if there's nothing to claim right now
+        """
+        shards = self.load()["shards"]
+        done = self._done_shard_ids()
+        latest = self._latest_leases()
+        shard_ids = sorted(shards)
+        start = zlib.crc32(worker_id.encode()) % len(shard_ids) if shard_ids else 0
+        for shard_id in shard_ids[start:] + shard_ids[:start]:
+            if shard_id in done:
+                continue
+            generation = latest.get(shard_id, -1) + 1
+            if generation > 0:
+                lease = json.loads(self.storage.get_bytes(f"{self.run_prefix}leases/{shard_id}/"
+                                                          f"{generation - 1:05d}.json"))
+                if lease["expires_at"] > time.time():
+                    continue
+                self._logger.warning(f"lease of shard {shard_id} held by {lease['worker_id']} expired, taking it over")
+            expires_at = time.time() + self.lease_seconds
+            lease = {"worker_id": worker_id, "expires_at": expires_at}
+            # only one worker can create each generation of the lease
+            if self._save_if_absent(json.dumps(lease).encode(),
+                                    f"{self.run_prefix}leases/{shard_id}/{generation:05d}.json"):
+                return ShardClaim(shard_id=shard_id,
+                                  generation=generation,
+                                  app_ids=shards[shard_id],
+                                  expires_at=expires_at)
+        return None
+
+    def complete(self, claim: ShardClaim, worker_id: str, files: dict) -> bool:
+        """
+        Marks a shard as done. A worker whose lease expired may still complete its
+        shard, but only the first worker to finish a shard marks it, so the run
+        uses the files of exactly one of them
+
+        :param claim: claim of the shard
+        :param worker_id: identifier of the worker
+        :param files: keys of the files saved for the shard, by kind (e.g. part and rejects)
+
+        :returns:
+            bool: True if the shard was marked as done, False if another worker did it first
+        """
+        if time.time() > claim.expires_at:
+            self._logger.warning(f"shard {claim.shard_id} finished after its lease expired")
+        marker = {"worker_id": worker_id, "generation": claim.generation, "files": files}
+        return self._save_if_absent(json.dumps(marker).encode(), f"{self.run_prefix}done/{claim.shard_id}.json")
+
+    def pending_shards(self) -> list:
+        """
+        Returns the ids of the shards that aren't done yet
+        """
+        return sorted(set(self.load()["shards"]) - self._done_shard_ids())
+
+    def clear(self) -> bool:
+        """
+        Deletes the manifest, leases, markers and parts of the run
+
+        :returns:
+            bool: True if the files were deleted
+        """
+        return self.storage.delete_keys(self.storage.list_keys(self.run_prefix))
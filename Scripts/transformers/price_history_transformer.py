@@ -0,0 +1,280 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from Scripts.common.external_resources import S3Bucket
+from datetime import datetime, timedelta
+from typing import NamedTuple
+from pandas import DataFrame
+
+
+class PriceHistoryETLSourceConfig(NamedTuple):
+    """
+    Object that represents the source configuration for
+    PriceHistoryETL
+
+    :param dataset_key: the folder of the partitioned dataset written by SteamPricesETL
+    :param history_days: days of history read, counting back from the run date
+    :param app_ids: apps to analyse. None analyses every app in the dataset
+    :param country_codes: countries (ALPHA-2, lowercase) to analyse. None analyses every country
+    :param app_col: col name for the app ids
+    :param country_col: col name (and partition name) for the country codes
+    :param price_col: col name for the prices in usd
+    :param date_col: col name for the snapshot dates
+    :param month_col: partition name for the snapshot months
+    :param rolling_days: days of the rolling window of the per-country deviations
+    :param sale_lookback_days: days the regular price of an app is looked for in
+    :param sale_threshold: relative drop from the regular price that marks an app as on sale
+    :param reduce_every: row groups aggregated before the partial aggregates are merged,
+                         which bounds memory
+    """
+    dataset_key: str
+    history_days: int = 365
+    app_ids: list = None
+    country_codes: list = None
+    app_col: str = 'app'
+    country_col: str = 'country_iso'
+    price_col: str = 'usd_price'
+    date_col: str = 'snapshot_date'
+    month_col: str = 'month'
+    rolling_days: int = 7
+    sale_lookback_days: int = 30
+    sale_threshold: float = 0.1
+    reduce_every: int = 50
+
+
+class PriceHistoryETLTargetConfig(NamedTuple):
+    """
+    Represents the target configuration for
+    PriceHistoryETL
+
+    :param trg_key: the folder inside the target storage service
+    :param trg_key_date_format: the filename date format in target storage service
+                            this one is appended to the filename at the end
+    :param trg_key_filename: the filename for the data to be stored
+    """
+    trg_key: str
+    trg_key_date_format: str
+    trg_key_filename: str
+
+
+class PriceHistoryETL:
+
+    """
+    Analyses the price history saved by SteamPricesETL: rolling per-country
+    deviations from the world average, per-app regional price indices and
+    sales. The dataset is streamed one row group at a time and only partial
+    aggregates (sums of log prices and counts) are kept in memory
+    """
+
+    def __init__(self,
+                 s3_bucket: S3Bucket,
+                 src_conf: PriceHistoryETLSourceConfig,
+                 trg_conf: PriceHistoryETLTargetConfig):
+        """
+        Constructor for PriceHistoryETL
+
+        :param s3_bucket: connection to s3 bucket api
+        :param src_conf: NamedTuple class with source configuration data
+        :param trg_conf: NamedTuple class with target configuration data
+        """
+        self._logger = logging.getLogger(__name__)
+        self.s3 = s3_bucket
+        self.src_conf = src_conf
+        self.trg_conf = trg_conf
+
+    # Extract
+    def list_partition_keys(self, start: datetime, end: datetime) -> list:
+        """
+        Lists the dataset files of the months between start and end, skipping
+        the partitions of countries that aren't analysed
+
+        :param start: first day of history
+        :param end: last day of history
+
+        :returns:
+            list: tuples with the file key and its country code
+        """
+        countries = set(self.src_conf.country_codes) if self.src_conf.country_codes else None
+        keys = []
+        for month in pd.period_range(start, end, freq="M").strftime("%Y-%m"):
+            for key in self.s3.list_keys(f"{self.src_conf.dataset_key}{self.src_conf.month_col}={month}/"):
+                partitions = dict(part.split("=", 1) for part in key.split("/") if "=" in part)
+                country = partitions.get(self.src_conf.country_col)
+                if key.endswith(".parquet") and country and (countries is None or country in countries):
+                    keys.append((key, country))
+        self._logger.info(f"{len(keys)} dataset files between {start.date()} and {end.date()}")
+        return keys
+
+    def iter_history_chunks(self, start: datetime, end: datetime):
+        """
+        Reads the history one row group at a time. Only the needed columns are downloaded
+        and row groups outside the date range (or app ids) are skipped using the
+        statistics in the file footers, before they're downloaded
+
+        :param start: first day of history
+        :param end: last day of history
+
+        :returns:
+            Iterator: DataFrames with the date, app, price and country cols
+        """
+        date_col, app_col, price_col = self.src_conf.date_col, self.src_conf.app_col, self.src_conf.price_col
+        ranges = {date_col: (start.date(), end.date())}
+        app_ids = None
+        if self.src_conf.app_ids:
+            app_ids = np.asarray(self.src_conf.app_ids)
+            ranges[app_col] = (int(app_ids.min()), int(app_ids.max()))
+        for key, country in self.list_partition_keys(start, end):
+            # the footer is downloaded first, then only the needed columns of the row groups
+            # in range. Files compacted away since they were listed yield nothing
+            for table in self.s3.iter_parquet_row_groups(key, columns=[date_col, app_col, price_col], ranges=ranges):
+                df = table.to_pandas(date_as_object=False)
+                mask = df[date_col].between(pd.Timestamp(start.date()), pd.Timestamp(end.date())) \
+                    & (df[price_col] > 0)
+                if app_ids is not None:
+                    mask &= df[app_col].isin(app_ids)
+                df = df[mask]
+                if not df.empty:
+                    yield df.assign(**{self.src_conf.country_col: country})
+
+    # Transform
+    def _partial_aggregates(self, df: DataFrame, sale_start: pd.Timestamp) -> dict:
+        date_col, app_col, price_col = self.src_conf.date_col, self.src_conf.app_col, self.src_conf.price_col
+        country_col = self.src_conf.country_col
+        df = df.assign(log_price=np.log(df[price_col]),
+                       recent_price=df[price_col].where(df[date_col] >= sale_start)) \
+               .sort_values(date_col)
+        return {"date_country": df.groupby([date_col, country_col], sort=False)
+                                  .agg(log_sum=("log_price", "sum"), n=("log_price", "size")),
+                "app_country": df.groupby([app_col, country_col], sort=False)
+                                 .agg(log_sum=("log_price", "sum"),
+                                      n=("log_price", "size"),
+                                      regular_price=("recent_price", "max"),
+                                      last_date=(date_col, "last"),
+                                      last_price=(price_col, "last")),
+                "app": df.groupby(app_col, sort=False)
+                         .agg(log_sum=("log_price", "sum"), n=("log_price", "size"))}
+
+    @staticmethod
+    def _reduce(partials: list) -> dict:
+        """
+        Merges partial aggregates into a single one per level
+        """
+        reduced = {}
+        for level in ("date_country", "app"):
+            reduced[level] = pd.concat([partial[level] for partial in partials]) \
+                               .groupby(level=list(range(len(partials[0][level].index.names)))).sum()
+        app_country = pd.concat([partial["app_country"] for partial in partials]).sort_values("last_date")
+        reduced["app_country"] = app_country.groupby(level=[0, 1]) \
+                                            .agg(log_sum=("log_sum", "sum"),
+                                                 n=("n", "sum"),
+                                                 regular_price=("regular_price", "max"),
+                                                 last_date=("last_date", "last"),
+                                                 last_price=("last_price", "last"))
+        return reduced
+
+    def aggregate_history(self, start: datetime, end: datetime) -> dict:
+        """
+        Streams the history into partial aggregates, merging them every reduce_every
+        row groups so that memory depends on the amount of apps, countries and days,
+        not on the amount of rows
+
+        :param start: first day of history
+        :param end: last day of history
+
+        :returns:
+            dict: aggregates per date and country, per app and country and per app. None
+                  if there is no history
+        """
+        sale_start = pd.Timestamp((end - timedelta(days=self.src_conf.sale_lookback_days)).date())
+        partials = []
+        rows = 0
+        for df in self.iter_history_chunks(start, end):
+            rows += len(df)
+            partials.append(self._partial_aggregates(df, sale_start))
+            if len(partials) >= self.src_conf.reduce_every:
+                partials = [self._reduce(partials)]
+        self._logger.info(f"{rows} historical prices aggregated")
+        return self._reduce(partials) if partials else None
+
+    def get_country_deviations(self, date_country: DataFrame) -> DataFrame:
+        """
+        Calculates the daily deviation of each country from the world average, as the
+        ratio of geometric mean prices, and its rolling mean over rolling_days
+
+        :param date_country: aggregates per date and country
+
+        :returns:
+            DataFrame: df with date, country, deviation and rolling_deviation cols
+        """
+        date_col, country_col = self.src_conf.date_col, self.src_conf.country_col
+        df = date_country.reset_index()
+        world = df.groupby(date_col)[["log_sum", "n"]].transform("sum")
+        df["deviation"] = np.exp(df["log_sum"] / df["n"] - world["log_sum"] / world["n"]) - 1
+        df = df.sort_values([country_col, date_col]).reset_index(drop=True)
+        df["rolling_deviation"] = df.set_index(date_col) \
+                                    .groupby(country_col, sort=False)["deviation"] \
+                                    .rolling(f"{self.src_conf.rolling_days}D") \
+                                    .mean() \
+                                    .to_numpy()
+        return df[[date_col, country_col, "deviation", "rolling_deviation"]]
+
+    def get_app_price_indices(self, app_country: DataFrame, app: DataFrame) -> DataFrame:
+        """
+        Calculates each app regional price index: its geometric mean price in a country
+        relative to its geometric mean price in every country (1 is the world average)
+
+        :param app_country: aggregates per app and country
+        :param app: aggregates per app
+
+        :returns:
+            DataFrame: df with app, country and price_index cols
+        """
+        df = app_country.reset_index()
+        app_log_mean = (app["log_sum"] / app["n"]).rename("app_log_mean")
+        df = df.join(app_log_mean, on=self.src_conf.app_col)
+        df["price_index"] = np.exp(df["log_sum"] / df["n"] - df["app_log_mean"])
+        return df[[self.src_conf.app_col, self.src_conf.country_col, "price_index"]]
+
+    def get_sales(self, app_country: DataFrame) -> DataFrame:
+        """
+        Detects the apps whose last price is at least sale_threshold under their regular
+        price (the max price in the last sale_lookback_days)
+
+        :param app_country: aggregates per app and country
+
+        :returns:
+            DataFrame: df with app, country, last_date, last_price, regular_price and discount cols
+        """
+        df = app_country.reset_index()
+        df["discount"] = 1 - df["last_price"] / df["regular_price"]
+        df = df[df["discount"] >= self.src_conf.sale_threshold]
+        return df[[self.src_conf.app_col, self.src_conf.country_col,
+                   "last_date", "last_price", "regular_price", "discount"]].reset_index(drop=True)
+
+    # Load
+    def generate_price_history(self, run_date: datetime = None) -> dict:
+        """
+        Analyses the last history_days of prices and saves the results to
+        external storage service
+
+        :param run_date: last day of history. None means today
+
+        :returns:
+            dict: result names as keys and DataFrames as values. None if there is no history
+        """
+        end = run_date or datetime.now()
+        start = end - timedelta(days=self.src_conf.history_days)
+        aggregates = self.aggregate_history(start, end)
+        if aggregates is None:
+            self._logger.warning(f"no price history between {start.date()} and {end.date()}")
+            return None
+        results = {"country_deviations": self.get_country_deviations(aggregates["date_country"]),
+                   "app_price_indices": self.get_app_price_indices(aggregates["app_country"], aggregates["app"]),
+                   "sales": self.get_sales(aggregates["app_country"])}
+        todays_date = end.strftime(self.trg_conf.trg_key_date_format)
+        for name, df in results.items():
+            self.s3.save_df_to_parquet(df, f"{self.trg_conf.trg_key}{name}/{self.trg_conf.trg_key_filename}"
+                                           f"{todays_date}.parquet")
+        self._logger.info(f"price history analysed: {len(results['sales'])} sales detected")
+        return results
@@ -1,14 +1,31 @@
+import io
+import json
 import time
 import logging
-import re
 import numpy as np
 import pandas as pd
 
-from Scripts.common.external_resources import SteamWebApi, OpenExRatesApi, S3Bucket
-from datetime import datetime
-from typing import NamedTuple
+from Scripts.common.external_resources import SteamWebApi, OpenExRatesApi, S3Bucket, LocalStorage
+from Scripts.common.checkpoint import RunCheckpoint
+from Scripts.common.ex_rates_cache import ExRatesCache
+from Scripts.common.country_index import CountryIndex
+from Scripts.common.currency_formats import (STEAM_CURRENCY_FORMATS,
+                                             PRICE_NUMBER_PATTERN,
+                                             PRICE_WHITESPACE_PATTERN)
+from Scripts.common.price_schema import apply_price_schema, raw_price_frame, price_arrow_schema
+from Scripts.common.parquet_dataset import PartitionedParquetWriter, compact_parquet_files
+from Scripts.common.metrics import METRICS
+from Scripts.common.work_manifest import WorkManifest, ShardClaim
+from concurrent.futures import ThreadPoolExecutor, Executor, Future
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import NamedTuple, Union
 from pandas import DataFrame
 
+RUN_ID_FORMAT = "%Y%m%d%H%M%S"
+DATASET_MONTH_COL = "month"
+DATASET_DATE_COL = "snapshot_date"
+
 """TODO:
 1. make the remaining method docs using google syntax
 2. Check the target conf in yaml (the target now is the bucket the etl points to)
@@ -25,10 +42,40 @@ class SteamPricesETLSourceConfig(NamedTuple):
     :param ex_currencies: currencies to get the exchange rates (for base currency)
     :param videogames_appids: videogames to get the prices of in the different exchange
                               currencies
+    :param max_workers: number of threads requesting prices from steam concurrently
+    :param batch_size: amount of apps whose prices are requested to steam in a single request
+    :param request_budget: maximum number of steam requests for a single run, the ones sampling
+                           price regions included. None means there is no limit
+    :param price_regions: dict containing country codes (ALPHA-2) as keys and the steam pricing
+                          region they belong to as values. Prices are fetched once per region and
+                          shared by every country in it. None disables the price region mode
+    :param price_regions_sample_appids: apps used to refresh price_regions by sampling at the
+                                        start of the run. None keeps price_regions as configured
+    :param price_regions_from_country_index: if True and price_regions is None, the steam regions
+                                             of the shared CountryIndex are used
+    :param incremental: if True, only stale or on sale apps are requested and only the prices that
+                        changed since the previous snapshot are saved (as a delta)
+    :param max_staleness_days: in incremental mode, apps requested less than this many days ago
+                               are skipped, unless they are on sale
+    :param price_change_tolerance: in incremental mode, relative usd price change under which a
+                                   price is considered unchanged (absorbs exchange rate noise)
+    :param sale_threshold: in incremental mode, relative price drop that marks an app as on sale
+    :param shard_size: in distributed runs, apps per shard claimed by a worker
     """
     base_currency: str
     ex_currencies: str
     videogames_appids: str
+    max_workers: int = 1
+    batch_size: int = 1
+    request_budget: int = None
+    price_regions: dict = None
+    price_regions_sample_appids: list = None
+    price_regions_from_country_index: bool = False
+    incremental: bool = False
+    max_staleness_days: float = 7
+    price_change_tolerance: float = 0.02
+    sale_threshold: float = 0.1
+    shard_size: int = 500
 
 
 class SteamPricesETLTargetConfig(NamedTuple):
@@ -42,12 +89,63 @@ class SteamPricesETLTargetConfig(NamedTuple):
                             this one is appended to the filename at the end
     :param trg_format: the filename format for the data to be stored
     :param trg_cols: columns included in the filename to be stored
+    :param trg_rejects_key: the folder inside the target storage service for the prices
+                            that couldn't be parsed. None means rejects are only logged
+    :param trg_row_group_size: rows parsed and written to the parquet file at a time
+    :param trg_checkpoint_key: the folder inside the target storage service where the run
+                               progress is checkpointed. None disables checkpoints
+    :param trg_checkpoint_local_dir: local directory where trg_checkpoint_key is located. None
+                                     means checkpoints are stored in the target storage service
+    :param trg_checkpoint_size: rows per checkpoint part
+    :param trg_delta_key: the folder inside the target storage service for incremental deltas
+    :param trg_manifest_key: the folder inside the target storage service for the manifests that
+                             point incremental deltas to their base snapshot
+    :param trg_max_deltas: deltas saved on top of a base snapshot before a new full snapshot is taken
+    :param trg_latest_key: key of the index object pointing to the latest snapshot (and its deltas).
+                           It's updated on every run so that readers don't need to list the bucket
+    :param trg_dataset_key: the folder inside the target storage service for the Hive-style
+                            partitioned dataset (month=YYYY-MM/country_iso=xx/) every run appends
+                            its prices to, for historical analysis. None disables the dataset
+    :param trg_dataset_row_group_size: rows per row group of the compacted monthly files
+    :param trg_dataset_dictionary_cols: low cardinality columns stored dictionary encoded
+    :param trg_price_dtype: dtype of the parsed prices, float32 or float64
+    :param trg_work_key: the folder inside the target storage service for the work manifests,
+                         leases and shard parts of distributed runs. None disables distributed runs
+    :param trg_lease_seconds: seconds a shard claimed by a worker of a distributed run is reserved
+                              for it. Shards of workers that die are taken over once it expires
     """
     trg_key: str
     trg_key_date_format: str
     trg_key_filename: str
     trg_format: str
     trg_cols: list
+    trg_rejects_key: str = None
+    trg_row_group_size: int = 10000
+    trg_checkpoint_key: str = None
+    trg_checkpoint_local_dir: str = None
+    trg_checkpoint_size: int = 500
+    trg_delta_key: str = None
+    trg_manifest_key: str = None
+    trg_max_deltas: int = 30
+    trg_latest_key: str = None
+    trg_dataset_key: str = None
+    trg_dataset_row_group_size: int = 131072
+    trg_dataset_dictionary_cols: list = None
+    trg_price_dtype: str = 'float64'
+    trg_work_key: str = None
+    trg_lease_seconds: float = 900
+
+
+class SteamPricesHandoff(NamedTuple):
+    """
+    Result of a SteamPricesETL run handed over in memory to the next stage
+
+    :param prices: df with the latest price of every app and country (handoff_cols only)
+    :param load_future: Future of the load step (upload, manifest and index) when it runs in
+                        the background. None if it already finished
+    """
+    prices: DataFrame
+    load_future: Future = None
 
 
 class SteamPricesETL:
@@ -58,18 +156,20 @@ class SteamPricesETL:
 
     def __init__(self,
                  steam_api: SteamWebApi,
-                 ex_rates_api: OpenExRatesApi,
+                 ex_rates_api: Union[OpenExRatesApi, ExRatesCache],
                  s3_bucket: S3Bucket,
                  src_conf: SteamPricesETLSourceConfig,
-                 trg_conf: SteamPricesETLTargetConfig,):
+                 trg_conf: SteamPricesETLTargetConfig,
+                 country_index: CountryIndex = None):
         """
         Constructor for SteamPricesETL
 
         :param steam_api: connection to steam market api
-        :param ex_rates_api: connection to exchange rates api
+        :param ex_rates_api: connection to exchange rates api (or a cache in front of it)
         :param s3_bucket: connection to s3 bucket api
         :param src_conf: NamedTuple class with source configuration data
         :param trg_conf: NamedTuple class with target configuration data
+        :param country_index: country lookups shared with WorldMapETL
         """
         self._logger = logging.getLogger(__name__)
         self.steam_api = steam_api
@@ -77,6 +177,7 @@ class SteamPricesETL:
         self.src_conf = src_conf
         self.trg_conf = trg_conf
         self.s3 = s3_bucket
+        self.country_index = country_index
 
     # Extract
     def get_currency_rates(self, base_currency: str,
@@ -98,79 +199,276 @@ class SteamPricesETL:
         return ex_rates
 
     # Transform
-    def parse_app_price(self,
-                        price_str: str,
-                        ex_rate: float,
-                        currency_name: str) -> tuple:
+    def parse_app_prices(self,
+                         raw_df: DataFrame,
+                         ex_rates: dict) -> tuple:
+        """
+        Parses steam market api prices to float and converts them to the currency
+        the exchange rates are relative to. The whole column is parsed at once using
+        each currency's decimal and thousands separators
+
+        :param raw_df: df with trg_cols, except that the price column holds the raw
+                       price strings from the api
+        :param ex_rates: dict containing currency names (ALPHA-3) as key and exchange rates as values
+
+        :returns:
+            tuple: df with the prices parsed as trg_price_dtype and df with the rows that couldn't
+                   be parsed plus a reject_reason column
+        """
+        _, _, currency_col, price_col = self.trg_conf.trg_cols
+        currencies = raw_df[currency_col].str.upper()
+        decimal_seps = currencies.map({name: fmt.decimal_sep for name, fmt in STEAM_CURRENCY_FORMATS.items()})
+        thousands_seps = currencies.map({name: fmt.thousands_sep for name, fmt in STEAM_CURRENCY_FORMATS.items()})
+
+        numbers = raw_df[price_col].astype(str).str.extract(PRICE_NUMBER_PATTERN, expand=False)
+        # whitespace is only ever used as thousands separator
+        numbers = numbers.str.replace(PRICE_WHITESPACE_PATTERN, "", regex=True)
+        # one vectorized replace per separator instead of one per row
+        for sep in thousands_seps.dropna().unique():
+            if sep.strip():
+                is_sep = thousands_seps == sep
+                numbers[is_sep] = numbers[is_sep].str.replace(sep, "", regex=False)
+        for sep in decimal_seps.dropna().unique():
+            if sep != ".":
+                is_sep = decimal_seps == sep
+                numbers[is_sep] = numbers[is_sep].str.replace(sep, ".", regex=False)
+        values = pd.to_numeric(numbers, errors="coerce")
+        rates = currencies.map(ex_rates)
+
+        reject_reason = pd.Series(np.select([decimal_seps.isna(),
+                                             numbers.isna(),
+                                             values.isna(),
+                                             rates.isna() | (rates == 0)],
+                                            ["unknown currency format",
+                                             "no price found",
+                                             "price couldn't be parsed",
+                                             "no exchange rate"],
+                                            default=""),
+                                  index=raw_df.index)
+        is_rejected = reject_reason != ""
+        rejects_df = raw_df[is_rejected].assign(reject_reason=reject_reason[is_rejected])
+        prices_df = raw_df[~is_rejected].assign(**{price_col: (values[~is_rejected] / rates[~is_rejected])
+                                                   .astype(self.trg_conf.trg_price_dtype)})
+        if not rejects_df.empty:
+            self._logger.warning(f"{len(rejects_df)} of {len(raw_df)} prices couldn't be parsed")
+        return prices_df, rejects_df
+
+    def _get_app_prices_rows(self,
+                             app_ids: list,
+                             cc: str,
+                             region_members: list = None) -> list:
         """
-        Parses steam market api app price data to float type and calculates the
-        exchange rate for currency
+        Gets the prices of a batch of apps in a single country
 
-        :param price_str: steam market api app price (raw data from api)
-        :param ex_rate: exchange rate to convert price from local currency (currency_name)
-                        to whatever the exchange rate is relative to
-        :param currency_name: currency name (ALPHA-2) for price_str
+        :param app_ids: steam games id to get the price of
+        :param cc: country code (ALPHA-2) to get the prices for
+        :param region_members: country codes (ALPHA-2) sharing cc's steam pricing region. A row is
+                               built for each of them with cc's price. None means only cc
 
         :returns:
-            tuple: first position as currency name (the same as the param), and
-                   second position as price in the currency the exchange rate is
-                   relative to
+            list: items as tuples each containing the app_id, country code (ALPHA-2),
+                  currency steam uses for app_id in country and the raw price string.
+                  Apps whose price couldn't be retrieved are left out
         """
         try:
-            price_formatted = re.findall(r"[0-9]+[,\. ]?[0-9]*", price_str)
-            if price_formatted:
-                usd_price_formatted_str = price_formatted[0].replace(" ", "").replace(".", "").replace(",", ".")
-                # if the country uses . for thousands this is ok
-                usd_price = float(usd_price_formatted_str) / ex_rate
-                if usd_price > 100 or usd_price < 0.1:
-                    usd_price_formatted_str = price_formatted[0].replace(" ", "").replace(",", "")
-                    # use this for countries that use . for floating point numbers
-                    usd_price = float(usd_price_formatted_str) / ex_rate
-                return (currency_name, usd_price)
-        except Exception:
-            self._logger.debug(f"execution for {currency_name} failed. Sending NaN...")
-        return (currency_name, np.nan)  # if the price couldn't be parsed, then send NaN
+            app_prices, failures = self.steam_api.get_app_prices(app_ids=app_ids,
+                                                                 country_code=cc)
+        except Exception as e:
+            self._logger.error(f"{cc} for {app_ids} could not be processed... skipping...")
+            self._logger.error(f"{e}")
+            return []
+        for app, reason in failures.items():
+            self._logger.error(f"{cc} for {app} could not be processed ({reason})... skipping...")
+        rows = []
+        for app, (app_price_str, steam_currency) in app_prices.items():
+            # fan out the region price to every member country
+            for member in region_members or [cc]:
+                rows.append((app, member.lower(), steam_currency.lower(), app_price_str))
+        return rows
+
+    def sample_price_regions(self,
+                             sample_app_ids: list,
+                             country_codes: list,
+                             max_workers=1) -> dict:
+        """
+        Groups countries into steam pricing regions by requesting the price of a
+        few sample apps in every country. Countries where all the sample apps have
+        the same price and currency are considered the same region
+
+        :param sample_app_ids: steam games id used as price samples
+        :param country_codes: country codes (ALPHA-2) to group
+        :param max_workers: number of threads requesting prices concurrently
+
+        :returns:
+            dict: country codes (ALPHA-2) as keys and region names as values. The region name
+                  is the first country code found for that region
+        """
+        def sample_country(cc):
+            try:
+                app_prices, _ = self.steam_api.get_app_prices(app_ids=sample_app_ids,
+                                                              country_code=cc)
+            except Exception as e:
+                self._logger.error(f"{cc} could not be sampled ({e})... using its own region")
+                return None
+            return tuple(sorted(app_prices.items()))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            signatures = list(executor.map(sample_country, country_codes))
+        regions = {}
+        region_by_signature = {}
+        for cc, signature in zip(country_codes, signatures):
+            if not signature:
+                regions[cc] = cc
+                continue
+            regions[cc] = region_by_signature.setdefault(signature, cc)
+        self._logger.info(f"sampled {len(country_codes)} countries into "
+                          f"{len(set(regions.values()))} price regions")
+        return regions
+
+    def get_price_regions(self) -> dict:
+        """
+        Resolves the steam pricing region of each country as the source configuration
+        says: as configured, from the country index or sampled
+
+        :returns:
+            dict: country codes (ALPHA-2) as keys and their steam pricing region as values.
+                  None if the price region mode is disabled
+        """
+        price_regions = self.src_conf.price_regions
+        if price_regions is None and self.src_conf.price_regions_from_country_index and self.country_index:
+            price_regions = self.country_index.steam_regions(list(self.src_conf.ex_currencies.keys()))
+        if self.src_conf.price_regions_sample_appids:
+            price_regions = self.sample_price_regions(sample_app_ids=self.src_conf.price_regions_sample_appids,
+                                                      country_codes=list(self.src_conf.ex_currencies.keys()),
+                                                      max_workers=self.src_conf.max_workers)
+        return price_regions
+
+    def iter_prices_per_app(self,
+                            app_ids: list,
+                            currencies: dict,
+                            max_workers=1,
+                            batch_size=1,
+                            request_budget=None,
+                            price_regions=None,
+                            completed_pairs=None):
+        """
+        Yields raw prices for apps in different countries as soon as they are
+        retrieved, so that they can be parsed and stored in chunks
+
+        :param app_ids: list with the steam games id to get the price of in different currencies
+        :param currencies: dict containing the country code (ALPHA-2) and their currency
+                            names (ALPHA-3) as values
+        :param max_workers: number of threads requesting prices concurrently
+        :param batch_size: amount of apps requested to steam in a single request
+        :param request_budget: maximum number of steam requests for this call. Requests over
+                               the budget are skipped. None means there is no limit
+        :param price_regions: dict containing country codes (ALPHA-2) as keys and their steam
+                              pricing region as values. Each (app, region) is requested once and
+                              its price is copied to every country in the region. Countries that
+                              are not in the dict are their own region
+        :param completed_pairs: set of (app_id, country code (ALPHA-2)) tuples already retrieved
+                                (e.g. by a previous attempt of the run). They aren't requested again
+
+        :returns:
+            Iterator: tuples each containing the app_id, country code (ALPHA-2),
+                      currency steam uses for app_id in country and the raw price string
+                      for country
+        """
+        # the first country of each region is the one requested to steam
+        region_members = {}
+        for cc in currencies.keys():
+            region = (price_regions or {}).get(cc, cc)
+            region_members.setdefault(region, []).append(cc)
+        batches = [app_ids[i:i + batch_size] for i in range(0, len(app_ids), batch_size)]
+        batch_requests = [(batch, members[0], members)
+                          for batch in batches for members in region_members.values()]
+        if completed_pairs:
+            # a checkpoint part can end halfway through a region's fan-out, so an app is only
+            # skipped once every member of the region is saved. The members that were saved
+            # are filtered out of the rows below
+            batch_requests = [([app for app in batch
+                                if any((app, member.lower()) not in completed_pairs for member in members)],
+                               cc, members)
+                              for (batch, cc, members) in batch_requests]
+            batch_requests = [request for request in batch_requests if request[0]]
+            self._logger.info(f"{len(completed_pairs)} prices already retrieved, skipping them")
+        if request_budget is not None and len(batch_requests) > request_budget:
+            self._logger.warning(f"{len(batch_requests)} requests needed but budget is {request_budget}... "
+                                 f"skipping the last {len(batch_requests) - request_budget}")
+            batch_requests = batch_requests[:request_budget]
+        self._logger.info(f"started processing {len(app_ids)} apps prices in {len(batch_requests)} "
+                          f"requests with {max_workers} workers")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # requests are paced by the steam api rate limiter, which is shared by every worker
+            # map keeps the order of batch_requests, so the output is deterministic
+            batch_rows = executor.map(lambda request: self._get_app_prices_rows(app_ids=request[0],
+                                                                                cc=request[1],
+                                                                                region_members=request[2]),
+                                      batch_requests)
+            retrieved = 0
+            for rows in batch_rows:
+                if completed_pairs:
+                    rows = [row for row in rows if (row[0], row[1]) not in completed_pairs]
+                retrieved += len(rows)
+                yield from rows
+        self._logger.info(f"finished processing prices, {retrieved} retrieved "
+                          f"(steam rate limiter: {self.steam_api.rate_limiter.stats()})")
 
     def get_prices_per_app(self,
                            app_ids: list,
                            currencies: dict,
-                           ex_rates: dict,
-                           wait_time=3) -> list:
+                           **kwargs) -> list:
         """
-        Gets prices for apps in the currencies the exchange rates are relative to
+        Gets raw prices for apps in different countries. Same as iter_prices_per_app,
+        but all the rows are kept in memory
 
         :param app_ids: list with the steam games id to get the price of in different currencies
         :param currencies: dict containing the country code (ALPHA-2) and their currency
                             names (ALPHA-3) as values
-        :param ex_rates: dict containing currency names (ALPHA-3) as key and exchange rates as values
-        :wait_time: time to wait between price extraction (to prevent DDoS attacks)
+        :param kwargs: the rest of iter_prices_per_app args
 
         :returns:
             list: items as tuples each containing the app_id, country code (ALPHA-2),
-                    currency steam uses for app_id in country and price in usd for
-                    country
-        """
-        prices = list()
-        for app in app_ids:
-            self._logger.info(f"started processing {app} prices")
-            for (cc, _) in currencies.items():
-                try:
-                    app_price_str, steam_currency = self.steam_api.get_app_price(app_id=app,
-                                                                                 country_code=cc)
-                    # if country uses usd, then rate is 1
-                    rate = ex_rates.get(steam_currency.upper())
-                    # parse API price to get float value
-                    _, usd_price = self.parse_app_price(app_price_str, rate, steam_currency)
-                    prices.append((app, cc.lower(), steam_currency.lower(), usd_price))
-                    # wait X time to prevent DDoS
-                    time.sleep(wait_time)
-                except Exception as e:
-                    self._logger.error(f"{cc} for {app} could not be processed... skipping...")
-                    self._logger.error(f"{e}")
-                    continue
-
-            self._logger.info(f"finished processing {app} prices")
-        return prices
+                    currency steam uses for app_id in country and the raw price string
+                    for country
+        """
+        return list(self.iter_prices_per_app(app_ids, currencies, **kwargs))
+
+    def iter_parsed_chunks(self,
+                           raw_prices,
+                           ex_rates: dict,
+                           chunk_size: int,
+                           rejects: list):
+        """
+        Groups raw prices into chunks of chunk_size rows and parses each of them
+
+        :param raw_prices: iterable of raw price tuples as yielded by iter_prices_per_app
+        :param ex_rates: dict containing currency names (ALPHA-3) as key and exchange rates as values
+        :param chunk_size: amount of rows per chunk
+        :param rejects: list where the rejected rows dfs of every chunk are appended to
+
+        :returns:
+            Iterator: DataFrames with trg_cols and the prices parsed, one per chunk
+        """
+        chunk = []
+        for row in raw_prices:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield self._parse_chunk(chunk, ex_rates, rejects)
+                chunk = []
+        if chunk:
+            yield self._parse_chunk(chunk, ex_rates, rejects)
+
+    def _parse_chunk(self, chunk: list, ex_rates: dict, rejects: list) -> DataFrame:
+        raw_df = raw_price_frame(chunk, self.trg_conf.trg_cols)
+        df, rejects_df = self.parse_app_prices(raw_df, ex_rates)
+        METRICS.inc("rows_parsed_total", len(df), etl="steam_prices")
+        if not rejects_df.empty:
+            rejects.append(rejects_df)
+            for reason, count in rejects_df["reject_reason"].value_counts().items():
+                METRICS.inc("rows_rejected_total", count, etl="steam_prices", reason=reason)
+        self._logger.debug(f"parsed chunk of {len(chunk)} prices")
+        return df
 
     def save_as_parquet_to_s3(self,
                               df: pd.DataFrame,
@@ -189,22 +487,574 @@ class SteamPricesETL:
         self.s3.save_df_to_parquet(df, filename+".parquet")
         return True
 
+    def load_manifest(self) -> dict:
+        """
+        Reads the manifest of the last incremental run. If there is none, the last
+        snapshot in trg_key is used as base
+
+        :returns:
+            dict: manifest with the base snapshot key, the deltas on top of it, when each app
+                  was last requested and the apps on sale. None if there's no previous snapshot
+        """
+        manifest = self.s3.get_bytes(f"{self.trg_conf.trg_manifest_key}latest.json")
+        if manifest is not None:
+            return json.loads(manifest)
+        try:
+            base = self.s3.get_bucket_filenames(bucket_name=self.s3.bucket_name,
+                                                prefix=self.trg_conf.trg_key)[0]
+        except (KeyError, IndexError):
+            return None
+        return {"base": base, "deltas": [], "app_fetched_at": {}, "on_sale_apps": []}
+
+    def save_manifest(self, manifest: dict, run_id: str) -> bool:
+        """
+        Saves the manifest of the run, both under its run id and as the latest one
+
+        :param manifest: manifest as returned by load_manifest
+        :param run_id: identifier of the run
+
+        :returns:
+            bool: True if the manifest was saved
+        """
+        data = json.dumps(manifest, indent=2).encode()
+        self.s3.save_bytes(data, f"{self.trg_conf.trg_manifest_key}{run_id}.json")
+        self.s3.save_bytes(data, f"{self.trg_conf.trg_manifest_key}latest.json")
+        return True
+
+    def load_snapshot_state(self, manifest: dict) -> DataFrame:
+        """
+        Rebuilds the latest known prices by applying the manifest deltas on top of its base
+
+        :param manifest: manifest as returned by load_manifest
+
+        :returns:
+            DataFrame: df with trg_cols, one row per app and country
+        """
+        app_col, cc_col = self.trg_conf.trg_cols[:2]
+        snapshots = [pd.read_parquet(io.BytesIO(self.s3.get_bytes(key)), columns=self.trg_conf.trg_cols)
+                     for key in [manifest["base"]] + manifest["deltas"]]
+        state = pd.concat(snapshots, ignore_index=True) \
+                  .drop_duplicates(subset=[app_col, cc_col], keep="last")
+        # categories of different files don't match, so concat falls back to object columns
+        return apply_price_schema(state, self.trg_conf.trg_cols, self.trg_conf.trg_price_dtype)
+
+    def select_apps_to_refresh(self,
+                               app_ids: list,
+                               manifest: dict,
+                               run_date: datetime) -> list:
+        """
+        Picks the apps an incremental run requests, most urgent first: apps on
+        sale, apps never requested and then the stalest ones. Apps requested less
+        than max_staleness_days ago are skipped
+
+        :param app_ids: every app tracked
+        :param manifest: manifest as returned by load_manifest
+        :param run_date: date of the run
+
+        :returns:
+            list: app ids to request
+        """
+        fetched_at = manifest["app_fetched_at"]
+        on_sale = set(manifest["on_sale_apps"])
+        stale_date = (run_date - timedelta(days=self.src_conf.max_staleness_days)).isoformat()
+
+        def priority(app):
+            if app in on_sale:
+                return (0, "")
+            if f"{app}" not in fetched_at:
+                return (1, "")
+            return (2, fetched_at[f"{app}"])
+
+        selected = sorted((app for app in app_ids if priority(app)[0] < 2 or priority(app)[1] <= stale_date),
+                          key=priority)
+        self._logger.info(f"incremental run: refreshing {len(selected)} of {len(app_ids)} apps "
+                          f"({len(on_sale)} on sale)")
+        return selected
+
+    def iter_changed_chunks(self,
+                            chunks,
+                            state: DataFrame,
+                            changes: dict):
+        """
+        Filters parsed chunks down to the prices that changed since the last snapshot
+
+        :param chunks: iterable of DataFrames as yielded by iter_parsed_chunks
+        :param state: latest known prices as returned by load_snapshot_state. None means
+                      there are no known prices, so every price is new
+        :param changes: dict where the refreshed_apps, sale_started and sale_ended sets of
+                        apps are collected
+
+        :returns:
+            Iterator: DataFrames with only the new or changed prices
+        """
+        app_col, cc_col, _, price_col = self.trg_conf.trg_cols
+        tolerance = self.src_conf.price_change_tolerance
+        sale_threshold = self.src_conf.sale_threshold
+        previous = None
+        if state is not None:
+            previous = pd.Series(state[price_col].to_numpy(),
+                                 index=pd.MultiIndex.from_arrays([state[app_col].to_numpy(),
+                                                                  state[cc_col].astype(str).to_numpy()]))
+        for chunk in chunks:
+            changes["refreshed_apps"].update(chunk[app_col].unique().tolist())
+            if previous is None:
+                yield chunk
+                continue
+            keys = pd.MultiIndex.from_arrays([chunk[app_col].to_numpy(), chunk[cc_col].astype(str).to_numpy()])
+            old_price = pd.Series(previous.reindex(keys).to_numpy(),
+                                  index=chunk.index)
+            ratio = chunk[price_col] / old_price
+            changes["sale_started"].update(chunk.loc[ratio <= 1 - sale_threshold, app_col].tolist())
+            changes["sale_ended"].update(chunk.loc[ratio >= 1 / (1 - sale_threshold), app_col].tolist())
+            yield chunk[old_price.isna() | ((ratio - 1).abs() > tolerance)]
+
+    def get_run_checkpoint(self, run_id: str) -> RunCheckpoint:
+        """
+        Creates the checkpoint for a run, as configured in the target configuration
+
+        :param run_id: identifier of the run
+
+        :returns:
+            RunCheckpoint: checkpoint of the run. None if checkpoints are disabled
+        """
+        if not self.trg_conf.trg_checkpoint_key:
+            return None
+        storage = LocalStorage(self.trg_conf.trg_checkpoint_local_dir) \
+            if self.trg_conf.trg_checkpoint_local_dir else self.s3
+        return RunCheckpoint(storage=storage,
+                             prefix=self.trg_conf.trg_checkpoint_key,
+                             run_id=run_id,
+                             columns=self.trg_conf.trg_cols)
+
     # Load
-    def generate_games_data(self):
+    def _iter_collected_chunks(self, chunks, columns: list, collected: list):
+        """
+        Passes chunks through while keeping a copy of columns of each one in collected
+        """
+        for chunk in chunks:
+            collected.append(chunk[columns])
+            yield chunk
+
+    def _iter_dataset_chunks(self, chunks, writer: PartitionedParquetWriter, run_date: datetime):
+        """
+        Passes chunks through while writing them to the partitioned dataset
+        """
+        for chunk in chunks:
+            writer.write(chunk.assign(**{DATASET_DATE_COL: run_date.date(),
+                                         DATASET_MONTH_COL: run_date.strftime("%Y-%m")}))
+            yield chunk
+
+    def get_dataset_writer(self) -> PartitionedParquetWriter:
+        """
+        Creates the writer of the run's partitioned dataset files
+
+        :returns:
+            PartitionedParquetWriter: writer partitioned by month and country. None if the
+                                      dataset is disabled
+        """
+        if not self.trg_conf.trg_dataset_key:
+            return None
+        return PartitionedParquetWriter(partition_cols=[DATASET_MONTH_COL, self.trg_conf.trg_cols[1]],
+                                        dictionary_cols=self.trg_conf.trg_dataset_dictionary_cols)
+
+    def compact_dataset(self, month: str) -> int:
+        """
+        Merges the small per run files of a month of the partitioned dataset into a single
+        file per country, sorted by date and app, so that reading many months means
+        reading few objects. The merged file is saved before the small ones are deleted
+
+        :param month: month to compact (YYYY-MM)
+
+        :returns:
+            int: amount of partitions compacted
+        """
+        app_col = self.trg_conf.trg_cols[0]
+        prefix = f"{self.trg_conf.trg_dataset_key}{DATASET_MONTH_COL}={month}/"
+        partitions = {}
+        for key in self.s3.list_keys(prefix):
+            if key.endswith(".parquet"):
+                partitions.setdefault(key.rsplit("/", 1)[0] + "/", []).append(key)
+        compacted_id = datetime.now().strftime(RUN_ID_FORMAT)
+        compacted = 0
+        for partition, keys in sorted(partitions.items()):
+            if len(keys) < 2:
+                continue
+            data = compact_parquet_files([self.s3.get_bytes(key) for key in keys],
+                                         sort_cols=[DATASET_DATE_COL, app_col],
+                                         row_group_size=self.trg_conf.trg_dataset_row_group_size,
+                                         dictionary_cols=self.trg_conf.trg_dataset_dictionary_cols)
+            self.s3.save_bytes(data, f"{partition}compacted-{compacted_id}.parquet")
+            self.s3.delete_keys(keys)
+            compacted += 1
+            self._logger.info(f"compacted {len(keys)} files of {partition}")
+        self._logger.info(f"{compacted} partitions of {month} compacted")
+        return compacted
+
+    def generate_games_data(self,
+                            run_id: str = None,
+                            handoff_cols: list = None,
+                            executor: Executor = None,
+                            ex_rates: dict = None) -> SteamPricesHandoff:
         """
         Builds steam app data for different countries and saves it
         to external storage service
+
+        :param run_id: identifier of the run to resume. None starts a new run
+        :param handoff_cols: columns of the prices to keep in memory and return, so that the
+                             next stage doesn't have to download them. None keeps nothing
+        :param executor: if given, the upload to the external storage service runs in it, in
+                         the background, and the method returns as soon as prices are extracted
+        :param ex_rates: exchange rates already retrieved (e.g. by another pipeline stage). None
+                         means they're requested by the ETL
+
+        :returns:
+            SteamPricesHandoff: prices in memory (if handoff_cols) and the load step Future
+        """
+        run_date = datetime.strptime(run_id, RUN_ID_FORMAT) if run_id else datetime.now()
+        run_id = run_date.strftime(RUN_ID_FORMAT)
+        app_col, cc_col = self.trg_conf.trg_cols[:2]
+        checkpoint = self.get_run_checkpoint(run_id)
+        completed_pairs = None
+        if checkpoint:
+            completed_pairs = checkpoint.completed([app_col, cc_col])
+            self._logger.info(f"run {run_id} is checkpointed in {checkpoint.run_prefix} "
+                              f"({len(completed_pairs)} prices already retrieved)")
+        app_ids = self.src_conf.videogames_appids
+        manifest = self.load_manifest() if self.src_conf.incremental else None
+        # a new base snapshot is taken when there's none or when too many deltas piled up on it
+        is_delta = manifest is not None and len(manifest["deltas"]) < self.trg_conf.trg_max_deltas
+        state = None
+        if is_delta:
+            state = self.load_snapshot_state(manifest)
+            app_ids = self.select_apps_to_refresh(app_ids, manifest, run_date)
+        if ex_rates is None:
+            with METRICS.timer("etl_stage_seconds", etl="steam_prices", stage="ex_rates"):
+                ex_rates = self.get_currency_rates(self.src_conf.base_currency,
+                                                   list(self.src_conf.ex_currencies.values()))
+        price_regions = self.get_price_regions()
+        request_budget = self.src_conf.request_budget
+        if request_budget is not None and self.src_conf.price_regions_sample_appids:
+            # sampling made a request per country, what's left of the budget goes to the prices
+            request_budget = max(request_budget - len(self.src_conf.ex_currencies), 0)
+        raw_prices = self.iter_prices_per_app(app_ids=app_ids,
+                                              currencies=self.src_conf.ex_currencies,
+                                              max_workers=self.src_conf.max_workers,
+                                              batch_size=self.src_conf.batch_size,
+                                              request_budget=request_budget,
+                                              price_regions=price_regions,
+                                              completed_pairs=completed_pairs)
+        if checkpoint:
+            # rows from previous attempts go first, new rows are checkpointed as they arrive
+            raw_prices = chain(checkpoint.iter_rows(),
+                               checkpoint.checkpointed(raw_prices, self.trg_conf.trg_checkpoint_size))
+        todays_date = run_date.strftime(self.trg_conf.trg_key_date_format)
+        trg_key = self.trg_conf.trg_delta_key if is_delta else self.trg_conf.trg_key
+        filename = f'{trg_key}{self.trg_conf.trg_key_filename}{todays_date}'
+        # rows flow from the api through the parser into the parquet file one chunk at a time
+        rejects = []
+        chunks = self.iter_parsed_chunks(raw_prices,
+                                         ex_rates=ex_rates,
+                                         chunk_size=self.trg_conf.trg_row_group_size,
+                                         rejects=rejects)
+        collected = []
+        if handoff_cols:
+            chunks = self._iter_collected_chunks(chunks,
+                                                 columns=list(dict.fromkeys([app_col, cc_col] + list(handoff_cols))),
+                                                 collected=collected)
+        # every refreshed price is appended to the dataset, not only the ones that changed
+        dataset_writer = self.get_dataset_writer()
+        if dataset_writer:
+            chunks = self._iter_dataset_chunks(chunks, writer=dataset_writer, run_date=run_date)
+        changes = {"refreshed_apps": set(), "sale_started": set(), "sale_ended": set()}
+        if self.src_conf.incremental:
+            chunks = self.iter_changed_chunks(chunks, state=state, changes=changes)
+        # rows are requested, parsed and written in the same stream, so they're timed together
+        with METRICS.timer("etl_stage_seconds", etl="steam_prices", stage="extract_transform"):
+            parquet_file = self.s3.write_df_chunks_to_parquet_file(chunks,
+                                                                   schema=price_arrow_schema(
+                                                                       self.trg_conf.trg_cols,
+                                                                       self.trg_conf.trg_price_dtype))
+            dataset_files = dataset_writer.close() if dataset_writer else {}
+
+        @METRICS.timer("etl_stage_seconds", etl="steam_prices", stage="load")
+        def load():
+            self._load_run(parquet_file=parquet_file,
+                           dataset_files=dataset_files,
+                           filename=filename,
+                           rejects=rejects,
+                           manifest=manifest,
+                           is_delta=is_delta,
+                           run_id=run_id,
+                           run_date=run_date,
+                           changes=changes,
+                           checkpoint=checkpoint)
+        load_future = executor.submit(load) if executor else load()
+
+        prices = None
+        if handoff_cols:
+            # prices that weren't refreshed by an incremental run are the previous ones
+            prices = pd.concat(([state] if state is not None else []) + collected, ignore_index=True) \
+                       .drop_duplicates(subset=[app_col, cc_col], keep="last")[list(handoff_cols)] \
+                       .reset_index(drop=True)
+            prices = apply_price_schema(prices, self.trg_conf.trg_cols, self.trg_conf.trg_price_dtype)
+        return SteamPricesHandoff(prices=prices, load_future=load_future)
+
+    def _load_run(self,
+                  parquet_file,
+                  dataset_files: dict,
+                  filename: str,
+                  rejects: list,
+                  manifest: dict,
+                  is_delta: bool,
+                  run_id: str,
+                  run_date: datetime,
+                  changes: dict,
+                  checkpoint: RunCheckpoint):
+        """
+        Uploads the run's parquet file, dataset files and rejects, then updates the manifest,
+        the latest index and the checkpoint. The index is only updated once the
+        file is in the external storage service
+        """
+        is_saved = parquet_file is not None
+        # the snapshot and the dataset partitions are uploaded at the same time
+        uploads = {f"{self.trg_conf.trg_dataset_key}{partition}part-{run_id}.parquet": partition_file
+                   for partition, partition_file in dataset_files.items()}
+        if is_saved:
+            uploads[filename+".parquet"] = parquet_file
+        self.s3.upload_many(uploads)
+        todays_date = run_date.strftime(self.trg_conf.trg_key_date_format)
+        if self.trg_conf.trg_rejects_key and rejects:
+            self.save_as_parquet_to_s3(df=pd.concat(rejects, ignore_index=True),
+                                       filename=f'{self.trg_conf.trg_rejects_key}'
+                                                f'{self.trg_conf.trg_key_filename}{todays_date}')
+        latest = {"base": filename+".parquet", "deltas": []} if is_saved else None
+        if self.src_conf.incremental:
+            latest = self._update_manifest(manifest,
+                                           is_base=not is_delta,
+                                           run_id=run_id,
+                                           run_date=run_date,
+                                           key=filename+".parquet" if is_saved else None,
+                                           changes=changes)
+        if latest and self.trg_conf.trg_latest_key:
+            self.save_latest_index(latest, run_id)
+        if checkpoint:
+            # the final file is complete, the checkpoint isn't needed anymore
+            checkpoint.clear()
+        self._logger.info(f"run {run_id} loaded to {filename}")
+
+    def _update_manifest(self,
+                         manifest: dict,
+                         is_base: bool,
+                         run_id: str,
+                         run_date: datetime,
+                         key: str,
+                         changes: dict):
+        """
+        Records an incremental run in the manifest
+
+        :param manifest: manifest of the previous run. None if there was no previous snapshot
+        :param is_base: True if the run saved a new base snapshot instead of a delta
+        :param run_id: identifier of the run
+        :param run_date: date of the run
+        :param key: key of the saved snapshot or delta. None if nothing changed
+        :param changes: changes collected by iter_changed_chunks
+
+        :returns:
+            dict: the updated manifest. None if it wasn't updated
+        """
+        if is_base:
+            if key is None:
+                self._logger.warning("incremental run: no prices were saved, the manifest is not updated")
+                return None
+            manifest = {"base": key,
+                        "deltas": [],
+                        "app_fetched_at": (manifest or {}).get("app_fetched_at", {}),
+                        "on_sale_apps": (manifest or {}).get("on_sale_apps", [])}
+        elif key:
+            manifest["deltas"].append(key)
+        for app in changes["refreshed_apps"]:
+            manifest["app_fetched_at"][f"{app}"] = run_date.isoformat()
+        on_sale = (set(manifest["on_sale_apps"]) | changes["sale_started"]) - \
+                  (changes["sale_ended"] - changes["sale_started"])
+        manifest["on_sale_apps"] = sorted(int(app) for app in on_sale)
+        manifest["run_id"] = run_id
+        self._logger.info(f"incremental run: {len(changes['refreshed_apps'])} apps refreshed, "
+                          f"{len(manifest['deltas'])} deltas on top of {manifest['base']}")
+        self.save_manifest(manifest, run_id)
+        return manifest
+
+    def save_latest_index(self, snapshot: dict, run_id: str) -> bool:
+        """
+        Points the latest index object to the run's snapshot
+
+        :param snapshot: dict with the base snapshot key and the keys of the deltas on top of it
+        :param run_id: identifier of the run
+
+        :returns:
+            bool: True if the index was saved
+        """
+        index = {"run_id": run_id,
+                 "base": snapshot["base"],
+                 "deltas": snapshot["deltas"],
+                 "updated_at": datetime.now().isoformat()}
+        self.s3.save_bytes(json.dumps(index, indent=2).encode(), self.trg_conf.trg_latest_key)
+        return True
+
+    # Distributed runs
+    def get_work_manifest(self, run_id: str) -> WorkManifest:
+        """
+        Creates the work manifest of a distributed run
+
+        :param run_id: identifier of the run
+
+        :returns:
+            WorkManifest: work manifest in trg_work_key
+        """
+        if not self.trg_conf.trg_work_key:
+            raise ValueError("trg_work_key must be configured for distributed runs")
+        return WorkManifest(storage=self.s3,
+                            prefix=self.trg_conf.trg_work_key,
+                            run_id=run_id,
+                            lease_seconds=self.trg_conf.trg_lease_seconds)
+
+    def create_sharded_run(self, run_id: str = None, ex_rates: dict = None) -> str:
+        """
+        Coordinator step of a distributed run. Splits the apps into shards and writes the
+        work manifest, along with the exchange rates and price regions every worker uses,
+        so that all the shards are parsed the same way. A distributed run always takes a
+        full snapshot
+
+        :param run_id: identifier of the run. None starts a new one
+        :param ex_rates: exchange rates already retrieved. None means they're requested
+
+        :returns:
+            str: identifier of the run, to be passed to the workers and the finalize step
+        """
+        run_id = run_id or datetime.now().strftime(RUN_ID_FORMAT)
+        if ex_rates is None:
+            ex_rates = self.get_currency_rates(self.src_conf.base_currency,
+                                               list(self.src_conf.ex_currencies.values()))
+        work = self.get_work_manifest(run_id)
+        if not work.create(app_ids=list(self.src_conf.videogames_appids),
+                           shard_size=self.src_conf.shard_size,
+                           ex_rates=ex_rates,
+                           price_regions=self.get_price_regions()):
+            self._logger.info(f"run {run_id} already has a work manifest, keeping it")
+        return run_id
+
+    def scrape_shard(self, work: WorkManifest, claim: ShardClaim) -> dict:
+        """
+        Requests and parses the prices of a shard's apps and saves them as the shard's part
+
+        :param work: work manifest of the run
+        :param claim: claim of the shard
+
+        :returns:
+            dict: keys of the part and the rejects saved. None for the ones without rows
+        """
+        manifest = work.load()
+        rejects = []
+        raw_prices = self.iter_prices_per_app(app_ids=claim.app_ids,
+                                              currencies=self.src_conf.ex_currencies,
+                                              max_workers=self.src_conf.max_workers,
+                                              batch_size=self.src_conf.batch_size,
+                                              price_regions=manifest["price_regions"])
+        chunks = self.iter_parsed_chunks(raw_prices,
+                                         ex_rates=manifest["ex_rates"],
+                                         chunk_size=self.trg_conf.trg_row_group_size,
+                                         rejects=rejects)
+        parquet_file = self.s3.write_df_chunks_to_parquet_file(chunks,
+                                                               schema=price_arrow_schema(self.trg_conf.trg_cols,
+                                                                                         self.trg_conf.trg_price_dtype))
+        # every lease generation writes its own files, a late worker never overwrites the ones marked done
+        files = {"part": None, "rejects": None}
+        if parquet_file is not None:
+            files["part"] = work.part_key(claim.shard_id, f"part-{claim.generation:05d}")
+            self.s3.upload_file(parquet_file, files["part"])
+        if rejects:
+            files["rejects"] = work.part_key(claim.shard_id, f"rejects-{claim.generation:05d}")
+            self.s3.save_df_to_parquet(pd.concat(rejects, ignore_index=True), files["rejects"])
+        return files
+
+    def run_shard_worker(self, run_id: str, worker_id: str, poll_seconds: float = 5) -> int:
+        """
+        Worker step of a distributed run. Claims and scrapes shards until every shard of
+        the run is done. When the remaining shards are leased to other workers it waits
+        for them, taking over the ones whose lease expires
+
+        :param run_id: identifier of the run
+        :param worker_id: identifier of the worker, unique among the run's workers
+        :param poll_seconds: seconds between claim attempts while waiting
+
+        :returns:
+            int: shards this worker completed
+        """
+        work = self.get_work_manifest(run_id)
+        completed = 0
+        while True:
+            claim = work.claim(worker_id)
+            if claim is None:
+                pending = work.pending_shards()
+                if not pending:
+                    break
+                self._logger.debug(f"{len(pending)} shards leased to other workers, waiting...")
+                time.sleep(poll_seconds)
+                continue
+            self._logger.info(f"worker {worker_id} claimed shard {claim.shard_id} ({len(claim.app_ids)} apps)")
+            with METRICS.timer("etl_stage_seconds", etl="steam_prices", stage="shard"):
+                files = self.scrape_shard(work, claim)
+            if work.complete(claim, worker_id, files):
+                completed += 1
+            else:
+                self._logger.warning(f"shard {claim.shard_id} was completed by another worker first")
+        self._logger.info(f"worker {worker_id} completed {completed} shards of run {run_id}")
+        return completed
+
+    def finalize_sharded_run(self, run_id: str) -> str:
+        """
+        Finalize step of a distributed run. Merges the shard parts into the run's snapshot,
+        appends them to the dataset and updates the manifest and the latest index as a
+        single process run does. The work files are deleted afterwards
+
+        :param run_id: identifier of the run
+
+        :returns:
+            str: key of the run's snapshot, without the .parquet suffix
+
+        :raises RuntimeError: if some shards aren't done yet
         """
-        ex_rates = self.get_currency_rates(self.src_conf.base_currency,
-                                           list(self.src_conf.ex_currencies.values()))
-        prices = self.get_prices_per_app(app_ids=self.src_conf.videogames_appids,
-                                         currencies=self.src_conf.ex_currencies,
-                                         ex_rates=ex_rates)
-        # fit data into dataframe
-        df = DataFrame(data=prices, columns=self.trg_conf.trg_cols)
-        print(df.to_parquet())
-        todays_date = datetime.now().strftime(self.trg_conf.trg_key_date_format)
-        filename = f'{self.trg_conf.trg_key}{self.trg_conf.trg_key_filename}{todays_date}'
-        # save it
-        self.save_as_parquet_to_s3(df=df,
-                                   filename=filename)
\ No newline at end of file
+        work = self.get_work_manifest(run_id)
+        pending = work.pending_shards()
+        if pending:
+            raise RuntimeError(f"run {run_id} has {len(pending)} shards left ({', '.join(pending[:10])})")
+        run_date = datetime.strptime(run_id, RUN_ID_FORMAT)
+        files = [shard_files["files"] for _, shard_files in sorted(work.completed_shards().items())]
+        # parts are read one at a time, so memory doesn't depend on the amount of shards
+        chunks = (pd.read_parquet(io.BytesIO(self.s3.get_bytes(shard_files["part"])))
+                  for shard_files in files if shard_files["part"])
+        rejects = [pd.read_parquet(io.BytesIO(self.s3.get_bytes(shard_files["rejects"])))
+                   for shard_files in files if shard_files["rejects"]]
+        dataset_writer = self.get_dataset_writer()
+        if dataset_writer:
+            chunks = self._iter_dataset_chunks(chunks, writer=dataset_writer, run_date=run_date)
+        with METRICS.timer("etl_stage_seconds", etl="steam_prices", stage="finalize"):
+            parquet_file = self.s3.write_df_chunks_to_parquet_file(chunks,
+                                                                   schema=price_arrow_schema(
+                                                                       self.trg_conf.trg_cols,
+                                                                       self.trg_conf.trg_price_dtype))
+            dataset_files = dataset_writer.close() if dataset_writer else {}
+        filename = f'{self.trg_conf.trg_key}{self.trg_conf.trg_key_filename}' \
+                   f'{run_date.strftime(self.trg_conf.trg_key_date_format)}'
+        refreshed_apps = {app for app_ids in work.load()["shards"].values() for app in app_ids}
+        self._load_run(parquet_file=parquet_file,
+                       dataset_files=dataset_files,
+                       filename=filename,
+                       rejects=rejects,
+                       manifest=self.load_manifest() if self.src_conf.incremental else None,
+                       is_delta=False,
+                       run_id=run_id,
+                       run_date=run_date,
+                       changes={"refreshed_apps": refreshed_apps, "sale_started": set(), "sale_ended": set()},
+                       checkpoint=None)
+        work.clear()
+        return filename
@@ -1,17 +1,19 @@
-import io
+import json
 import logging
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
 
-from babel.numbers import get_territory_currencies
 from Scripts.common.external_resources import S3Bucket
-from matplotlib.figure import Figure
+from Scripts.common.reference_cache import ReferenceDataCache
+from Scripts.common.country_index import CountryIndex, EURO_REGION
+from Scripts.common.metrics import METRICS
 from datetime import datetime
-from typing import NamedTuple
+from typing import NamedTuple, TYPE_CHECKING
 from pandas import DataFrame
 
+# map_renderer loads matplotlib, it's imported when maps are rendered
+if TYPE_CHECKING:
+    from Scripts.common.map_renderer import MapRenderer, MapJob
+
 class WorldMapETLSourceConfig(NamedTuple):
     """
     Object that represents the source configuration for
@@ -37,6 +39,16 @@ class WorldMapETLSourceConfig(NamedTuple):
     :param world_map_prices_plot_args: args to create the countries with price information geopandas plot
     :param divider_plot_args: args to create the price divider plot
     :param plot_args: args to create the empty canvas (plot) where all the maps are going to be drawn upon
+    :param parquet_latest_key: key of the index object SteamPricesETL updates with its latest snapshot.
+                               None (or a missing index) means the bucket is listed to find it
+    :param country_prices_app_col: col name for the app ids, used to apply incremental deltas
+    :param reference_cache_dir: local directory where the ISO-3166 lookup and the world map geometries
+                                are cached. None caches them in memory only
+    :param reference_cache_ttl_hours: hours the cached ISO-3166 lookup is valid for
+    :param map_groups: dict with group names (e.g. genres or single apps) as keys and lists of
+                       app ids as values. A map is rendered for each group besides the world map
+    :param render_max_workers: number of processes rendering maps
+    :param render_dpi: resolution of the rendered maps
 
     """
     parquet_key: str
@@ -60,6 +72,13 @@ class WorldMapETLSourceConfig(NamedTuple):
     world_map_prices_plot_args: dict
     divider_plot_args: dict
     plot_args: dict
+    parquet_latest_key: str = None
+    country_prices_app_col: str = 'app'
+    reference_cache_dir: str = None
+    reference_cache_ttl_hours: float = 168
+    map_groups: dict = None
+    render_max_workers: int = 1
+    render_dpi: int = 100
 
 
 class WorldMapETLTargetConfig(NamedTuple):
@@ -72,11 +91,15 @@ class WorldMapETLTargetConfig(NamedTuple):
     :param trg_key_date_format: the filename date format in target storage service
                             this one is appended to the filename at the end
     :param trg_format: the filename format for the data to be stored
+    :param trg_render_index_key: key of the object with the data hash and image key of the last
+                                 render of each map. Maps whose data hash didn't change aren't
+                                 rendered again. None renders every map on every run
     """
     trg_key: str
     trg_key_date_format: str
     trg_key_filename: str
     trg_format: str
+    trg_render_index_key: str = None
 
 class WorldMapETL:
 
@@ -88,24 +111,44 @@ class WorldMapETL:
     def __init__(self,
                  src_conf: WorldMapETLSourceConfig,
                  trg_conf: WorldMapETLTargetConfig,
-                 s3_bucket: S3Bucket):
+                 s3_bucket: S3Bucket,
+                 reference_cache: ReferenceDataCache = None,
+                 country_index: CountryIndex = None):
         """
         Constructor for WorldMapETL
 
         :param s3_bucket: connection to s3 bucket api
         :param src_conf: NamedTuple class with source configuration data
         :param trg_conf: NamedTuple class with target configuration data
+        :param reference_cache: cache for the ISO-3166 lookup and world map geometries. If None,
+                                one is created from the source configuration
+        :param country_index: country lookups shared with SteamPricesETL. If None, it's loaded
+                              from reference_cache
         """
         self.src_conf = src_conf
         self.trg_conf = trg_conf
         self.s3_bucket = s3_bucket
+        self.reference_cache = reference_cache or ReferenceDataCache(cache_dir=src_conf.reference_cache_dir,
+                                                                     ttl_hours=src_conf.reference_cache_ttl_hours)
+        self._country_index = country_index
         self._logger = logging.getLogger(__name__)
 
+    @property
+    def country_index(self) -> CountryIndex:
+        """
+        Country lookups (ALPHA-2, ALPHA-3, euro membership, etc.), loaded on first use
+        """
+        if self._country_index is None:
+            self._country_index = self.reference_cache.get_country_index(self.src_conf.iso_code_map_url,
+                                                                         alpha_2_col=self.src_conf.iso_code_map_alpha_2_col,
+                                                                         alpha_3_col=self.src_conf.iso_code_map_alpha_3_col)
+        return self._country_index
+
     def calculate_countries_averages(self, df: pd.DataFrame) -> DataFrame:
         """
         Calculates countries price deviation from world average
 
-        :param df: dataframe containing price data in usd.
+        :param df: dataframe containing price data in usd. It isn't modified
 
         :returns:
             DataFrame: df containing country codes in ALPHA-2 and
@@ -117,30 +160,25 @@ class WorldMapETL:
         perc_dif_col = self.src_conf.country_prices_perc_dif_col
         usd_dif_col = self.src_conf.country_prices_usd_dif_col
 
+        # country codes may be categorical, only the countries with prices are kept
         country_means_df = df[self.src_conf.country_prices_cols] \
-                                .groupby(country_prices_alpha_2) \
+                                .groupby(country_prices_alpha_2, observed=True) \
                                 .agg({usd_price_col: "mean"})
         worlds_average_price = df[usd_price_col].mean()
         country_means_df[perc_dif_col] = (country_means_df/worlds_average_price) - 1
         country_means_df[usd_dif_col] = country_means_df[perc_dif_col] * worlds_average_price
         country_means_df.reset_index(inplace=True)
-        country_means_df[country_prices_alpha_2].replace("uk", "gb", inplace=True)
-        country_means_df[country_prices_alpha_2] = country_means_df[country_prices_alpha_2].str.upper()
-        return country_means_df.copy()
+        country_means_df[country_prices_alpha_2] = country_means_df[country_prices_alpha_2].astype(str) \
+                                                                                           .replace("uk", "gb") \
+                                                                                           .str.upper()
+        return country_means_df
 
     def _get_alpha_3_from_2(self,
                             df: pd.DataFrame) -> pd.DataFrame:
-        iso_map_iso_alpha_2 = self.src_conf.iso_code_map_alpha_2_col
-        iso_map_iso_alpha_3 = self.src_conf.iso_code_map_alpha_3_col
         country_prices_alpha_2_col = self.src_conf.country_prices_alpha_2_col
         country_prices_alpha_3_col = self.src_conf.country_prices_alpha_3_col
-        # create a lookup table to map iso_2_codes and iso_3_codes
-        iso_lookup = pd.read_csv(self.src_conf.iso_code_map_url,
-                                 usecols=self.src_conf.iso_code_map_cols)
-        iso_lookup = iso_lookup.set_index(iso_map_iso_alpha_2)
-        # add a new column with iso_a2 codes to the world GeoDataFrame
-        df[country_prices_alpha_3_col] = df[country_prices_alpha_2_col] \
-                                         .apply(lambda x: iso_lookup.loc[x][iso_map_iso_alpha_3] if x in iso_lookup.index else None)
+        # add a new column with iso_a3 codes to the prices DataFrame
+        df[country_prices_alpha_3_col] = df[country_prices_alpha_2_col].map(self.country_index.alpha_3_by_alpha_2)
         return df
 
     def get_geospatial_df(self):
@@ -154,34 +192,19 @@ class WorldMapETL:
         # load conf args to prevent repetition
         world_iso_alpha_2 = self.src_conf.world_map_alpha_2_col
         world_iso_alpha_3 = self.src_conf.world_map_alpha_3_col
-        iso_map_iso_alpha_2 = self.src_conf.iso_code_map_alpha_2_col
-        iso_map_iso_alpha_3 = self.src_conf.iso_code_map_alpha_3_col
 
-        # load world map
-        world = gpd.read_file(gpd.datasets.get_path(self.src_conf.world_map_geopandas))
-        # create a lookup table to map iso_2_codes and iso_3_codes
-        iso_lookup = pd.read_csv(self.src_conf.iso_code_map_url,
-                                 usecols=self.src_conf.iso_code_map_cols)
-        iso_lookup = iso_lookup.set_index(iso_map_iso_alpha_3)
+        # load world map, the cached one is shared so columns are added to a copy
+        world = self.reference_cache.get_world_geometries(self.src_conf.world_map_geopandas).copy()
 
         # add a new column with iso_a2 codes to the world GeoDataFrame
-        world[world_iso_alpha_2] = world[world_iso_alpha_3] \
-                                   .apply(lambda x: iso_lookup.loc[x][iso_map_iso_alpha_2] if x in iso_lookup.index else None)
+        world[world_iso_alpha_2] = world[world_iso_alpha_3].map(self.country_index.alpha_2_by_alpha_3)
 
-        # map european countries under the same iso code for ease of data processing
-        european_countries_iso_codes = world[world["continent"] == "Europe"][world_iso_alpha_2]
-        euro_countries = []
-        for i, country_iso_code in european_countries_iso_codes.items():
-            if country_iso_code:
-                euro_country = get_territory_currencies(country_iso_code)
-                if euro_country[0].lower() == "eur":
-                    euro_countries.append(country_iso_code.lower())
+        # map european euro countries under the same iso code for ease of data processing,
+        # so that they can be joined with the world_prices_df
+        is_euro = world[world_iso_alpha_2].map(self.country_index.is_euro_by_alpha_2).fillna(False).astype(bool)
+        world.loc[is_euro & (world["continent"] == "Europe"), world_iso_alpha_2] = EURO_REGION
 
-        # change euro countries' iso_2 code to EU so that they can be joined with the world_prices_df
-        world[world_iso_alpha_2] = world[world_iso_alpha_2][~world[world_iso_alpha_2].isna()] \
-                                   .apply(lambda country_code: "EU" if country_code.lower() in euro_countries else country_code)
-
-        return world.copy()
+        return world
 
     def _merge_geodata_with_prices(self,
                                    country_price_df: DataFrame,
@@ -207,94 +230,169 @@ class WorldMapETL:
                                         left_on=world_iso_alpha_3,
                                         right_on=country_prices_alpha_3)
         # propagate price across EU countries
-        eu_price = merged_df[merged_df[world_iso_alpha_2] == "EU"][usd_dif_col].max()
-        merged_df.loc[merged_df[world_iso_alpha_2] == "EU", usd_dif_col] = eu_price
-        return merged_df.copy()
+        eu_price = merged_df[merged_df[world_iso_alpha_2] == EURO_REGION][usd_dif_col].max()
+        merged_df.loc[merged_df[world_iso_alpha_2] == EURO_REGION, usd_dif_col] = eu_price
+        return merged_df
+
+    def get_renderer(self, geospatial_df: DataFrame) -> "MapRenderer":
+        """
+        Creates the renderer of the maps, its base layer is shared by every map
 
-    def get_world_map(self, merged_df: pd.DataFrame) -> Figure:
+        :param geospatial_df: df returned by get_geospatial_df
+
+        :returns:
+            MapRenderer: renderer for the geospatial_df countries
         """
-        Generates world map. ETL step, this is not the builder
+        from Scripts.common.map_renderer import MapRenderer, MapStyle
+        style = MapStyle(value_col=self.src_conf.color_bar_min_max,
+                         plot_args=self.src_conf.plot_args,
+                         color_bar_args=self.src_conf.color_bar_args,
+                         missing_countries_plot_args=self.src_conf.missing_countries_plot_args,
+                         world_map_prices_plot_args=self.src_conf.world_map_prices_plot_args,
+                         divider_plot_args=self.src_conf.divider_plot_args,
+                         dpi=self.src_conf.render_dpi)
+        return MapRenderer(geospatial_df, style)
+
+    def get_map_job(self,
+                    name: str,
+                    title: str,
+                    df: DataFrame,
+                    geospatial_df: DataFrame) -> "MapJob":
+        """
+        Calculates the values of a map. ETL step, this is not the builder
         method. Using it directly is not recommended.
 
-        :param merged_df: df containing geospatial data and
-                          usd difference from world average.
+        :param name: map name
+        :param title: plot title
+        :param df: df containing price data in usd
+        :param geospatial_df: df returned by get_geospatial_df
 
         :returns:
-            Figure: Matplotlib object representation of a world map
-                    representing price data.
+            MapJob: map with the usd difference from world average of each geospatial_df country
         """
-        # load conf args to prevent repetition
-        usd_dif_col = self.src_conf.color_bar_min_max
-
-        missing_countries = gpd.read_file(gpd.datasets.get_path(self.src_conf.world_map_geopandas))
-        missing_countries["steam_value"] = 0
-        # Create a custom colormap that ranges from green to red
-        cmap = colors.LinearSegmentedColormap.from_list(**self.src_conf.color_bar_args)
-
-        # Normalize the data using vmin and vmax
-        norm = colors.Normalize(vmin=merged_df[usd_dif_col].min(), vmax=merged_df[usd_dif_col].max())
-        # Create a large plot
-        fig, ax = plt.subplots(**self.src_conf.plot_args)
-
-        from mpl_toolkits.axes_grid1 import make_axes_locatable
-
-        # We make the legend as small and thin as possible
-        divider = make_axes_locatable(ax)
-        cax = divider.append_axes(**self.src_conf.divider_plot_args)
-
-        # we display the missing country data and the countries with data will be overriden by the merged_df plot
-        missing_countries.plot(ax=ax, **self.src_conf.missing_countries_plot_args)
-        merged_df.plot(ax=ax,
-                       cmap=cmap,
-                       norm=norm,
-                       cax=cax,
-                       **self.src_conf.world_map_prices_plot_args)
-        ax.set_axis_off()
-        ax.set_title(self.src_conf.plot_title)
-        return ax.get_figure()
-
-    def save_current_fig(self,
-                         fig: Figure,
-                         filename: str,
-                         format="png") -> bool:
+        from Scripts.common.map_renderer import MapJob
+        prices_df = self._get_alpha_3_from_2(self.calculate_countries_averages(df))
+        # a left merge keeps the geospatial_df rows, so values line up with the renderer geometries
+        merged_df = self._merge_geodata_with_prices(country_price_df=prices_df,
+                                                    geospatial_df=geospatial_df)
+        return MapJob(name=name,
+                      title=title,
+                      values=merged_df[self.src_conf.color_bar_min_max].to_numpy(dtype="float64"))
+
+    def get_map_jobs(self, df: DataFrame, geospatial_df: DataFrame) -> list:
         """
-        Saves figure to external storage service
+        Builds the world map job and one job per configured map group
 
-        :param fig: matplotlib Figure representing world map.
-        :param filename: string with the filename the file will be stored in.
-                         DO NOT ADD THE DATA TYPE SUFFIX (.png)
-        :param format: file format. Supported formats: PNG
+        :param df: df containing price data in usd
+        :param geospatial_df: df returned by get_geospatial_df
 
+        :returns:
+            list: MapJob list, the world map first
+        """
+        jobs = [self.get_map_job("world", self.src_conf.plot_title, df, geospatial_df)]
+        app_col = self.src_conf.country_prices_app_col
+        if self.src_conf.map_groups and app_col not in df.columns:
+            self._logger.warning(f"prices have no {app_col} col, map groups are skipped")
+            return jobs
+        for group, app_ids in (self.src_conf.map_groups or {}).items():
+            group_df = df[df[app_col].isin(app_ids)]
+            if group_df.empty:
+                self._logger.warning(f"no prices for the {group} map")
+                continue
+            jobs.append(self.get_map_job(group, f"{self.src_conf.plot_title} ({group})", group_df, geospatial_df))
+        return jobs
+
+    def load_render_index(self) -> dict:
+        """
+        Reads the data hash and image key of the last render of each map
 
         :returns:
-            bool: returns true if code was executed successfully
+            dict: map names as keys and dicts with hash and key as values
         """
-        self.s3_bucket.save_fig_to_png(fig, filename+"."+format)
-        return True
+        if not self.trg_conf.trg_render_index_key:
+            return {}
+        index = self.s3_bucket.get_bytes(self.trg_conf.trg_render_index_key)
+        return json.loads(index) if index is not None else {}
 
-    def generate_world_map_image(self):
+    def _read_parquet(self, key: str, columns: list) -> DataFrame:
+        # only the footer and the chunks of the price columns are downloaded
+        self._logger.info(f"Downloading {columns} of {key}...")
+        return self.s3_bucket.read_parquet(key, columns=columns)
+
+    def get_latest_prices(self) -> DataFrame:
+        """
+        Reads the latest prices saved by SteamPricesETL. The index object is used
+        when there's one, otherwise the bucket is listed to find the last file
+
+        :returns:
+            DataFrame: df containing price data in usd
+        """
+        app_col = self.src_conf.country_prices_app_col
+        columns = [app_col] + list(self.src_conf.country_prices_cols)
+        index = None
+        if self.src_conf.parquet_latest_key:
+            index = self.s3_bucket.get_bytes(self.src_conf.parquet_latest_key)
+        if index is None:
+            self._logger.info(f"Looking up last file in {self.src_conf.parquet_key}")
+            last_processed_file = self.s3_bucket.get_bucket_filenames(bucket_name=self.s3_bucket.bucket_name,
+                                                                      prefix=self.src_conf.parquet_key)[0]
+            return self._read_parquet(last_processed_file, columns=columns)
+        index = json.loads(index)
+        if not index["deltas"]:
+            return self._read_parquet(index["base"], columns=columns)
+        # apply the incremental deltas on top of the base snapshot
+        snapshots = [self._read_parquet(key, columns=columns) for key in [index["base"]] + index["deltas"]]
+        return pd.concat(snapshots, ignore_index=True) \
+                 .drop_duplicates(subset=[app_col, self.src_conf.country_prices_alpha_2_col], keep="last")
+
+    def generate_world_map_image(self,
+                                 prices_df: DataFrame = None,
+                                 geospatial_df: DataFrame = None):
         """
-        Builds world map image for different countries and saves it to
-        external storage service
+        Builds world map image for different countries (plus one per map group) and
+        saves them to external storage service. Maps whose data didn't change since
+        their last render are skipped
+
+        :param prices_df: df containing price data in usd handed over in memory by
+                          SteamPricesETL. If None, the latest prices are read from
+                          the external storage service
+        :param geospatial_df: df returned by get_geospatial_df, if it was already built
+                              (e.g. by another pipeline stage)
         """
-        self._logger.info(f"Looking up last file in {self.src_conf.parquet_key}")
-        last_processed_file = self.s3_bucket.get_bucket_filenames(bucket_name=self.s3_bucket.bucket_name,
-                                                                  prefix=self.src_conf.parquet_key)[0]
-        self._logger.info(f"Downloading {last_processed_file}...")
-        f = io.BytesIO()
-        self.s3_bucket.s3_session.download_fileobj(self.s3_bucket.bucket_name,
-                                                   last_processed_file,
-                                                   f)
-        df = pd.read_parquet(f)
-        prices_df = self.calculate_countries_averages(df.copy())
-        prices_df = self._get_alpha_3_from_2(prices_df.copy())
-        world_map_df = self.get_geospatial_df()
-        merged_df = self._merge_geodata_with_prices(country_price_df=prices_df.copy(),
-                                                    geospatial_df=world_map_df.copy())
-        fig = self.get_world_map(merged_df=merged_df.copy())
+        # every step builds a new df from its input instead of modifying it, so no copies are needed
+        with METRICS.timer("etl_stage_seconds", etl="world_map", stage="read_prices"):
+            df = prices_df if prices_df is not None else self.get_latest_prices()
+        with METRICS.timer("etl_stage_seconds", etl="world_map", stage="geodata"):
+            world_map_df = geospatial_df if geospatial_df is not None else self.get_geospatial_df()
+        with METRICS.timer("etl_stage_seconds", etl="world_map", stage="aggregate"):
+            jobs = self.get_map_jobs(df, world_map_df)
+
+        render_index = self.load_render_index()
+        changed_jobs = [job for job in jobs
+                        if render_index.get(job.name, {}).get("hash") != job.data_hash()]
+        changed_names = {job.name for job in changed_jobs}
+        for job in jobs:
+            if job.name not in changed_names:
+                self._logger.info(f"{job.name} map data didn't change, "
+                                  f"keeping {render_index[job.name]['key']}")
+        METRICS.inc("maps_skipped_total", len(jobs) - len(changed_jobs))
+        if not changed_jobs:
+            return
+        with METRICS.timer("etl_stage_seconds", etl="world_map", stage="render"):
+            images = self.get_renderer(world_map_df).render_many(changed_jobs,
+                                                                 max_workers=self.src_conf.render_max_workers)
+        METRICS.inc("maps_rendered_total", len(changed_jobs))
 
         todays_date = datetime.now().strftime(self.trg_conf.trg_key_date_format)
-        filename = f'{self.trg_conf.trg_key}{self.trg_conf.trg_key_filename}{todays_date}'
-        self.save_current_fig(fig=fig,
-                              filename=filename,
-                              format=self.trg_conf.trg_format)
+        with METRICS.timer("etl_stage_seconds", etl="world_map", stage="upload"):
+            uploads = {}
+            for job in changed_jobs:
+                folder = self.trg_conf.trg_key if job.name == "world" else f"{self.trg_conf.trg_key}{job.name}/"
+                key = f'{folder}{self.trg_conf.trg_key_filename}{todays_date}.{self.trg_conf.trg_format}'
+                uploads[key] = images[job.name]
+                render_index[job.name] = {"hash": job.data_hash(), "key": key}
+            self.s3_bucket.upload_many(uploads)
+        self._logger.info(f"{len(changed_jobs)} of {len(jobs)} maps rendered")
+        if self.trg_conf.trg_render_index_key:
+            self.s3_bucket.save_bytes(json.dumps(render_index, indent=2).encode(),
+                                      self.trg_conf.trg_render_index_key)
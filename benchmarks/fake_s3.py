@@ -0,0 +1,300 @@
+import io
+import os
+import uuid
+import logging
+import threading
+
+from Scripts.common.external_resources import S3Bucket, S3TransferConfig
+from botocore.session import get_session
+from botocore.validate import validate_parameters
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _input_shape(operation_name: str):
+    return get_session().get_service_model("s3").operation_model(operation_name).input_shape
+
+
+def _validate(operation_name: str, params: dict):
+    """
+    Checks request parameters against the installed botocore's S3 model, so that
+    parameters botocore doesn't know fail with its ParamValidationError like on a real client
+    """
+    validate_parameters(params, _input_shape(operation_name))
+
+
+class _ClientError(Exception):
+
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class _NoSuchKey(_ClientError):
+
+    def __init__(self, key: str):
+        super().__init__("NoSuchKey")
+        self.key = key
+
+
+class _Exceptions:
+    NoSuchKey = _NoSuchKey
+    ClientError = _ClientError
+
+
+class _ListObjectsV2Paginator:
+
+    def __init__(self, client: "InMemoryS3Client", page_size: int = 1000):
+        self.client = client
+        self.page_size = page_size
+
+    def paginate(self, Bucket: str, Prefix: str = "", Delimiter: str = None, **kwargs):
+        kwargs.pop("PaginationConfig", None)
+        _validate("ListObjectsV2", dict(kwargs, Bucket=Bucket, Prefix=Prefix,
+                                        **({"Delimiter": Delimiter} if Delimiter else {})))
+        objects = self.client.list_objects(Bucket)
+        contents, common_prefixes = [], set()
+        for key, (size, last_modified) in sorted(objects.items()):
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefixes.add(Prefix + rest.split(Delimiter, 1)[0] + Delimiter)
+                continue
+            contents.append({"Key": key, "LastModified": last_modified, "Size": size})
+        for start in range(0, max(len(contents), 1), self.page_size):
+            page = {"Contents": contents[start:start + self.page_size]}
+            if start == 0 and common_prefixes:
+                page["CommonPrefixes"] = [{"Prefix": prefix} for prefix in sorted(common_prefixes)]
+            yield page
+
+
+class InMemoryS3Client:
+
+    """
+    In-process stand-in for the subset of the boto3 S3 client S3Bucket uses.
+    Objects live in a dict, so benchmarks measure the pipeline and not the network.
+    Parameters the installed botocore doesn't know are rejected like a real client does
+    """
+
+    exceptions = _Exceptions
+
+    def __init__(self):
+        self._buckets = {}
+        self.lock = threading.Lock()
+        # objects get strictly increasing modification dates, so that listings sort deterministically
+        self._clock = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.stats = {"put": 0, "get": 0, "list": 0, "delete": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def objects_of(self, bucket: str) -> dict:
+        return self._buckets.setdefault(bucket, {})
+
+    def list_objects(self, bucket: str) -> dict:
+        """
+        Snapshot of the bucket, keys as keys and their size and modification date as values
+        """
+        with self.lock:
+            return {key: (len(data), last_modified) for key, (data, last_modified) in self.objects_of(bucket).items()}
+
+    def _put(self, bucket: str, key: str, data: bytes, if_none_match: str = None):
+        with self.lock:
+            if if_none_match == "*" and key in self.objects_of(bucket):
+                raise _ClientError("PreconditionFailed")
+            self._clock += timedelta(milliseconds=1)
+            self.objects_of(bucket)[key] = (data, self._clock)
+            self.stats["put"] += 1
+            self.stats["bytes_in"] += len(data)
+
+    def _get(self, bucket: str, key: str, byte_range: slice = slice(None)) -> bytes:
+        with self.lock:
+            if key not in self.objects_of(bucket):
+                raise _NoSuchKey(key)
+            data = self.objects_of(bucket)[key][0][byte_range]
+            self.stats["get"] += 1
+            self.stats["bytes_out"] += len(data)
+            return data
+
+    def put_object(self, Bucket: str, Key: str, Body, IfNoneMatch: str = None, **kwargs):
+        _validate("PutObject", dict(kwargs, Bucket=Bucket, Key=Key, Body=Body,
+                                    **({"IfNoneMatch": IfNoneMatch} if IfNoneMatch else {})))
+        self._put(Bucket, Key, Body if isinstance(Body, bytes) else Body.read(), if_none_match=IfNoneMatch)
+        return {}
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None, **kwargs):
+        _validate("GetObject", dict(kwargs, Bucket=Bucket, Key=Key, **({"Range": Range} if Range else {})))
+        byte_range = slice(None)
+        if Range:
+            start, end = Range.replace("bytes=", "").split("-")
+            if start == "":
+                byte_range = slice(-int(end), None)
+            else:
+                byte_range = slice(int(start), int(end) + 1 if end else None)
+        # only the bytes of the range count as downloaded
+        data = self._get(Bucket, Key, byte_range)
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        _validate("HeadObject", dict(kwargs, Bucket=Bucket, Key=Key))
+        data, last_modified = self.objects_of(Bucket).get(Key, (None, None))
+        if data is None:
+            # like S3, HEAD answers a missing key with a bare 404
+            raise _ClientError("404")
+        return {"ContentLength": len(data), "LastModified": last_modified}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs: dict = None, Callback=None, Config=None):
+        self._put(Bucket, Key, Fileobj.read())
+
+    def download_fileobj(self, Bucket: str, Key: str, Fileobj, ExtraArgs: dict = None, Callback=None, Config=None):
+        Fileobj.write(self._get(Bucket, Key))
+        Fileobj.seek(0)
+
+    def get_paginator(self, operation_name: str) -> _ListObjectsV2Paginator:
+        assert operation_name == "list_objects_v2", f"{operation_name} isn't supported"
+        with self.lock:
+            self.stats["list"] += 1
+        return _ListObjectsV2Paginator(self)
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs):
+        _validate("DeleteObjects", dict(kwargs, Bucket=Bucket, Delete=Delete))
+        with self.lock:
+            for item in Delete["Objects"]:
+                self.objects_of(Bucket).pop(item["Key"], None)
+                self.stats["delete"] += 1
+        return {}
+
+
+class InMemoryS3Bucket(S3Bucket):
+
+    """
+    S3Bucket backed by an InMemoryS3Client instead of a boto3 session, so every
+    S3Bucket method runs its real code against an in-process store
+    """
+
+    def __init__(self,
+                 bucket_name: str = "benchmark",
+                 client: InMemoryS3Client = None,
+                 transfer_config: dict = None):
+        """
+        Constructor for InMemoryS3Bucket
+
+        :param bucket_name: S3 bucket name
+        :param client: store shared with other buckets. None creates an empty one
+        :param transfer_config: S3TransferConfig fields. None keeps the defaults
+        """
+        self._logger = logging.getLogger(__name__)
+        self.endpoint_url = None
+        self.region_name = None
+        self.bucket_name = bucket_name
+        self.transfer_config = S3TransferConfig(**(transfer_config or {}))
+        self.session = None
+        self.s3_session = client or InMemoryS3Client()
+        # the in-process store transfers objects whole
+        self._transfer_args = {}
+
+
+class LocalDirS3Client(InMemoryS3Client):
+
+    """
+    Stand-in for the boto3 S3 client that keeps objects as files under a directory,
+    so that several processes (e.g. the workers of a distributed run) share a bucket.
+    Conditional writes are atomic across processes
+    """
+
+    def __init__(self, root_dir: str):
+        """
+        Constructor for LocalDirS3Client
+
+        :param root_dir: directory with a folder per bucket
+        """
+        super().__init__()
+        self.root_dir = root_dir
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root_dir, bucket, *key.split("/"))
+
+    def list_objects(self, bucket: str) -> dict:
+        objects = {}
+        bucket_dir = os.path.join(self.root_dir, bucket)
+        for dir_path, _, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(dir_path, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # deleted by another process while listing
+                    continue
+                key = os.path.relpath(path, bucket_dir).replace(os.sep, "/")
+                objects[key] = (stat.st_size, datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc))
+        return objects
+
+    def _put(self, bucket: str, key: str, data: bytes, if_none_match: str = None):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        try:
+            if if_none_match == "*":
+                # linking fails if the object exists, whichever process links first wins
+                os.link(tmp_path, path)
+            else:
+                os.replace(tmp_path, path)
+        except FileExistsError:
+            raise _ClientError("PreconditionFailed")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self.lock:
+            self.stats["put"] += 1
+            self.stats["bytes_in"] += len(data)
+
+    def _get(self, bucket: str, key: str, byte_range: slice = slice(None)) -> bytes:
+        try:
+            with open(self._path(bucket, key), "rb") as f:
+                data = f.read()[byte_range]
+        except FileNotFoundError:
+            raise _NoSuchKey(key)
+        with self.lock:
+            self.stats["get"] += 1
+            self.stats["bytes_out"] += len(data)
+        return data
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        _validate("HeadObject", dict(kwargs, Bucket=Bucket, Key=Key))
+        try:
+            stat = os.stat(self._path(Bucket, Key))
+        except FileNotFoundError:
+            raise _ClientError("404")
+        return {"ContentLength": stat.st_size,
+                "LastModified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)}
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs):
+        _validate("DeleteObjects", dict(kwargs, Bucket=Bucket, Delete=Delete))
+        for item in Delete["Objects"]:
+            try:
+                os.remove(self._path(Bucket, item["Key"]))
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.stats["delete"] += 1
+        return {}
+
+
+class LocalDirS3Bucket(InMemoryS3Bucket):
+
+    """
+    S3Bucket backed by a LocalDirS3Client, so processes creating one on the same
+    directory share the bucket
+    """
+
+    def __init__(self, root_dir: str, bucket_name: str = "benchmark"):
+        """
+        Constructor for LocalDirS3Bucket
+
+        :param root_dir: directory the objects are kept in
+        :param bucket_name: S3 bucket name
+        """
+        super().__init__(bucket_name=bucket_name, client=LocalDirS3Client(root_dir))
@@ -0,0 +1,205 @@
+import re
+import json
+import time
+import random
+import zlib
+import threading
+
+from Scripts.common.currency_formats import STEAM_CURRENCY_FORMATS, PRICE_NUMBER_PATTERN
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeApiServer:
+
+    """
+    Local HTTP server answering GET requests with the JSON returned by a
+    replay function, with configurable latency, server errors and throttling
+    (429 with Retry-After). It runs in a background thread
+    """
+
+    def __init__(self,
+                 replay,
+                 latency_ms: float = 0,
+                 latency_jitter_ms: float = 0,
+                 error_rate: float = 0,
+                 throttle_rate: float = 0,
+                 retry_after: float = 1,
+                 seed: int = 0):
+        """
+        Constructor for FakeApiServer
+
+        :param replay: function receiving the request path and query params (dict of lists)
+                       and returning the response body as a dict
+        :param latency_ms: delay before every response
+        :param latency_jitter_ms: random delay added to latency_ms
+        :param error_rate: fraction of requests answered with a 500
+        :param throttle_rate: fraction of requests answered with a 429
+        :param retry_after: seconds sent in the Retry-After header of the 429s
+        :param seed: seed of the random failures, so that runs are comparable
+        """
+        self.replay = replay
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0}
+        self._server = None
+        self._thread = None
+
+    def _outcome(self) -> tuple:
+        with self._lock:
+            self.stats["requests"] += 1
+            roll = self._random.random()
+            delay = (self.latency_ms + self._random.random() * self.latency_jitter_ms) / 1000
+            if roll < self.throttle_rate:
+                self.stats["throttled"] += 1
+                return 429, delay
+            if roll < self.throttle_rate + self.error_rate:
+                self.stats["errors"] += 1
+                return 500, delay
+            return 200, delay
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, delay = server._outcome()
+                time.sleep(delay)
+                headers = {"Content-Type": "application/json"}
+                if status == 429:
+                    headers["Retry-After"] = f"{server.retry_after:g}"
+                    body = b"{}"
+                elif status == 500:
+                    body = b"{}"
+                else:
+                    url = urlparse(self.path)
+                    body = json.dumps(server.replay(url.path, parse_qs(url.query))).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakeApiServer":
+        """
+        Starts serving on a free local port
+        """
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving and closes the socket
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def _format_price(value: float, currency: str) -> str:
+    fmt = STEAM_CURRENCY_FORMATS[currency]
+    whole, decimals = f"{value:,.2f}".split(".")
+    return f"{whole.replace(',', fmt.thousands_sep)}{fmt.decimal_sep}{decimals}"
+
+
+class SteamAppdetailsReplay:
+
+    """
+    Replays recorded appdetails responses. Apps that weren't recorded get the
+    recorded price of their country scaled by a factor derived from the app id,
+    formatted the way steam formats that currency, so any amount of apps can be
+    requested
+    """
+
+    def __init__(self, recorded: dict, free_app_rate: float = 0.05):
+        """
+        Constructor for SteamAppdetailsReplay
+
+        :param recorded: dict with country codes as keys and appdetails responses as values
+        :param free_app_rate: fraction of the unrecorded apps answered as free (no price data)
+        """
+        self.recorded = recorded
+        self.free_app_rate = free_app_rate
+        self._templates = {}
+        for cc, apps in recorded.items():
+            for app_data in apps.values():
+                data = app_data.get("data")
+                if isinstance(data, dict) and "price_overview" in data:
+                    overview = data["price_overview"]
+                    template = re.sub(PRICE_NUMBER_PATTERN, "{}", overview["final_formatted"], count=1)
+                    self._templates[cc] = (overview["currency"], overview["final"] / 100, template)
+                    break
+
+    def app_response(self, app_id: str, cc: str) -> dict:
+        """
+        Returns the appdetails response of a single app in a country
+        """
+        recorded = self.recorded.get(cc, {}).get(app_id)
+        if recorded is not None:
+            return recorded
+        currency, base_price, template = self._templates.get(cc, ("USD", 49.99, "${}"))
+        # crc32 is stable between runs, unlike hash()
+        factor = zlib.crc32(app_id.encode()) / 0xFFFFFFFF
+        if factor < self.free_app_rate:
+            return {"success": True, "data": []}
+        price = round(base_price * (0.1 + 1.9 * factor), 2)
+        return {"success": True,
+                "data": {"price_overview": {"currency": currency,
+                                            "initial": int(round(price * 100)),
+                                            "final": int(round(price * 100)),
+                                            "discount_percent": 0,
+                                            "initial_formatted": "",
+                                            "final_formatted": template.format(_format_price(price, currency))}}}
+
+    def __call__(self, path: str, query: dict) -> dict:
+        cc = query.get("cc", ["us"])[0].lower()
+        app_ids = query.get("appids", [""])[0].split(",")
+        return {app_id: self.app_response(app_id, cc) for app_id in app_ids if app_id}
+
+
+class ExRatesReplay:
+
+    """
+    Replays a recorded OpenExchangeRates latest.json response, keeping only the
+    requested symbols
+    """
+
+    def __init__(self, recorded: dict):
+        """
+        Constructor for ExRatesReplay
+
+        :param recorded: latest.json response
+        """
+        self.recorded = recorded
+
+    def __call__(self, path: str, query: dict) -> dict:
+        symbols = query.get("symbols", [""])[0].split(",")
+        rates = self.recorded["rates"]
+        return dict(self.recorded, rates={symbol: rates[symbol] for symbol in symbols if symbol in rates})
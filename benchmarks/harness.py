@@ -0,0 +1,181 @@
+import sys
+import json
+import math
+import time
+import threading
+import tracemalloc
+
+from itertools import product
+from typing import NamedTuple
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is traced with tracemalloc there
+    resource = None
+
+
+class BenchmarkResult(NamedTuple):
+    """
+    Measurements of a benchmark case
+
+    :param scenario: scenario name
+    :param params: scenario params of the case
+    :param seconds: wall time of the measured step
+    :param items: rows processed by the measured step
+    :param throughput: items per second
+    :param p50_ms: median latency of the requests to the fake apis. None if there were none
+    :param p99_ms: 99th percentile latency of the requests to the fake apis. None if there were none
+    :param peak_mem_mb: peak memory of the process running the case
+    :param requests: requests served by the fake apis
+    :param throttled: requests answered with a 429
+    :param errors: requests answered with a 500
+    """
+    scenario: str
+    params: dict
+    seconds: float
+    items: int
+    throughput: float
+    p50_ms: float
+    p99_ms: float
+    peak_mem_mb: float
+    requests: int = 0
+    throttled: int = 0
+    errors: int = 0
+
+    @property
+    def case_id(self) -> str:
+        return f"{self.scenario}[{','.join(f'{k}={v}' for k, v in sorted(self.params.items()))}]"
+
+
+class LatencyRecorder:
+
+    """
+    Records the latency of every response received by a requests Session
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies_ms = []
+
+    def attach(self, session):
+        """
+        Adds a response hook to session
+        """
+        session.hooks["response"].append(self._record)
+
+    def _record(self, response, *args, **kwargs):
+        with self._lock:
+            self.latencies_ms.append(response.elapsed.total_seconds() * 1000)
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Nearest-rank percentile
+
+    :param values: measurements
+    :param q: percentile, between 0 and 100
+
+    :returns:
+        float: the percentile. None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(q / 100 * len(ordered))) - 1]
+
+
+def timed(func, *args, **kwargs) -> tuple:
+    """
+    Runs func and measures its wall time
+
+    :returns:
+        tuple: func result and seconds it took
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def start_memory_tracking():
+    """
+    Starts tracing allocations when the peak RSS of the process isn't available
+    """
+    if resource is None:
+        tracemalloc.start()
+
+
+def peak_memory_mb() -> float:
+    """
+    Peak memory of the current process. Each case runs in its own process, so
+    this is the peak of the case
+    """
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KiB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def expand_cases(scenario_config: dict) -> list:
+    """
+    Expands a scenario into its cases, one per combination of its list params
+
+    :param scenario_config: scenario params, the ones with a list of values are scaled
+
+    :returns:
+        list: dicts with the params of each case
+    """
+    params = {key: value for key, value in scenario_config.items() if key != "kind"}
+    scaled = {key: value for key, value in params.items() if isinstance(value, list)}
+    cases = []
+    for values in product(*scaled.values()):
+        cases.append(dict(params, **dict(zip(scaled.keys(), values))))
+    return cases
+
+
+def format_report(results: list, baseline: dict = None, tolerance: float = 0.1) -> tuple:
+    """
+    Formats the results as a table, comparing them with a baseline report
+
+    :param results: list of BenchmarkResult
+    :param baseline: dict with case ids as keys and BenchmarkResult dicts as values. None skips
+                     the comparison
+    :param tolerance: relative change of throughput, p99 latency or peak memory reported as
+                      a regression
+
+    :returns:
+        tuple: report text and list of the case ids that regressed
+    """
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else "-"
+
+    lines = [f"{'case':<60} {'seconds':>9} {'items/s':>11} {'p50 ms':>8} {'p99 ms':>8} "
+             f"{'peak MB':>8} {'reqs':>6} {'429s':>5} {'5xx':>5}"]
+    regressions = []
+    for result in results:
+        line = (f"{result.case_id:<60} {result.seconds:>9.2f} {fmt(result.throughput, '>11.1f')} "
+                f"{fmt(result.p50_ms, '>8.1f')} {fmt(result.p99_ms, '>8.1f')} {result.peak_mem_mb:>8.1f} "
+                f"{result.requests:>6} {result.throttled:>5} {result.errors:>5}")
+        previous = (baseline or {}).get(result.case_id)
+        if previous:
+            changes = []
+            if previous["throughput"] and result.throughput < previous["throughput"] * (1 - tolerance):
+                changes.append(f"throughput {previous['throughput']:.1f} -> {result.throughput:.1f}")
+            if previous["p99_ms"] and result.p99_ms and result.p99_ms > previous["p99_ms"] * (1 + tolerance):
+                changes.append(f"p99 {previous['p99_ms']:.1f} -> {result.p99_ms:.1f}ms")
+            if result.peak_mem_mb > previous["peak_mem_mb"] * (1 + tolerance):
+                changes.append(f"peak memory {previous['peak_mem_mb']:.1f} -> {result.peak_mem_mb:.1f}MB")
+            if changes:
+                regressions.append(result.case_id)
+                line += f"  REGRESSION: {'; '.join(changes)}"
+        lines.append(line)
+    return "\n".join(lines), regressions
+
+
+def save_report(results: list, path: str):
+    """
+    Saves the results as JSON, keyed by case id, so that it can be used as a baseline
+    """
+    with open(path, "w") as f:
+        json.dump({result.case_id: dict(result._asdict()) for result in results}, f, indent=2)
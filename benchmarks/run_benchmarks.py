@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import yaml
+import logging
+import argparse
+import multiprocessing
+
+from benchmarks.harness import (BenchmarkResult,
+                                expand_cases,
+                                format_report,
+                                save_report,
+                                percentile,
+                                peak_memory_mb,
+                                start_memory_tracking)
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), "benchmark_config.yml")
+
+
+def run_case(scenario: str, kind: str, params: dict, config: dict) -> BenchmarkResult:
+    """
+    Runs a benchmark case. It's meant to run in a fresh process, so that the
+    peak memory is the case's alone
+    """
+    logging.basicConfig(level=config.get("log_level", "WARNING"))
+    start_memory_tracking()
+    # imported here so that the import time and memory aren't shared between cases
+    from benchmarks.scenarios import SCENARIO_KINDS
+    measures = SCENARIO_KINDS[kind](params, config)
+    latencies = measures.get("latencies_ms", [])
+    return BenchmarkResult(scenario=scenario,
+                           params=params,
+                           seconds=measures["seconds"],
+                           items=measures["items"],
+                           throughput=measures["items"] / measures["seconds"] if measures["seconds"] else None,
+                           p50_ms=percentile(latencies, 50),
+                           p99_ms=percentile(latencies, 99),
+                           # cases measuring other processes report their peak memory themselves
+                           peak_mem_mb=measures.get("peak_mem_mb") or peak_memory_mb(),
+                           requests=measures.get("requests", 0),
+                           throttled=measures.get("throttled", 0),
+                           errors=measures.get("errors", 0))
+
+
+def main():
+
+    """
+    Runs the benchmark scenarios against local stand-ins of Steam,
+    OpenExchangeRates and S3
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the Steam prices ETLs.')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help='A benchmark configuration file in YAML format.')
+    parser.add_argument('--scenario', action='append', default=None,
+                        help='Scenario to run, can be repeated. Every scenario runs by default.')
+    parser.add_argument('--output', default=None, help='Saves the results as JSON to this path.')
+    parser.add_argument('--baseline', default=None, help='Results JSON of a previous run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative change reported as a regression when comparing with the baseline.')
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config))
+
+    scenarios = config["scenarios"]
+    names = args.scenario or list(scenarios)
+    unknown = set(names) - set(scenarios)
+    if unknown:
+        parser.error(f"unknown scenarios {sorted(unknown)}")
+
+    results = []
+    for name in names:
+        for params in expand_cases(scenarios[name]):
+            # a fresh process per case, so that memory and caches don't leak between cases
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                result = executor.submit(run_case, name, scenarios[name]["kind"], params, config).result()
+            print(f"{result.case_id}: {result.seconds:.2f}s", file=sys.stderr)
+            results.append(result)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report, regressions = format_report(results, baseline=baseline, tolerance=args.tolerance)
+    print(report)
+    if args.output:
+        save_report(results, args.output)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+import io
+import os
+import logging
+import sys
+import json
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from benchmarks.fake_s3 import InMemoryS3Bucket, LocalDirS3Bucket
+from benchmarks.fake_servers import FakeApiServer, SteamAppdetailsReplay, ExRatesReplay
+from benchmarks.harness import LatencyRecorder, timed
+from Scripts.common.country_index import CountryIndex, EURO_REGION
+from Scripts.common.external_resources import SteamWebApi, OpenExRatesApi
+from Scripts.common.parquet_dataset import PartitionedParquetWriter
+from Scripts.common.reference_cache import ReferenceDataCache
+from Scripts.transformers.steam_prices_transformer import (SteamPricesETL,
+                                                           SteamPricesETLSourceConfig,
+                                                           SteamPricesETLTargetConfig,
+                                                           RUN_ID_FORMAT,
+                                                           DATASET_DATE_COL,
+                                                           DATASET_MONTH_COL)
+from Scripts.transformers.world_map_transformer import (WorldMapETL,
+                                                        WorldMapETLSourceConfig,
+                                                        WorldMapETLTargetConfig)
+from Scripts.transformers.price_history_transformer import (PriceHistoryETL,
+                                                            PriceHistoryETLSourceConfig,
+                                                            PriceHistoryETLTargetConfig)
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pandas import DataFrame
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# runs in a fresh interpreter: imports module and reports how long it took and what it loaded
+STARTUP_CODE = """
+import sys, time, json, importlib
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    importlib.import_module(module)
+seconds = time.perf_counter() - start
+from benchmarks.harness import peak_memory_mb
+print(json.dumps({"seconds": seconds, "peak_mem_mb": peak_memory_mb(), "modules": sorted(sys.modules)}))
+"""
+FIRST_APP_ID = 10
+HISTORY_END = datetime(2024, 6, 30, 12)
+
+
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_countries(amount: int) -> list:
+    """
+    Returns the first amount countries of the fixture, with their ALPHA-2, ALPHA-3 and currency
+    """
+    countries = load_fixture("countries.json")
+    if amount > len(countries):
+        raise ValueError(f"there are only {len(countries)} countries in the fixtures")
+    return countries[:amount]
+
+
+def get_country_index(countries: list) -> CountryIndex:
+    """
+    Builds the country index from the fixture, so that no ISO-3166 lookup is downloaded
+    """
+    table = DataFrame(countries)[["alpha_2", "alpha_3", "currency"]]
+    table["is_euro"] = table["currency"] == "EUR"
+    table["steam_region"] = np.where(table["is_euro"], EURO_REGION, table["alpha_2"])
+    return CountryIndex(table[CountryIndex.COLUMNS])
+
+
+def synthetic_prices(apps: int, countries: list, seed: int = 0) -> DataFrame:
+    """
+    Builds a price snapshot with a row per app and country
+    """
+    rng = np.random.default_rng(seed)
+    app_ids = np.arange(FIRST_APP_ID, FIRST_APP_ID + apps, dtype="int32")
+    codes = [country["alpha_2"].lower() for country in countries]
+    base = rng.uniform(1, 70, size=apps)
+    factors = rng.uniform(0.3, 1.3, size=len(codes))
+    return DataFrame({"app": np.repeat(app_ids, len(codes)),
+                      "country_iso": pd.Categorical(np.tile(codes, apps)),
+                      "currency_steam": pd.Categorical(np.tile([country["currency"].lower() for country in countries],
+                                                               apps)),
+                      "usd_price": (np.repeat(base, len(codes)) * np.tile(factors, apps)).astype("float32")})
+
+
+def _parquet_bytes(df: DataFrame) -> bytes:
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, compression="snappy", index=False)
+    return buffer.getvalue()
+
+
+def build_steam_prices_etl(bucket, steam_api, ex_rates_api, countries: list, apps: int, config: dict,
+                           **source) -> SteamPricesETL:
+    """
+    Builds SteamPricesETL for apps in countries with the benchmark configuration
+
+    :param source: source configuration values that override the benchmark ones
+    """
+    src_conf = SteamPricesETLSourceConfig(
+        base_currency="USD",
+        ex_currencies={country["alpha_2"].lower(): country["currency"] for country in countries},
+        videogames_appids=list(range(FIRST_APP_ID, FIRST_APP_ID + apps)),
+        **dict(config["steam_prices_etl"]["source"], **source))
+    return SteamPricesETL(steam_api=steam_api,
+                          ex_rates_api=ex_rates_api,
+                          s3_bucket=bucket,
+                          src_conf=src_conf,
+                          trg_conf=SteamPricesETLTargetConfig(**config["steam_prices_etl"]["target"]),
+                          country_index=get_country_index(countries))
+
+
+def run_steam_prices(params: dict, config: dict) -> dict:
+    """
+    Runs SteamPricesETL against the fake Steam and OpenExchangeRates servers
+
+    :param params: apps and countries to request
+    :param config: benchmark configuration
+
+    :returns:
+        dict: seconds, items, latencies and the fake servers stats
+    """
+    countries = get_countries(params["countries"])
+    steam_replay = SteamAppdetailsReplay(load_fixture("steam_appdetails.json"))
+    rates_replay = ExRatesReplay(load_fixture("openexchangerates_latest.json"))
+    with FakeApiServer(steam_replay, **config["servers"]["steam"]) as steam_server, \
+         FakeApiServer(rates_replay, **config["servers"]["ex_rates"]) as rates_server, \
+         SteamWebApi(endpoint=steam_server.url, **config["steam_web_api"]) as steam_api, \
+         OpenExRatesApi(endpoint=rates_server.url, app_token="benchmark") as ex_rates_api:
+        latencies = LatencyRecorder()
+        latencies.attach(steam_api.session)
+        bucket = InMemoryS3Bucket()
+        etl = build_steam_prices_etl(bucket, steam_api, ex_rates_api, countries, params["apps"], config)
+        _, seconds = timed(etl.generate_games_data)
+        index = json.loads(bucket.get_bytes(etl.trg_conf.trg_latest_key))
+        items = pq.ParquetFile(io.BytesIO(bucket.get_bytes(index["base"]))).metadata.num_rows
+        return {"seconds": seconds,
+                "items": items,
+                "latencies_ms": latencies.latencies_ms,
+                **steam_server.stats}
+
+
+def run_shard_worker(root_dir: str, steam_url: str, run_id: str, worker_id: str, params: dict, config: dict) -> int:
+    """
+    Worker of a distributed run, meant to run in its own process. Workers share the
+    bucket through root_dir and each one has its own connection pool and rate limiter,
+    as if it ran on its own machine
+
+    :returns:
+        int: shards the worker completed
+    """
+    logging.basicConfig(level=config.get("log_level", "WARNING"))
+    countries = get_countries(params["countries"])
+    with SteamWebApi(endpoint=steam_url, **config["steam_web_api"]) as steam_api:
+        etl = build_steam_prices_etl(LocalDirS3Bucket(root_dir), steam_api, None, countries, params["apps"], config)
+        return etl.run_shard_worker(run_id=run_id, worker_id=worker_id, poll_seconds=0.1)
+
+
+def run_distributed_steam_prices(params: dict, config: dict) -> dict:
+    """
+    Runs a distributed SteamPricesETL scrape: the coordinator shards the apps, workers
+    processes claim and scrape the shards against the fake Steam server and the parts
+    are merged by the finalize step. The bucket is a directory every process shares
+
+    :param params: apps, countries, workers and shard_size
+    :param config: benchmark configuration
+
+    :returns:
+        dict: seconds, items and the fake Steam server stats
+    """
+    countries = get_countries(params["countries"])
+    steam_replay = SteamAppdetailsReplay(load_fixture("steam_appdetails.json"))
+    rates_replay = ExRatesReplay(load_fixture("openexchangerates_latest.json"))
+    with tempfile.TemporaryDirectory() as root_dir, \
+         FakeApiServer(steam_replay, **config["servers"]["steam"]) as steam_server, \
+         FakeApiServer(rates_replay, **config["servers"]["ex_rates"]) as rates_server, \
+         OpenExRatesApi(endpoint=rates_server.url, app_token="benchmark") as ex_rates_api:
+        bucket = LocalDirS3Bucket(root_dir)
+        coordinator = build_steam_prices_etl(bucket, None, ex_rates_api, countries, params["apps"], config,
+                                             shard_size=params["shard_size"])
+
+        def distributed_run():
+            run_id = coordinator.create_sharded_run()
+            shards = len(coordinator.get_work_manifest(run_id).load()["shards"])
+            with ProcessPoolExecutor(max_workers=params["workers"],
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [executor.submit(run_shard_worker, root_dir, steam_server.url, run_id,
+                                           f"worker-{i}", params, config)
+                           for i in range(params["workers"])]
+                completed = sum(future.result() for future in futures)
+            if completed != shards:
+                raise AssertionError(f"workers completed {completed} shards, the run has {shards}")
+            return coordinator.finalize_sharded_run(run_id)
+
+        filename, seconds = timed(distributed_run)
+        items = pq.ParquetFile(io.BytesIO(bucket.get_bytes(filename + ".parquet"))).metadata.num_rows
+        return {"seconds": seconds, "items": items, **steam_server.stats}
+
+
+def run_world_map(params: dict, config: dict) -> dict:
+    """
+    Runs WorldMapETL on a base snapshot with deltas deltas on top of it, seeded
+    in the in-memory bucket
+
+    :param params: apps, countries and deltas of the seeded snapshot
+    :param config: benchmark configuration
+
+    :returns:
+        dict: seconds and items
+    """
+    countries = get_countries(params["countries"])
+    bucket = InMemoryS3Bucket()
+    src_conf = WorldMapETLSourceConfig(**config["world_map_etl"]["source"])
+    trg_conf = WorldMapETLTargetConfig(**config["world_map_etl"]["target"])
+    prices = synthetic_prices(params["apps"], countries)
+    keys = ["steam_etl/steam_etl_run_base.parquet"]
+    bucket.save_bytes(_parquet_bytes(prices), keys[0])
+    rng = np.random.default_rng(1)
+    items = len(prices)
+    for delta in range(params["deltas"]):
+        # every delta changes a tenth of the prices
+        changed = prices.sample(frac=0.1, random_state=delta)
+        changed = changed.assign(usd_price=(changed["usd_price"] * rng.uniform(0.5, 1.5, len(changed)))
+                                 .astype("float32"))
+        keys.append(f"steam_etl/deltas/steam_etl_run_{delta:05d}.parquet")
+        bucket.save_bytes(_parquet_bytes(changed), keys[-1])
+        items += len(changed)
+    bucket.save_bytes(json.dumps({"base": keys[0], "deltas": keys[1:]}).encode(), src_conf.parquet_latest_key)
+    etl = WorldMapETL(src_conf=src_conf,
+                      trg_conf=trg_conf,
+                      s3_bucket=bucket,
+                      reference_cache=ReferenceDataCache(cache_dir=None),
+                      country_index=get_country_index(countries))
+    _, seconds = timed(etl.generate_world_map_image)
+    return {"seconds": seconds, "items": items}
+
+
+def seed_price_dataset(bucket, params: dict, config: dict, countries: list) -> int:
+    """
+    Writes days of snapshots of every app and country to the partitioned dataset, one
+    file per day and country as SteamPricesETL does
+
+    :returns:
+        int: rows written
+    """
+    dataset_key = config["price_history_etl"]["source"]["dataset_key"]
+    prices = synthetic_prices(params["apps"], countries)
+    rng = np.random.default_rng(2)
+    rows = 0
+    for day in range(params["days"], 0, -1):
+        run_date = HISTORY_END - timedelta(days=day - 1)
+        # prices drift a bit every day and a few apps go on sale
+        drift = rng.uniform(0.98, 1.02, len(prices)) * np.where(rng.random(len(prices)) < 0.01, 0.5, 1)
+        snapshot = prices.assign(usd_price=(prices["usd_price"] * drift).astype("float32"),
+                                 **{DATASET_DATE_COL: run_date.date(),
+                                    DATASET_MONTH_COL: run_date.strftime("%Y-%m")})
+        writer = PartitionedParquetWriter(partition_cols=[DATASET_MONTH_COL, "country_iso"],
+                                          dictionary_cols=["currency_steam"])
+        writer.write(snapshot)
+        for partition, partition_file in writer.close().items():
+            bucket.upload_file(partition_file,
+                               f"{dataset_key}{partition}part-{run_date.strftime(RUN_ID_FORMAT)}.parquet")
+        rows += len(snapshot)
+    return rows
+
+
+def run_price_history(params: dict, config: dict) -> dict:
+    """
+    Runs PriceHistoryETL on days of history seeded in the in-memory bucket,
+    optionally compacted by month first
+
+    :param params: apps, countries, days and compacted
+    :param config: benchmark configuration
+
+    :returns:
+        dict: seconds and items
+    """
+    countries = get_countries(params["countries"])
+    bucket = InMemoryS3Bucket()
+    items = seed_price_dataset(bucket, params, config, countries)
+    if params.get("compacted"):
+        compactor = SteamPricesETL(steam_api=None,
+                                   ex_rates_api=None,
+                                   s3_bucket=bucket,
+                                   src_conf=None,
+                                   trg_conf=SteamPricesETLTargetConfig(**config["steam_prices_etl"]["target"]))
+        start = HISTORY_END - timedelta(days=params["days"])
+        for month in pd.period_range(start, HISTORY_END, freq="M").strftime("%Y-%m"):
+            compactor.compact_dataset(month)
+    etl = PriceHistoryETL(s3_bucket=bucket,
+                          src_conf=PriceHistoryETLSourceConfig(**dict(config["price_history_etl"]["source"],
+                                                                      history_days=params["days"])),
+                          trg_conf=PriceHistoryETLTargetConfig(**config["price_history_etl"]["target"]))
+    _, seconds = timed(etl.generate_price_history, run_date=HISTORY_END)
+    return {"seconds": seconds, "items": items}
+
+
+def _import_modules(modules: list) -> dict:
+    output = subprocess.run([sys.executable, "-c", STARTUP_CODE, *modules],
+                            cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def _time_imports(modules: list,
+                  repeats: int,
+                  config: dict,
+                  forbidden_modules: set = frozenset(),
+                  allow_baseline: bool = True) -> dict:
+    """
+    Imports modules in fresh interpreters, as a cron-spawned run.py does, and checks
+    that none of the modules that must be loaded lazily were imported
+
+    :param modules: modules imported, in order
+    :param repeats: interpreters the modules are imported in
+    :param config: benchmark configuration, startup.forbidden_modules lists the top level
+                   packages the imports must not load. What the startup.baseline_modules load
+                   on their own (e.g. pandas >= 2.2 loads pyarrow) isn't blamed on the modules
+    :param forbidden_modules: full names of other modules the imports must not load
+    :param allow_baseline: if False, the baseline modules are forbidden too
+
+    :returns:
+        dict: median seconds, repeats as items and the largest peak memory
+    """
+    runs = [_import_modules(modules) for _ in range(repeats)]
+    baseline_modules = config["startup"].get("baseline_modules", [])
+    forbidden_packages = set(config["startup"]["forbidden_modules"])
+    loaded_packages = {module.split(".")[0] for module in runs[0]["modules"]}
+    if allow_baseline:
+        loaded_packages -= {module.split(".")[0]
+                            for baseline_module in baseline_modules
+                            for module in _import_modules([baseline_module])["modules"]}
+    else:
+        forbidden_packages |= set(baseline_modules)
+    forbidden = sorted((loaded_packages & forbidden_packages) | (set(runs[0]["modules"]) & set(forbidden_modules)))
+    if forbidden:
+        raise AssertionError(f"importing {', '.join(modules)} loads {forbidden}, they must be imported lazily")
+    return {"seconds": sorted(run["seconds"] for run in runs)[len(runs) // 2],
+            "items": len(runs),
+            "peak_mem_mb": max(run["peak_mem_mb"] for run in runs)}
+
+
+def run_startup(params: dict, config: dict) -> dict:
+    """
+    Imports a module in fresh interpreters and checks that it doesn't load any of
+    startup.forbidden_modules
+
+    :param params: module to import and repeats
+    :param config: benchmark configuration
+
+    :returns:
+        dict: median seconds, repeats as items and the largest peak memory
+    """
+    return _time_imports([params["module"]], params["repeats"], config)
+
+
+def run_command_startup(params: dict, config: dict) -> dict:
+    """
+    Imports run.py and the ETL modules a command imports once its arguments are parsed,
+    in fresh interpreters, and checks that the command loads neither startup.forbidden_modules
+    nor the ETLs of other commands. The command none stops at run.py, as an argument error
+    does, so it mustn't load the startup.baseline_modules (pandas) either
+
+    :param params: command (a run.py command or none) and repeats
+    :param config: benchmark configuration
+
+    :returns:
+        dict: median seconds, repeats as items and the largest peak memory
+    """
+    from run import COMMAND_ETLS, ETL_MODULES
+    etl_modules = [ETL_MODULES[name] for name in COMMAND_ETLS.get(params["command"], ())]
+    return _time_imports(["run"] + etl_modules,
+                         params["repeats"],
+                         config,
+                         forbidden_modules=set(ETL_MODULES.values()) - set(etl_modules),
+                         allow_baseline=params["command"] != "none")
+
+
+SCENARIO_KINDS = {"steam_prices": run_steam_prices,
+                  "world_map": run_world_map,
+                  "price_history": run_price_history,
+                  "distributed_steam_prices": run_distributed_steam_prices,
+                  "startup": run_startup,
+                  "command_startup": run_command_startup}
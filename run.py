@@ -1,17 +1,56 @@
 import logging
 import logging.config
+import os
 import yaml
+import socket
 import argparse
 
-from Scripts.transformers.steam_prices_transformer import (SteamPricesETL,
-                                                           SteamPricesETLSourceConfig,
-                                                           SteamPricesETLTargetConfig)
-from Scripts.transformers.world_map_transformer import (WorldMapETL,
-                                                        WorldMapETLSourceConfig,
-                                                        WorldMapETLTargetConfig)
+from concurrent.futures import ThreadPoolExecutor
+
 from Scripts.common.external_resources import (SteamWebApi,
                                                OpenExRatesApi,
-                                               S3Bucket)
+                                               S3Bucket,
+                                               LocalStorage)
+from Scripts.common.pipeline import Pipeline
+from Scripts.common.metrics import METRICS, RunReport
+from Scripts.common.profiling import StageProfiler, PROFILE_MODES
+from datetime import datetime
+
+# pipeline stages run by each command, None runs every configured stage
+COMMAND_STAGES = {"steam": ["ex_rates", "country_index", "steam_prices", "price_history"],
+                  "worldmap": ["country_index", "geo_prep", "world_map"],
+                  "all": None}
+# steps of a distributed SteamPricesETL run, each one runs on its own instead of the pipeline
+DISTRIBUTED_COMMANDS = ("shards", "worker", "finalize")
+# ETLs built by each command. Their modules (and pandas) are imported once the arguments are
+# parsed, so a command only loads the ETLs it runs and argument errors load none of them
+COMMAND_ETLS = {"steam": ("steam_prices", "price_history"),
+                "worldmap": ("world_map",),
+                "all": ("steam_prices", "world_map", "price_history"),
+                "shards": ("steam_prices",),
+                "worker": ("steam_prices",),
+                "finalize": ("steam_prices",)}
+ETL_MODULES = {"steam_prices": "Scripts.transformers.steam_prices_transformer",
+               "world_map": "Scripts.transformers.world_map_transformer",
+               "price_history": "Scripts.transformers.price_history_transformer"}
+
+
+def save_run_report(run_report: RunReport, s3_bucket: S3Bucket, steam_api: SteamWebApi, config: dict):
+    """
+    Saves the run report next to the ETLs output
+
+    :param run_report: report of the run
+    :param s3_bucket: bucket the report is saved to
+    :param steam_api: api whose rate limiter state is added to the report
+    :param config: run_report section of the configuration file
+    """
+    for name, value in steam_api.rate_limiter.stats().items():
+        METRICS.set_gauge(f"rate_limiter_{name}", value, api=steam_api.API_NAME)
+    started_at = datetime.fromtimestamp(run_report.started_at).strftime(config["trg_key_date_format"])
+    run_report.save(s3_bucket,
+                    key=f'{config["trg_key"]}{config["trg_key_filename"]}{started_at}.json',
+                    prometheus=config.get("prometheus", False),
+                    prometheus_prefix=config.get("prometheus_prefix", ""))
 
 
 def main():
@@ -23,44 +62,191 @@ def main():
     # Parsing YAML file
     parser = argparse.ArgumentParser(description='Run the Xetra ETL job.')
     parser.add_argument('config', help='A configuration file in YAML format.')
+    parser.add_argument('command', nargs='?', choices=list(COMMAND_STAGES) + list(DISTRIBUTED_COMMANDS),
+                        default='all',
+                        help='steam scrapes prices and updates the price history, worldmap draws the maps from '
+                             'the latest prices in the bucket, all runs both (default). shards, worker and '
+                             'finalize are the coordinator, worker and finalize steps of a distributed scrape.')
+    parser.add_argument('--run-id', default=None,
+                        help='Distributed run the worker and finalize steps work on, as printed by shards.')
+    parser.add_argument('--worker-id', default=f'{socket.gethostname()}-{os.getpid()}',
+                        help='Identifier of a distributed run worker, unique among its workers.')
+    parser.add_argument('--resume', metavar='RUN_ID', default=None,
+                        help='Resumes a checkpointed SteamPricesETL run instead of starting a new one.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Hands prices over to WorldMapETL in memory and uploads them in the background.')
+    parser.add_argument('--compact-month', metavar='YYYY-MM', default=None,
+                        help='Merges the daily files of a month of the SteamPricesETL dataset and exits.')
+    parser.add_argument('--profile', choices=PROFILE_MODES, default=None,
+                        help='Profiles --profile-stage with cProfile (cpu) or tracemalloc (mem).')
+    parser.add_argument('--profile-stage', metavar='STAGE', default=None,
+                        help='Pipeline stage to profile (e.g. steam_prices, geo_prep, world_map).')
+    parser.add_argument('--profile-dir', metavar='DIR', default=None,
+                        help='Saves the profiles to this local directory instead of the bucket.')
     args = parser.parse_args()
+    if bool(args.profile) != bool(args.profile_stage):
+        parser.error("--profile and --profile-stage must be used together")
+    if args.pipeline and args.command != "all":
+        parser.error("--pipeline hands prices from steam to worldmap, it needs the all command")
+    if args.command in ("worker", "finalize") and not args.run_id:
+        parser.error(f"{args.command} needs the --run-id printed by the shards command")
     config = yaml.safe_load(open(args.config))
+    selected_stages = COMMAND_STAGES.get(args.command) or list(config["pipeline"]["stages"])
+    if args.profile_stage and args.profile_stage not in selected_stages:
+        parser.error(f"--profile-stage must be one of {sorted(selected_stages)}")
     # configure logging
     log_config = config['logging']
     logging.config.dictConfig(log_config)
     logger = logging.getLogger(__name__)
 
+    # --compact-month only needs the dataset of SteamPricesETL
+    etl_names = ("steam_prices",) if args.compact_month else COMMAND_ETLS[args.command]
+    # the caches use pandas, like every ETL, so they're imported once the arguments are parsed too
+    from Scripts.common.ex_rates_cache import ExRatesCache
+    from Scripts.common.reference_cache import ReferenceDataCache
+
     # api interfaces instances for extracting external data
-    steam_api = SteamWebApi(**config["steam_web_api"])
-    ex_rates_api = OpenExRatesApi(**config["currency_ex_api"])
-    # external storage
-    s3_bucket = S3Bucket(**config["s3_bucket"])
-    # reading source configuration
-    steam_etl_src_config = SteamPricesETLSourceConfig(**config["steam_prices_etl"]["source"])
-    world_map_etl_src_config = WorldMapETLSourceConfig(**config["world_map_etl"]["source"])
-    # reading target configuration
-    steam_etl_trg_config = SteamPricesETLTargetConfig(**config["steam_prices_etl"]["target"])
-    world_map_etl_trg_config = WorldMapETLTargetConfig(**config["world_map_etl"]["target"])
-
-    # Steam ETL Execution
-    logger.info("SteamPricesETL has started...")
-    steam_prices_etl = SteamPricesETL(steam_api=steam_api,
-                                      ex_rates_api=ex_rates_api,
-                                      s3_bucket=s3_bucket,
-                                      src_conf=steam_etl_src_config,
-                                      trg_conf=steam_etl_trg_config)
-    # running ETL job for the required ETL Steam
-    steam_prices_etl.generate_games_data()
-    logger.info("SteamPricesETL has finished...")
-
-    # World Map ETL Execution
-    logger.info("WorldMapETL has started...")
-    world_map_etl = WorldMapETL(s3_bucket=s3_bucket,
-                                src_conf=world_map_etl_src_config,
-                                trg_conf=world_map_etl_trg_config)
-    # running ETL job for the required ETL Steam
-    world_map_etl.generate_world_map_image()
-    logger.info("WorldMapETL has finished...")
+    # they own a connection pool that is closed when the pipeline ends
+    with SteamWebApi(**config["steam_web_api"]) as steam_api, \
+         OpenExRatesApi(**config["currency_ex_api"]) as ex_rates_api:
+        # external storage
+        s3_bucket = S3Bucket(**config["s3_bucket"])
+        # exchange rates are memoized and persisted so that reruns don't call the api
+        ex_rates_cache_config = dict(config["ex_rates_cache"])
+        ex_rates_local_dir = ex_rates_cache_config.pop("local_dir", None)
+        ex_rates_cache = ExRatesCache(ex_rates_api,
+                                      storage=LocalStorage(ex_rates_local_dir) if ex_rates_local_dir else s3_bucket,
+                                      **ex_rates_cache_config)
+        # reference data (country lookups) shared by both ETLs. Its settings are read from the
+        # world_map_etl source as they are, so that commands without WorldMapETL don't import it
+        reference_config = config["world_map_etl"]["source"]
+        reference_cache = ReferenceDataCache(cache_dir=reference_config.get("reference_cache_dir"),
+                                             ttl_hours=reference_config.get("reference_cache_ttl_hours", 168))
+
+        def get_country_index():
+            return reference_cache.get_country_index(reference_config["iso_code_map_url"],
+                                                     alpha_2_col=reference_config["iso_code_map_alpha_2_col"],
+                                                     alpha_3_col=reference_config["iso_code_map_alpha_3_col"])
+
+        # only the ETLs of the command are imported and built
+        steam_prices_etl = world_map_etl = price_history_etl = None
+        if "steam_prices" in etl_names:
+            from Scripts.transformers.steam_prices_transformer import (SteamPricesETL,
+                                                                       SteamPricesETLSourceConfig,
+                                                                       SteamPricesETLTargetConfig)
+            steam_prices_etl = SteamPricesETL(steam_api=steam_api,
+                                              ex_rates_api=ex_rates_cache,
+                                              s3_bucket=s3_bucket,
+                                              src_conf=SteamPricesETLSourceConfig(
+                                                  **config["steam_prices_etl"]["source"]),
+                                              trg_conf=SteamPricesETLTargetConfig(
+                                                  **config["steam_prices_etl"]["target"]))
+        if "price_history" in etl_names:
+            from Scripts.transformers.price_history_transformer import (PriceHistoryETL,
+                                                                        PriceHistoryETLSourceConfig,
+                                                                        PriceHistoryETLTargetConfig)
+            price_history_etl = PriceHistoryETL(s3_bucket=s3_bucket,
+                                                src_conf=PriceHistoryETLSourceConfig(
+                                                    **config["price_history_etl"]["source"]),
+                                                trg_conf=PriceHistoryETLTargetConfig(
+                                                    **config["price_history_etl"]["target"]))
+        if "world_map" in etl_names:
+            from Scripts.transformers.world_map_transformer import (WorldMapETL,
+                                                                    WorldMapETLSourceConfig,
+                                                                    WorldMapETLTargetConfig)
+            world_map_etl = WorldMapETL(s3_bucket=s3_bucket,
+                                        src_conf=WorldMapETLSourceConfig(**config["world_map_etl"]["source"]),
+                                        trg_conf=WorldMapETLTargetConfig(**config["world_map_etl"]["target"]),
+                                        reference_cache=reference_cache)
+
+        run_report = RunReport()
+        # returning early from the block still finishes the run as succeeded
+        with run_report.recording(lambda report: save_run_report(report, s3_bucket, steam_api,
+                                                                 config["run_report"])):
+            if args.compact_month:
+                steam_prices_etl.compact_dataset(args.compact_month)
+                return
+            if args.command == "shards":
+                if steam_prices_etl.src_conf.price_regions_from_country_index:
+                    steam_prices_etl.country_index = get_country_index()
+                run_id = steam_prices_etl.create_sharded_run(run_id=args.run_id)
+                print(run_id)
+                return
+            if args.command == "worker":
+                steam_prices_etl.run_shard_worker(run_id=args.run_id, worker_id=args.worker_id)
+                return
+            if args.command == "finalize":
+                filename = steam_prices_etl.finalize_sharded_run(run_id=args.run_id)
+                logger.info(f"distributed run {args.run_id} merged into {filename}")
+                return
+
+            with ThreadPoolExecutor(max_workers=1) as load_executor:
+
+                # stages of the pipeline, the edges between them are configured in the YAML file
+                def ex_rates():
+                    steam_etl_src_config = steam_prices_etl.src_conf
+                    return steam_prices_etl.get_currency_rates(steam_etl_src_config.base_currency,
+                                                               list(steam_etl_src_config.ex_currencies.values()))
+
+                def country_index():
+                    index = get_country_index()
+                    logger.info(f"Country index version {index.version}")
+                    return index
+
+                def steam_prices(ex_rates, country_index):
+                    steam_prices_etl.country_index = country_index
+                    if not args.pipeline:
+                        return steam_prices_etl.generate_games_data(run_id=args.resume,
+                                                                    ex_rates=ex_rates)
+                    # prices go straight to WorldMapETL while they're uploaded in the background
+                    world_map_etl_src_config = world_map_etl.src_conf
+                    return steam_prices_etl.generate_games_data(run_id=args.resume,
+                                                                handoff_cols=[world_map_etl_src_config.country_prices_app_col]
+                                                                             + list(world_map_etl_src_config.country_prices_cols),
+                                                                executor=load_executor,
+                                                                ex_rates=ex_rates)
+
+                def geo_prep(country_index):
+                    # the index is already in the reference cache, world_map_etl picks it up from there
+                    return world_map_etl.get_geospatial_df()
+
+                def world_map(geo_prep, steam_prices=None):
+                    # without the steam stage (worldmap command) the latest prices are read from the bucket
+                    world_map_etl.generate_world_map_image(prices_df=steam_prices.prices if steam_prices else None,
+                                                           geospatial_df=geo_prep)
+
+                def price_history(steam_prices):
+                    # the run's prices must be in the dataset before the history is read
+                    if steam_prices.load_future is not None:
+                        steam_prices.load_future.result()
+                    return price_history_etl.generate_price_history()
+
+                stage_funcs = {"ex_rates": ex_rates,
+                               "country_index": country_index,
+                               "steam_prices": steam_prices,
+                               "geo_prep": geo_prep,
+                               "world_map": world_map,
+                               "price_history": price_history}
+                if args.profile:
+                    # only the chosen stage is wrapped, the others run untouched
+                    profiling_config = dict(config["profiling"])
+                    started_at = datetime.fromtimestamp(run_report.started_at) \
+                                         .strftime(profiling_config.pop("trg_key_date_format"))
+                    profiler = StageProfiler(args.profile,
+                                             storage=LocalStorage(args.profile_dir) if args.profile_dir else s3_bucket,
+                                             key_prefix=f'{profiling_config.pop("trg_key")}{started_at}/',
+                                             **profiling_config)
+                    stage_funcs[args.profile_stage] = profiler.wrap(args.profile_stage,
+                                                                    stage_funcs[args.profile_stage])
+                pipeline = Pipeline.from_config(config["pipeline"],
+                                                stage_funcs=stage_funcs,
+                                                selected_stages=selected_stages)
+                results = pipeline.run()
+                handoff = results.get("steam_prices")
+                if handoff is not None and handoff.load_future is not None:
+                    handoff.load_future.result()
+                    logger.info("SteamPricesETL upload has finished...")
+
 
 
 if __name__ == "__main__":
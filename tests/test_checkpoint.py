@@ -0,0 +1,85 @@
+from itertools import chain, islice
+
+from Scripts.common.checkpoint import RunCheckpoint
+from Scripts.common.external_resources import LocalStorage
+from Scripts.transformers.steam_prices_transformer import (SteamPricesETL,
+                                                           SteamPricesETLSourceConfig,
+                                                           SteamPricesETLTargetConfig)
+
+TRG_COLS = ['app', 'country_iso', 'currency_steam', 'usd_price']
+CURRENCIES = {"de": "EUR", "fr": "EUR", "it": "EUR", "us": "USD"}
+PRICE_REGIONS = {"de": "eu", "fr": "eu", "it": "eu"}
+APP_IDS = [1, 2, 3]
+
+
+class FakeRateLimiter:
+
+    def stats(self) -> dict:
+        return {}
+
+
+class FakeSteamApi:
+
+    def __init__(self):
+        self.rate_limiter = FakeRateLimiter()
+        self.requests = []
+
+    def get_app_prices(self, app_ids: list, country_code: str = "us") -> tuple:
+        self.requests.append((tuple(app_ids), country_code))
+        currency = "USD" if country_code == "us" else "EUR"
+        return {app_id: (f"{app_id},99", currency) for app_id in app_ids}, {}
+
+
+def make_etl(steam_api: FakeSteamApi) -> SteamPricesETL:
+    return SteamPricesETL(steam_api=steam_api,
+                          ex_rates_api=None,
+                          s3_bucket=None,
+                          src_conf=SteamPricesETLSourceConfig(base_currency="USD",
+                                                              ex_currencies=CURRENCIES,
+                                                              videogames_appids=APP_IDS),
+                          trg_conf=SteamPricesETLTargetConfig(trg_key="steam_etl/",
+                                                              trg_key_date_format="%Y%m%d",
+                                                              trg_key_filename="run",
+                                                              trg_format="parquet",
+                                                              trg_cols=TRG_COLS))
+
+
+def iter_prices(etl: SteamPricesETL, completed_pairs: set = None):
+    return etl.iter_prices_per_app(app_ids=APP_IDS,
+                                   currencies=CURRENCIES,
+                                   price_regions=PRICE_REGIONS,
+                                   completed_pairs=completed_pairs)
+
+
+def test_checkpointed_saves_full_parts_and_the_rest_at_the_end(tmp_path):
+    checkpoint = RunCheckpoint(LocalStorage(str(tmp_path)), prefix="checkpoints/", run_id="run", columns=TRG_COLS)
+    rows = [(app, "us", "usd", "1.00") for app in range(5)]
+    assert list(checkpoint.checkpointed(iter(rows), part_size=2)) == rows
+    assert len(checkpoint.part_keys()) == 3
+    assert list(checkpoint.iter_rows()) == rows
+    assert checkpoint.completed(["app", "country_iso"]) == {(app, "us") for app in range(5)}
+    checkpoint.clear()
+    assert checkpoint.part_keys() == []
+
+
+def test_resume_after_a_part_split_a_region(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    expected = list(iter_prices(make_etl(FakeSteamApi())))
+
+    # the first attempt dies after its first part, which holds only 2 of the 3 eu rows of app 1
+    checkpoint = RunCheckpoint(storage, prefix="checkpoints/", run_id="run", columns=TRG_COLS)
+    first_attempt = checkpoint.checkpointed(iter_prices(make_etl(FakeSteamApi())), part_size=2)
+    assert [row[:2] for row in islice(first_attempt, 3)] == [(1, "de"), (1, "fr"), (1, "it")]
+    first_attempt.close()
+    assert checkpoint.completed(["app", "country_iso"]) == {(1, "de"), (1, "fr")}
+
+    # the resumed run requests the split region again, without repeating the saved rows
+    checkpoint = RunCheckpoint(storage, prefix="checkpoints/", run_id="run", columns=TRG_COLS)
+    steam_api = FakeSteamApi()
+    completed_pairs = checkpoint.completed(["app", "country_iso"])
+    rows = list(chain(checkpoint.iter_rows(),
+                      checkpoint.checkpointed(iter_prices(make_etl(steam_api), completed_pairs), part_size=2)))
+    assert sorted(rows) == sorted(expected)
+    assert ((1,), "de") in steam_api.requests
+    assert len(steam_api.requests) == 6
+    assert checkpoint.completed(["app", "country_iso"]) == {row[:2] for row in expected}
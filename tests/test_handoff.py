@@ -0,0 +1,88 @@
+import threading
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_s3 import InMemoryS3Bucket
+from Scripts.transformers.steam_prices_transformer import (SteamPricesETL,
+                                                           SteamPricesETLSourceConfig,
+                                                           SteamPricesETLTargetConfig)
+
+TRG_COLS = ['app', 'country_iso', 'currency_steam', 'usd_price']
+CURRENCIES = {"de": "EUR", "us": "USD"}
+APP_IDS = [1, 2, 3]
+
+
+class FakeRateLimiter:
+
+    def stats(self) -> dict:
+        return {}
+
+
+class FakeSteamApi:
+
+    def __init__(self):
+        self.rate_limiter = FakeRateLimiter()
+
+    def get_app_prices(self, app_ids: list, country_code: str = "us") -> tuple:
+        currency = "USD" if country_code == "us" else "EUR"
+        return {app_id: (f"{app_id},99", currency) for app_id in app_ids}, {}
+
+
+def make_etl(bucket: InMemoryS3Bucket) -> SteamPricesETL:
+    return SteamPricesETL(steam_api=FakeSteamApi(),
+                          ex_rates_api=None,
+                          s3_bucket=bucket,
+                          src_conf=SteamPricesETLSourceConfig(base_currency="USD",
+                                                              ex_currencies=CURRENCIES,
+                                                              videogames_appids=APP_IDS),
+                          trg_conf=SteamPricesETLTargetConfig(trg_key="steam_etl/",
+                                                              trg_key_date_format="%Y%m%d",
+                                                              trg_key_filename="run",
+                                                              trg_format="parquet",
+                                                              trg_cols=TRG_COLS))
+
+
+def generate(etl: SteamPricesETL, executor: ThreadPoolExecutor):
+    return etl.generate_games_data(handoff_cols=["app", "country_iso", "usd_price"],
+                                   executor=executor,
+                                   ex_rates={"USD": 1.0, "EUR": 0.5})
+
+
+def test_prices_are_handed_over_before_the_upload_finishes(monkeypatch):
+    bucket = InMemoryS3Bucket()
+    upload_many = bucket.upload_many
+    release = threading.Event()
+
+    def slow_upload_many(objects: dict, **kwargs):
+        release.wait(timeout=10)
+        return upload_many(objects, **kwargs)
+    monkeypatch.setattr(bucket, "upload_many", slow_upload_many)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        handoff = generate(make_etl(bucket), executor)
+
+        assert not handoff.load_future.done()
+        assert sorted(zip(handoff.prices["app"], handoff.prices["country_iso"])) == \
+            [(app, country) for app in APP_IDS for country in ("de", "us")]
+        assert handoff.prices["usd_price"].notna().all()
+        assert bucket.list_keys("steam_etl/") == []
+
+        release.set()
+        handoff.load_future.result()
+    assert any(key.endswith(".parquet") for key in bucket.list_keys("steam_etl/"))
+
+
+def test_background_upload_failure_is_raised_by_the_load_future(monkeypatch):
+    bucket = InMemoryS3Bucket()
+
+    def failing_upload_many(objects: dict, **kwargs):
+        raise ConnectionError("S3 is down")
+    monkeypatch.setattr(bucket, "upload_many", failing_upload_many)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        handoff = generate(make_etl(bucket), executor)
+
+        assert len(handoff.prices) == len(APP_IDS) * len(CURRENCIES)
+        with pytest.raises(ConnectionError, match="S3 is down"):
+            handoff.load_future.result()
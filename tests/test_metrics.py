@@ -0,0 +1,38 @@
+import pytest
+
+from benchmarks.fake_s3 import InMemoryS3Bucket
+from Scripts.common.metrics import METRICS, MetricsRegistry
+
+
+def counter(name: str, **labels) -> float:
+    return sum(counter["value"] for counter in METRICS.snapshot()["counters"]
+               if counter["name"] == name and counter["labels"] == labels)
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    METRICS.reset()
+    yield
+    METRICS.reset()
+
+
+def test_every_page_of_a_listing_is_a_request():
+    bucket = InMemoryS3Bucket()
+    for i in range(2500):
+        bucket.save_bytes(b"", f"prefix/{i:05d}")
+    assert len(bucket.list_keys("prefix/")) == 2500
+    assert counter("s3_requests_total", operation="list") == 3
+    assert len(bucket.get_bucket_filenames(bucket.bucket_name, "prefix/")) == 2500
+    assert counter("s3_requests_total", operation="list") == 6
+
+
+def test_registry_formats_counters_and_histograms_for_prometheus():
+    registry = MetricsRegistry()
+    registry.inc("requests_total", api="steam", status=200)
+    registry.inc("requests_total", 2, api="steam", status=200)
+    registry.observe("request_seconds", 0.2, buckets=(0.1, 1))
+    text = registry.to_prometheus(prefix="etl_")
+    assert 'etl_requests_total{api="steam",status="200"} 3' in text
+    assert 'etl_request_seconds_bucket{le="0.1"} 0' in text
+    assert 'etl_request_seconds_bucket{le="1"} 1' in text
+    assert "etl_request_seconds_count 1" in text
@@ -0,0 +1,90 @@
+import io
+import datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from benchmarks.fake_s3 import InMemoryS3Bucket
+from Scripts.transformers.price_history_transformer import (PriceHistoryETL,
+                                                            PriceHistoryETLSourceConfig,
+                                                            PriceHistoryETLTargetConfig)
+
+ROWS_PER_DAY = 2000
+
+
+def daily_prices(days: int) -> pd.DataFrame:
+    dates = [datetime.date(2024, 1, 1) + datetime.timedelta(days=day) for day in range(days)]
+    return pd.DataFrame({"snapshot_date": [date for date in dates for _ in range(ROWS_PER_DAY)],
+                         "app": list(range(ROWS_PER_DAY)) * days,
+                         "usd_price": [1.0 + app / 100 for app in range(ROWS_PER_DAY)] * days,
+                         "comment": [f"padding text {i} " * 5 for i in range(ROWS_PER_DAY * days)]})
+
+
+def save_parquet(bucket: InMemoryS3Bucket, df: pd.DataFrame, key: str):
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer, row_group_size=ROWS_PER_DAY)
+    bucket.save_bytes(buffer.getvalue(), key)
+    return pq.read_metadata(io.BytesIO(buffer.getvalue()))
+
+
+def column_chunk_bytes(metadata, columns: list, row_groups: list = None) -> int:
+    """
+    Bytes of the column chunks of columns, the least a projected read downloads besides the footer
+    """
+    return sum(metadata.row_group(i).column(j).total_compressed_size
+               for i in (row_groups if row_groups is not None else range(metadata.num_row_groups))
+               for j in range(metadata.num_columns)
+               if metadata.schema.column(j).name in columns)
+
+
+def bytes_downloaded(bucket: InMemoryS3Bucket, read) -> tuple:
+    before = bucket.s3_session.stats["bytes_out"]
+    result = read()
+    return result, bucket.s3_session.stats["bytes_out"] - before
+
+
+def test_read_parquet_only_downloads_the_projected_columns():
+    bucket = InMemoryS3Bucket(transfer_config={"footer_read_size": 1024, "range_coalesce_gap": 0})
+    df = daily_prices(days=5)
+    metadata = save_parquet(bucket, df, "prices.parquet")
+    read, downloaded = bytes_downloaded(bucket, lambda: bucket.read_parquet("prices.parquet",
+                                                                            columns=["app", "usd_price"]))
+    pd.testing.assert_frame_equal(read, df[["app", "usd_price"]])
+    footer = metadata.serialized_size + 8
+    assert downloaded <= column_chunk_bytes(metadata, ["app", "usd_price"]) + footer + 1024
+    pd.testing.assert_frame_equal(bucket.read_parquet("prices.parquet"), df)
+
+
+def test_row_groups_outside_the_ranges_are_not_downloaded():
+    bucket = InMemoryS3Bucket(transfer_config={"footer_read_size": 1024, "range_coalesce_gap": 0})
+    df = daily_prices(days=10)
+    metadata = save_parquet(bucket, df, "prices.parquet")
+    day = datetime.date(2024, 1, 4)
+    tables, downloaded = bytes_downloaded(bucket, lambda: list(bucket.iter_parquet_row_groups(
+        "prices.parquet", columns=["snapshot_date", "app"], ranges={"snapshot_date": (day, day)})))
+    assert len(tables) == 1
+    assert set(tables[0].column("snapshot_date").to_pylist()) == {day}
+    # the statistics are in the footer, so only the 4th row group is downloaded
+    footer = metadata.serialized_size + 8
+    assert downloaded <= column_chunk_bytes(metadata, ["snapshot_date", "app"], row_groups=[3]) + footer + 1024
+    assert list(bucket.iter_parquet_row_groups("missing.parquet")) == []
+
+
+def test_price_history_reads_only_the_history_range():
+    bucket = InMemoryS3Bucket(transfer_config={"footer_read_size": 1024})
+    metadata = save_parquet(bucket, daily_prices(days=10), "dataset/month=2024-01/country_iso=us/part-1.parquet")
+    etl = PriceHistoryETL(s3_bucket=bucket,
+                          src_conf=PriceHistoryETLSourceConfig(dataset_key="dataset/", app_ids=[5, 7]),
+                          trg_conf=PriceHistoryETLTargetConfig(trg_key="analytics/",
+                                                               trg_key_date_format="%Y%m%d",
+                                                               trg_key_filename="run"))
+    chunks, downloaded = bytes_downloaded(bucket, lambda: list(etl.iter_history_chunks(
+        datetime.datetime(2024, 1, 3), datetime.datetime(2024, 1, 4))))
+    footer = metadata.serialized_size + 8
+    assert downloaded <= column_chunk_bytes(metadata, ["snapshot_date", "app", "usd_price"],
+                                            row_groups=[2, 3]) + footer + 1024
+    history = pd.concat(chunks)
+    assert len(chunks) == 2
+    assert sorted(history["app"].unique()) == [5, 7]
+    assert set(history["country_iso"]) == {"us"}
+    assert history["snapshot_date"].min() == pd.Timestamp("2024-01-03")
@@ -0,0 +1,66 @@
+import threading
+import pytest
+
+from Scripts.common.pipeline import Pipeline, PipelineStage
+
+
+def test_stages_receive_the_results_of_their_dependencies():
+    pipeline = Pipeline([PipelineStage("a", lambda: 1),
+                         PipelineStage("b", lambda a: a + 1, depends_on=["a"]),
+                         PipelineStage("c", lambda a, b: a + b, depends_on=["a", "b"])])
+    assert pipeline.run() == {"a": 1, "b": 2, "c": 3}
+    assert set(pipeline.timings) == {"a", "b", "c"}
+
+
+def test_independent_stages_run_concurrently():
+    # each stage waits for the other one, so they only finish if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    pipeline = Pipeline([PipelineStage("a", lambda: barrier.wait()),
+                         PipelineStage("b", lambda: barrier.wait())],
+                        max_workers=2)
+    assert set(pipeline.run()) == {"a", "b"}
+
+
+def test_failed_stage_stops_its_dependents():
+    started = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    pipeline = Pipeline([PipelineStage("a", fail),
+                         PipelineStage("b", lambda a: started.append("b"), depends_on=["a"])])
+    with pytest.raises(RuntimeError, match="boom"):
+        pipeline.run()
+    assert started == []
+
+
+def test_invalid_graphs_are_rejected():
+    with pytest.raises(ValueError, match="doesn't exist"):
+        Pipeline([PipelineStage("a", lambda missing: None, depends_on=["missing"])])
+    with pytest.raises(ValueError, match="circular"):
+        Pipeline([PipelineStage("a", lambda b: None, depends_on=["b"]),
+                  PipelineStage("b", lambda a: None, depends_on=["a"])])
+
+
+def test_from_config_drops_dependencies_on_unselected_stages():
+    config = {"max_workers": 2,
+              "stages": {"country_index": {"depends_on": []},
+                         "steam_prices": {"depends_on": ["country_index"]},
+                         "geo_prep": {"depends_on": ["country_index"]},
+                         "world_map": {"depends_on": ["steam_prices", "geo_prep"]}}}
+    stage_funcs = {"country_index": lambda: "index",
+                   "steam_prices": lambda country_index: "prices",
+                   "geo_prep": lambda country_index: f"geo {country_index}",
+                   "world_map": lambda geo_prep, steam_prices=None: (geo_prep, steam_prices)}
+    pipeline = Pipeline.from_config(config, stage_funcs,
+                                    selected_stages=["country_index", "geo_prep", "world_map"])
+    assert pipeline.stages["world_map"].depends_on == ("geo_prep",)
+    assert pipeline.run()["world_map"] == ("geo index", None)
+    with pytest.raises(ValueError, match="doesn't exist"):
+        Pipeline.from_config({"stages": {"unknown": None}}, stage_funcs)
+
+
+def test_stages_without_dependencies_dont_share_a_list():
+    first, second = PipelineStage("a", lambda: None), PipelineStage("b", lambda: None)
+    assert first.depends_on == second.depends_on == ()
+    assert isinstance(first.depends_on, tuple)
@@ -0,0 +1,71 @@
+import pytest
+
+from Scripts.common.currency_formats import STEAM_CURRENCY_FORMATS
+from Scripts.transformers.steam_prices_transformer import (SteamPricesETL,
+                                                           SteamPricesETLSourceConfig,
+                                                           SteamPricesETLTargetConfig)
+
+TRG_COLS = ['app', 'country_iso', 'currency_steam', 'usd_price']
+EX_RATES = {"USD": 1, "EUR": 0.5, "BRL": 5, "RUB": 100, "CHF": 1, "IDR": 10000, "NOK": 10, "KZT": 500,
+            "ARS": 1000, "JPY": 100, "UAH": 40}
+
+
+def make_etl() -> SteamPricesETL:
+    return SteamPricesETL(steam_api=None,
+                          ex_rates_api=None,
+                          s3_bucket=None,
+                          src_conf=SteamPricesETLSourceConfig(base_currency="USD",
+                                                              ex_currencies={},
+                                                              videogames_appids=[]),
+                          trg_conf=SteamPricesETLTargetConfig(trg_key="steam_etl/",
+                                                              trg_key_date_format="%Y%m%d",
+                                                              trg_key_filename="run",
+                                                              trg_format="parquet",
+                                                              trg_cols=TRG_COLS))
+
+
+def parse(rows: list, ex_rates: dict = None) -> tuple:
+    rejects = []
+    chunks = list(make_etl().iter_parsed_chunks(rows, ex_rates=ex_rates or EX_RATES, chunk_size=100, rejects=rejects))
+    return chunks[0], (rejects[0] if rejects else None)
+
+
+@pytest.mark.parametrize("price_str, currency, usd_price", [
+    ("$9.99", "usd", 9.99),
+    ("$1,299.99", "usd", 1299.99),
+    ("9,99€", "eur", 19.98),
+    ("1.234,50€", "eur", 2469.0),
+    ("R$ 1.234,56", "brl", 246.912),
+    ("1 299 pуб.", "rub", 12.99),
+    # steam sends no-break spaces as thousands separator
+    ("1\xa0299,50 pуб.", "rub", 12.995),
+    ("CHF 1'234.50", "chf", 1234.5),
+    ("Rp 1 234 567", "idr", 123.4567),
+    ("199,00 kr", "nok", 19.9),
+    ("1 234,50₸", "kzt", 2.469),
+    ("ARS$ 12.345,67", "ars", 12.34567),
+    ("¥ 1,980", "jpy", 19.8),
+    ("299₴", "uah", 7.475),
+])
+def test_prices_are_parsed_with_each_currency_format(price_str, currency, usd_price):
+    df, rejects = parse([(1, "xx", currency, price_str)])
+    assert rejects is None
+    assert df["usd_price"].tolist() == pytest.approx([usd_price])
+
+
+@pytest.mark.parametrize("price_str, currency, reason", [
+    ("9.99 XTS", "xts", "unknown currency format"),
+    ("Free", "usd", "no price found"),
+    ("9,99€", "eur", "no exchange rate"),
+])
+def test_unparseable_prices_are_rejected_with_a_reason(price_str, currency, reason):
+    df, rejects = parse([(1, "xx", currency, price_str), (2, "us", "usd", "$1.00")],
+                        ex_rates={"USD": 1})
+    assert df["app"].tolist() == [2]
+    assert rejects["app"].tolist() == [1]
+    assert rejects["reject_reason"].tolist() == [reason]
+
+
+def test_every_currency_format_has_distinct_separators():
+    for name, fmt in STEAM_CURRENCY_FORMATS.items():
+        assert fmt.decimal_sep != fmt.thousands_sep, name
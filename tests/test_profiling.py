@@ -0,0 +1,53 @@
+import tracemalloc
+import pytest
+
+from Scripts.common.external_resources import LocalStorage
+from Scripts.common.profiling import StageProfiler
+
+
+def allocate(size: int) -> int:
+    data = bytearray(size)
+    return len(data)
+
+
+@pytest.mark.parametrize("mode, extension", [("cpu", "prof"), ("mem", "tracemalloc")])
+def test_profiled_stage_returns_its_result_and_saves_the_profile(tmp_path, mode, extension):
+    storage = LocalStorage(str(tmp_path))
+    profiler = StageProfiler(mode, storage=storage, key_prefix="profiles/", top_n=5)
+    assert profiler.wrap("stage", allocate)(2 ** 20) == 2 ** 20
+    assert sorted(storage.list_keys("profiles/")) == [f"profiles/stage_{mode}.{extension}",
+                                                       f"profiles/stage_{mode}_summary.txt"]
+    assert not tracemalloc.is_tracing()
+
+
+def test_mem_profile_works_without_reset_peak(tmp_path, monkeypatch):
+    # Python < 3.9 has no tracemalloc.reset_peak
+    monkeypatch.delattr(tracemalloc, "reset_peak", raising=False)
+    storage = LocalStorage(str(tmp_path))
+    profiler = StageProfiler("mem", storage=storage, key_prefix="profiles/")
+    tracemalloc.start()
+    try:
+        assert profiler.wrap("stage", allocate)(2 ** 20) == 2 ** 20
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    summary = storage.get_bytes("profiles/stage_mem_summary.txt").decode()
+    assert summary.startswith("current ")
+
+
+class FailingStorage:
+
+    def save_bytes(self, data: bytes, key: str):
+        raise ConnectionError("S3 is down")
+
+
+def fail():
+    raise ValueError("stage failed")
+
+
+@pytest.mark.parametrize("mode", ["cpu", "mem"])
+def test_failed_profile_save_doesnt_hide_the_stage_result(mode):
+    profiler = StageProfiler(mode, storage=FailingStorage(), key_prefix="profiles/")
+    assert profiler.wrap("stage", allocate)(1024) == 1024
+    with pytest.raises(ValueError, match="stage failed"):
+        profiler.wrap("stage", fail)()
@@ -0,0 +1,24 @@
+import pytest
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from Scripts.common.rate_limiter import parse_retry_after
+
+
+def http_date(seconds_from_now: float, zone: str) -> str:
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=seconds_from_now), usegmt=True)
+    return date.replace(" GMT", zone)
+
+
+def test_delay_seconds():
+    assert parse_retry_after("2.5") == 2.5
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+
+@pytest.mark.parametrize("zone", [" GMT", " +0000", " -0000", ""])
+def test_http_dates_in_every_utc_form(zone):
+    assert parse_retry_after(http_date(120, zone)) == pytest.approx(120, abs=2)
+    assert parse_retry_after(http_date(-120, zone)) == 0.0
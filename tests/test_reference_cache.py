@@ -0,0 +1,45 @@
+import threading
+import pandas as pd
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from Scripts.common import reference_cache
+from Scripts.common.reference_cache import ReferenceDataCache
+
+
+@pytest.fixture(autouse=True)
+def empty_memory_cache(monkeypatch):
+    monkeypatch.setattr(reference_cache, "_MEMORY_CACHE", {})
+    monkeypatch.setattr(reference_cache, "_MEMORY_CACHE_LOCKS", {})
+
+
+def test_independent_entries_load_at_the_same_time(monkeypatch):
+    # each load waits for the other one, so they only finish if they run concurrently
+    both_loading = threading.Barrier(2, timeout=5)
+
+    def read_csv(url: str, usecols: list) -> pd.DataFrame:
+        both_loading.wait()
+        return pd.DataFrame({col: [url] for col in usecols})
+    monkeypatch.setattr(reference_cache.pd, "read_csv", read_csv)
+    cache = ReferenceDataCache()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(cache.get_iso_codes, url, usecols=["alpha-2"]) for url in ("a.csv", "b.csv")]
+        assert [future.result()["alpha-2"][0] for future in futures] == ["a.csv", "b.csv"]
+
+
+def test_an_entry_is_loaded_once_and_shared(monkeypatch):
+    loads = []
+
+    def read_csv(url: str, usecols: list) -> pd.DataFrame:
+        loads.append(url)
+        return pd.DataFrame({col: [url] for col in usecols})
+    monkeypatch.setattr(reference_cache.pd, "read_csv", read_csv)
+    cache = ReferenceDataCache()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tables = list(executor.map(lambda _: cache.get_iso_codes("a.csv", usecols=["alpha-2"]), range(8)))
+
+    assert loads == ["a.csv"]
+    assert all(table is tables[0] for table in tables)
@@ -0,0 +1,60 @@
+from benchmarks.fake_s3 import InMemoryS3Bucket
+from Scripts.transformers.steam_prices_transformer import (SteamPricesETL,
+                                                           SteamPricesETLSourceConfig,
+                                                           SteamPricesETLTargetConfig)
+
+TRG_COLS = ['app', 'country_iso', 'currency_steam', 'usd_price']
+CURRENCIES = {"de": "EUR", "fr": "EUR", "us": "USD"}
+
+
+class FakeRateLimiter:
+
+    def stats(self) -> dict:
+        return {}
+
+
+class FakeSteamApi:
+
+    def __init__(self):
+        self.rate_limiter = FakeRateLimiter()
+        self.requests = []
+
+    def get_app_prices(self, app_ids: list, country_code: str = "us") -> tuple:
+        self.requests.append((tuple(app_ids), country_code))
+        currency = "USD" if country_code == "us" else "EUR"
+        return {app_id: (f"{app_id},99", currency) for app_id in app_ids}, {}
+
+
+def run_with_budget(request_budget: int, price_regions_sample_appids: list = None) -> FakeSteamApi:
+    steam_api = FakeSteamApi()
+    etl = SteamPricesETL(steam_api=steam_api,
+                         ex_rates_api=None,
+                         s3_bucket=InMemoryS3Bucket(),
+                         src_conf=SteamPricesETLSourceConfig(base_currency="USD",
+                                                             ex_currencies=CURRENCIES,
+                                                             videogames_appids=list(range(1, 11)),
+                                                             request_budget=request_budget,
+                                                             price_regions_sample_appids=price_regions_sample_appids),
+                         trg_conf=SteamPricesETLTargetConfig(trg_key="steam_etl/",
+                                                             trg_key_date_format="%Y%m%d",
+                                                             trg_key_filename="run",
+                                                             trg_format="parquet",
+                                                             trg_cols=TRG_COLS))
+    etl.generate_games_data(ex_rates={"USD": 1.0, "EUR": 0.5})
+    return steam_api
+
+
+def test_request_budget_limits_the_price_requests():
+    assert len(run_with_budget(5).requests) == 5
+
+
+def test_region_sampling_requests_count_against_the_budget():
+    steam_api = run_with_budget(5, price_regions_sample_appids=[1])
+
+    # a sampling request per country, the rest of the budget for the prices
+    assert steam_api.requests[:3] == [((1,), "de"), ((1,), "fr"), ((1,), "us")]
+    assert len(steam_api.requests) == 5
+
+
+def test_a_budget_spent_on_sampling_requests_no_prices():
+    assert len(run_with_budget(2, price_regions_sample_appids=[1]).requests) == 3
@@ -0,0 +1,65 @@
+import json
+import sys
+import yaml
+import pytest
+
+import run
+
+from benchmarks.fake_s3 import InMemoryS3Bucket
+from Scripts.common.metrics import METRICS
+from Scripts.transformers.steam_prices_transformer import SteamPricesETL
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch) -> InMemoryS3Bucket:
+    with open("configs/etl_config.yml") as f:
+        config = yaml.safe_load(f)
+    config["world_map_etl"]["source"]["reference_cache_dir"] = None
+    config_path = tmp_path / "etl_config.yml"
+    config_path.write_text(yaml.safe_dump(config))
+    bucket = InMemoryS3Bucket()
+    monkeypatch.setattr(run, "S3Bucket", lambda **kwargs: bucket)
+    monkeypatch.setattr(sys, "argv", ["run.py", str(config_path), "finalize", "--run-id", "run"])
+    METRICS.reset()
+    yield bucket
+    METRICS.reset()
+
+
+def saved_report(bucket: InMemoryS3Bucket) -> dict:
+    keys = [key for key in bucket.list_keys("steam_etl/reports/") if key.endswith(".json")]
+    assert len(keys) == 1
+    return json.loads(bucket.get_bytes(keys[0]))
+
+
+def test_command_returning_early_saves_a_succeeded_report(bucket, monkeypatch):
+    monkeypatch.setattr(SteamPricesETL, "finalize_sharded_run", lambda self, run_id: "snapshot.parquet")
+
+    run.main()
+
+    report = saved_report(bucket)
+    assert report["status"] == "succeeded"
+    assert report["finished_at"] is not None
+
+
+def test_failed_command_saves_a_failed_report(bucket, monkeypatch):
+    def finalize_sharded_run(self, run_id: str):
+        raise ValueError("no manifest")
+    monkeypatch.setattr(SteamPricesETL, "finalize_sharded_run", finalize_sharded_run)
+
+    with pytest.raises(ValueError, match="no manifest"):
+        run.main()
+
+    assert saved_report(bucket)["status"] == "failed"
+
+
+def test_report_save_failure_doesnt_hide_the_run_error(bucket, monkeypatch):
+    def finalize_sharded_run(self, run_id: str):
+        raise ValueError("no manifest")
+
+    def save_bytes(data: bytes, key: str):
+        raise ConnectionError("S3 is down")
+    monkeypatch.setattr(SteamPricesETL, "finalize_sharded_run", finalize_sharded_run)
+    monkeypatch.setattr(bucket, "save_bytes", save_bytes)
+
+    with pytest.raises(ValueError, match="no manifest"):
+        run.main()
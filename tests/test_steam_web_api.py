@@ -0,0 +1,109 @@
+import json
+import pytest
+import requests
+
+from Scripts.common import external_resources
+from Scripts.common.external_resources import SteamWebApi
+
+
+class FakeResponse:
+
+    def __init__(self, status_code: int, body: dict = None, headers: dict = None):
+        self.status_code = status_code
+        self.text = json.dumps(body or {})
+        self.headers = headers or {}
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"status {self.status_code}")
+
+
+class FakeSession:
+
+    """
+    Returns (or raises) the scripted outcomes in order, one per request
+    """
+
+    def __init__(self, outcomes: list):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def close(self):
+        pass
+
+
+class FakeTime:
+
+    def __init__(self):
+        self.sleeps = []
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+
+
+PRICE_BODY = {"10": {"success": True,
+                     "data": {"price_overview": {"currency": "USD", "final_formatted": "$9.99"}}}}
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(external_resources, "time", fake)
+    return fake
+
+
+def make_api(outcomes: list, max_retries: int = 5) -> SteamWebApi:
+    api = SteamWebApi(endpoint="http://steam.test/api/appdetails/",
+                      rate_limit={"rate": 1000, "capacity": 1000},
+                      max_retries=max_retries,
+                      backoff_base=0,
+                      backoff_max=0)
+    api.session = FakeSession(outcomes)
+    return api
+
+
+def test_timeouts_and_dropped_connections_are_retried(fake_time):
+    api = make_api([requests.ReadTimeout("read timed out"),
+                    requests.ConnectionError("reset by peer"),
+                    FakeResponse(200, PRICE_BODY)])
+    assert api.get_app_price(10) == ("$9.99", "USD")
+    assert api.session.calls == 3
+    assert len(fake_time.sleeps) == 2
+
+
+def test_throttled_and_failed_responses_are_retried_after_retry_after(fake_time):
+    api = make_api([FakeResponse(429, headers={"Retry-After": "0.05"}),
+                    FakeResponse(503),
+                    FakeResponse(200, PRICE_BODY)])
+    assert api.get_app_price(10) == ("$9.99", "USD")
+    assert api.session.calls == 3
+    # the first retry waits what the server asked for
+    assert fake_time.sleeps[0] == pytest.approx(0.05)
+    assert api.rate_limiter.throttle_count == 2
+
+
+def test_gives_up_after_max_retries(fake_time):
+    api = make_api([requests.ReadTimeout("read timed out")] * 3, max_retries=2)
+    with pytest.raises(requests.Timeout):
+        api.get_app_price(10)
+    api = make_api([FakeResponse(500)] * 3, max_retries=2)
+    with pytest.raises(requests.HTTPError):
+        api.get_app_price(10)
+
+
+def test_transport_level_retries_are_disabled():
+    with SteamWebApi(endpoint="http://steam.test/api/appdetails/", http_config={"retries": 3}) as api:
+        retry = api.session.get_adapter(api.endpoint).max_retries
+    # connection and read errors reach _get, which retries them through the rate limiter
+    assert (retry.total, retry.connect, retry.read) == (0, 0, 0)
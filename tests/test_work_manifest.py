@@ -0,0 +1,122 @@
+import pytest
+
+from botocore.exceptions import ParamValidationError
+
+from benchmarks.fake_s3 import InMemoryS3Bucket, InMemoryS3Client, _ClientError
+from Scripts.common import work_manifest
+from Scripts.common.external_resources import ConditionalWriteUnsupported, LocalStorage
+from Scripts.common.work_manifest import WorkManifest
+
+APP_IDS = list(range(10))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(work_manifest, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["local", "s3"])
+def storage(request, tmp_path):
+    if request.param == "local":
+        return LocalStorage(str(tmp_path))
+    return InMemoryS3Bucket()
+
+
+def make_manifest(storage, shard_size: int = 4) -> WorkManifest:
+    manifest = WorkManifest(storage, prefix="distributed/", run_id="run", lease_seconds=60)
+    manifest.create(APP_IDS, shard_size=shard_size, ex_rates={"EUR": 0.9})
+    return manifest
+
+
+def test_create_keeps_an_existing_manifest(storage):
+    make_manifest(storage)
+    manifest = WorkManifest(storage, prefix="distributed/", run_id="run")
+
+    assert not manifest.create(APP_IDS[:2], shard_size=1)
+    assert manifest.load()["shards"] == {"00000": [0, 1, 2, 3], "00001": [4, 5, 6, 7], "00002": [8, 9]}
+    assert manifest.load()["ex_rates"] == {"EUR": 0.9}
+
+
+def test_a_leased_shard_isnt_claimed_twice(storage, clock):
+    manifest = make_manifest(storage)
+
+    claims = [manifest.claim(f"worker-{i}") for i in range(4)]
+
+    assert sorted(claim.shard_id for claim in claims[:3]) == ["00000", "00001", "00002"]
+    assert all(claim.generation == 0 for claim in claims[:3])
+    assert claims[3] is None
+
+
+def test_an_expired_lease_is_taken_over(storage, clock):
+    manifest = make_manifest(storage)
+    claims = {claim.shard_id: claim for claim in (manifest.claim(f"worker-{i}") for i in range(3))}
+
+    clock.now += 30
+    assert manifest.claim("late") is None
+    clock.now += 31
+    manifest.complete(claims["00000"], "worker-0", {"part": manifest.part_key("00000")})
+    takeovers = [manifest.claim("late"), manifest.claim("later"), manifest.claim("latest")]
+
+    assert sorted(claim.shard_id for claim in takeovers[:2]) == ["00001", "00002"]
+    assert all(claim.generation == 1 for claim in takeovers[:2])
+    assert takeovers[2] is None
+
+
+def test_only_the_first_worker_to_finish_marks_the_shard(storage, clock):
+    manifest = make_manifest(storage, shard_size=len(APP_IDS))
+    stale = manifest.claim("slow")
+    clock.now += 61
+    takeover = manifest.claim("fast")
+    assert takeover.shard_id == stale.shard_id
+
+    assert manifest.complete(takeover, "fast", {"part": "fast.parquet"})
+    assert not manifest.complete(stale, "slow", {"part": "slow.parquet"})
+    assert manifest.completed_shards()[stale.shard_id] == {"worker_id": "fast", "generation": 1,
+                                                           "files": {"part": "fast.parquet"}}
+    assert manifest.pending_shards() == []
+
+
+def test_clear_deletes_the_run(storage, clock):
+    manifest = make_manifest(storage)
+    manifest.complete(manifest.claim("worker"), "worker", {})
+
+    manifest.clear()
+
+    assert storage.list_keys("distributed/") == []
+
+
+def test_fake_s3_rejects_unknown_parameters():
+    with pytest.raises(ParamValidationError):
+        InMemoryS3Client().put_object(Bucket="bucket", Key="key", Body=b"", IfMatches="*")
+
+
+class NoConditionalWritesClient(InMemoryS3Client):
+
+    def __init__(self, error: Exception):
+        super().__init__()
+        self.error = error
+
+    def put_object(self, IfNoneMatch: str = None, **kwargs):
+        if IfNoneMatch:
+            raise self.error
+        return super().put_object(**kwargs)
+
+
+@pytest.mark.parametrize("error", [ParamValidationError(report='Unknown parameter in input: "IfNoneMatch"'),
+                                   _ClientError("NotImplemented")])
+def test_unsupported_conditional_writes_are_an_error(error):
+    bucket = InMemoryS3Bucket(client=NoConditionalWritesClient(error))
+
+    with pytest.raises(ConditionalWriteUnsupported, match="conditional writes"):
+        make_manifest(bucket)